@@ -13,31 +13,50 @@ import src.bot.require as Require
 # noinspection PyUnresolvedReferences
 import src.bot.user as UserCommand
 # noinspection PyUnresolvedReferences
-from src.bot import callback
+from src.bot import callback, update_scoped
 from src.bot.callback import user_reg_cb, user_reg_username, user_reg_pw, cancel
 from src.bot.inline import inline_query
 from src.bot.msg import forward_message
 from src.config import BotConfig, Config
+from src.database import init_database
+from src.database.cdk import KnownCdks
+from src.http_client import close_transports
 from src.logger import bot_logger
+from src.scheduler import start_scheduler
+from src.utils import EmbyHealth
 from src.webhook.api import run_flask
 
-if Config.PROXY and Config.PROXY != "":
-    os.environ['https_proxy'] = Config.PROXY
-    os.environ['http_proxy'] = Config.PROXY
+
+async def post_init(application: Application):
+    await init_database()
+    await KnownCdks.load()
+    bot_logger.info(f"CDK filter loaded: {KnownCdks.stats()}")
+    start_scheduler(application.job_queue)
+    EmbyHealth.start()
+
+
+# noinspection PyUnusedLocal
+async def post_shutdown(application: Application):
+    await EmbyHealth.stop()
+    await close_transports()
 
 
 def run_bot():
-    application = (Application.builder()
-                   .token(BotConfig.BOT_TOKEN)
-                   .concurrent_updates(True)
-                   .connect_timeout(60)
-                   .get_updates_connect_timeout(60)
-                   .get_updates_read_timeout(60)
-                   .get_updates_write_timeout(60)
-                   .read_timeout(60)
-                   .write_timeout(60)
-                   .base_url(BotConfig.BASE_URL)
-                   .build())
+    builder = (Application.builder()
+               .token(BotConfig.BOT_TOKEN)
+               .concurrent_updates(True)
+               .connect_timeout(60)
+               .get_updates_connect_timeout(60)
+               .get_updates_read_timeout(60)
+               .get_updates_write_timeout(60)
+               .read_timeout(60)
+               .write_timeout(60)
+               .base_url(BotConfig.BASE_URL)
+               .post_init(post_init)
+               .post_shutdown(post_shutdown))
+    if Config.PROXY:
+        builder = builder.proxy(Config.PROXY).get_updates_proxy(Config.PROXY)
+    application = builder.build()
 
     # noinspection PyShadowingNames
     def load_handlers(application):
@@ -47,27 +66,27 @@ def run_bot():
             data = toml.load('command.production.toml')
         # 用户命令
         for command, handler in data['user_commands'].items():
-            application.add_handler(CommandHandler(command, eval(handler)))
+            application.add_handler(CommandHandler(command, update_scoped(eval(handler))))
         # 管理员命令
         for command, handler in data['admin_commands'].items():
-            application.add_handler(CommandHandler(command, eval(handler)))
+            application.add_handler(CommandHandler(command, update_scoped(eval(handler))))
         # 回调
         for pattern, handler in data['callback_queries'].items():
-            application.add_handler(CallbackQueryHandler(eval(handler), pattern=pattern))
+            application.add_handler(CallbackQueryHandler(update_scoped(eval(handler)), pattern=pattern))
 
     load_handlers(application)
     # 内联查询
-    application.add_handler(InlineQueryHandler(inline_query))
+    application.add_handler(InlineQueryHandler(update_scoped(inline_query)))
     application.add_handler(MessageHandler(filters.UpdateType.CHANNEL_POST, forward_message))
 
     # 对话
     conv_handler = ConversationHandler(
         entry_points=[
-            CallbackQueryHandler(user_reg_cb, pattern="user_reg_")
+            CallbackQueryHandler(update_scoped(user_reg_cb), pattern="user_reg_")
         ],
         states={
-            1: [MessageHandler(filters=~filters.UpdateType.EDITED_MESSAGE, callback=user_reg_username)],
-            2: [MessageHandler(filters=~filters.UpdateType.EDITED_MESSAGE, callback=user_reg_pw)],
+            1: [MessageHandler(filters=~filters.UpdateType.EDITED_MESSAGE, callback=update_scoped(user_reg_username))],
+            2: [MessageHandler(filters=~filters.UpdateType.EDITED_MESSAGE, callback=update_scoped(user_reg_pw))],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
     )
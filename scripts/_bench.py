@@ -0,0 +1,31 @@
+"""
+基准测试脚本的公共部分
+必须在导入 src.database 之前调用 use_temp_databases，ENGINE 在导入时根据 DATABASES_DIR 创建
+"""
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT_PATH = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_PATH))
+
+from src.config import Config  # noqa: E402
+
+
+def use_temp_databases() -> Path:
+    """数据库与备份放在临时目录中，不影响正在使用的数据"""
+    Config.DATABASES_DIR = Path(tempfile.mkdtemp(prefix="bot-bench-"))
+    Config.BACKUP_DIR = Config.DATABASES_DIR / "backup"
+    Config.LOGGING = False
+    Config.LOG_LEVE = 30
+    return Config.DATABASES_DIR
+
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def latency(name: str, seconds: list[float]) -> str:
+    """格式化一组耗时（秒）"""
+    return f"{name:32s} p50 {percentile(seconds, 0.5) * 1e3:7.2f}ms  p99 {percentile(seconds, 0.99) * 1e3:7.2f}ms"
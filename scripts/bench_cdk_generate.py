@@ -0,0 +1,77 @@
+"""
+批量生成注册码并导出 gzip 文件：比较旧版逐个 add_cdk 与 bulk_add_cdk，以及无签名与带签名两种格式
+输出每秒生成的注册码数量与导出文件大小
+
+    python scripts/bench_cdk_generate.py [-n 100000] [--legacy 2000]
+"""
+import argparse
+import asyncio
+import time
+
+from _bench import use_temp_databases
+
+use_temp_databases()
+
+from src.bot import reply_codes  # noqa: E402
+from src.config import Config  # noqa: E402
+from src.database import init_database  # noqa: E402
+from src.database.cdk import CdkModel, CdkOperate, generate_cdk  # noqa: E402
+
+
+class FakeMessage:
+    """代替 telegram 消息，只读取发送的文件大小"""
+
+    def __init__(self):
+        self.size = 0
+
+    async def reply_text(self, text: str):
+        self.size = len(text.encode("utf-8"))
+
+    async def reply_document(self, document, filename: str):
+        self.size = len(document.read())
+
+
+class FakeUpdate:
+    def __init__(self):
+        self.message = FakeMessage()
+
+
+async def add_one_by_one(quantity: int, limit: int, expired_time: int) -> list[str]:
+    """旧版 gen_cdk 的做法：每个注册码一个会话与一次提交"""
+    codes = []
+    for _ in range(quantity):
+        code = generate_cdk()
+        await CdkOperate.add_cdk(CdkModel(cdk=code, limit=limit, expired_time=expired_time))
+        codes.append(code)
+    return codes
+
+
+async def run(name: str, generate, quantity: int):
+    update = FakeUpdate()
+    start = time.perf_counter()
+    codes = await generate(quantity, 1, 0)
+    generated = time.perf_counter() - start
+    await reply_codes(update, f"生成 {quantity} 个注册码\n\n", codes)
+    total = time.perf_counter() - start
+    raw = sum(len(code) + 1 for code in codes)
+    print(f"{name:24s} {quantity:7d} codes  generate {quantity / generated:7.0f} codes/s  "
+          f"with export {quantity / total:7.0f} codes/s  {raw / 1e6:.2f}MB -> {update.message.size / 1e6:.2f}MB")
+
+
+async def main(quantity: int, legacy: int):
+    await init_database()
+    Config.SALT = Config.SALT or "bench"
+    for signed in (False, True):
+        Config.SIGNED_CDK = signed
+        label = "signed" if signed else "unsigned"
+        if legacy:
+            await run(f"add_cdk loop, {label}", add_one_by_one, legacy)
+        await run(f"bulk_add_cdk, {label}", CdkOperate.bulk_add_cdk, quantity)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=100000, help="bulk_add_cdk 生成的数量")
+    parser.add_argument("--legacy", type=int, default=2000, help="逐个 add_cdk 生成的数量，0 为跳过")
+    args = parser.parse_args()
+    asyncio.run(main(args.n, args.legacy))
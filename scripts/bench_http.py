@@ -0,0 +1,103 @@
+"""
+50 个并发处理函数请求本地的 Emby 模拟服务器，比较每次新建客户端、默认参数的客户端与共享连接池的吞吐量和建立的连接数
+模拟服务器在子进程中运行，避免与客户端争用同一个事件循环
+
+    python scripts/bench_http.py [--concurrency 50] [--rounds 60]
+"""
+import argparse
+import asyncio
+import subprocess
+import sys
+import time
+
+from _bench import ROOT_PATH  # noqa: F401
+
+import httpx
+
+from src import http_client
+from src.config import HttpConfig
+
+BODY = b'{"Id":"1","ServerName":"stub"}'
+
+
+async def serve():
+    """模拟服务器：每个请求延迟 2ms 后返回固定的 JSON，/conns 返回并清零期间建立的连接数"""
+    connections = 0
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        nonlocal connections
+        connections += 1
+        try:
+            while line := await reader.readline():
+                while (await reader.readline()) not in (b"\r\n", b""):
+                    pass
+                if line.startswith(b"GET /conns"):
+                    body, connections = str(connections).encode(), 0
+                else:
+                    body = BODY
+                    await asyncio.sleep(0.002)
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n"
+                             % len(body) + body)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0, backlog=1024)
+    print(server.sockets[0].getsockname()[1], flush=True)
+    await server.serve_forever()
+
+
+async def connections(url: str) -> int:
+    async with httpx.AsyncClient() as client:
+        # 本次查询自身也会建立一个连接
+        return int((await client.get(f"{url}/conns")).text) - 1
+
+
+async def run(name: str, url: str, make_client, concurrency: int, rounds: int, per_call: bool = False):
+    await connections(url)
+    client = None if per_call else make_client()
+
+    async def handler():
+        if per_call:
+            async with make_client() as own:
+                (await own.get("/System/Info/Public")).json()
+        else:
+            (await client.get("/System/Info/Public")).json()
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await asyncio.gather(*(handler() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    if client:
+        await client.aclose()
+    print(f"{name:40s} {rounds * concurrency / elapsed:7.0f} req/s  {elapsed / rounds * 1e3:6.1f}ms/round  "
+          f"{await connections(url)} connections opened")
+
+
+async def main(concurrency: int, rounds: int):
+    stub = subprocess.Popen([sys.executable, __file__, "--serve"], stdout=subprocess.PIPE, text=True)
+    try:
+        url = f"http://127.0.0.1:{stub.stdout.readline().strip()}"
+        await run("new AsyncClient per call", url, lambda: httpx.AsyncClient(base_url=url), concurrency,
+                  max(rounds // 6, 1), per_call=True)
+        await run("one AsyncClient, default limits", url, lambda: httpx.AsyncClient(base_url=url), concurrency,
+                  rounds)
+        for keepalive in (HttpConfig.MAX_KEEPALIVE_CONNECTIONS, concurrency):
+            HttpConfig.MAX_KEEPALIVE_CONNECTIONS = keepalive
+            await http_client.close_transports()
+            await run(f"shared transport, keepalive={keepalive}", url,
+                      lambda: http_client.create_client("direct", base_url=url), concurrency, rounds)
+        await http_client.close_transports()
+    finally:
+        stub.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=50, help="并发的处理函数数量")
+    parser.add_argument("--rounds", type=int, default=60, help="轮数，每轮全部处理函数各请求一次")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    asyncio.run(serve() if args.serve else main(args.concurrency, args.rounds))
@@ -0,0 +1,52 @@
+"""
+按 DatabaseConfig 的调优预设分别测试并发读写吞吐量 每个预设在单独的进程中运行，连接在导入时按预设配置
+
+    python scripts/bench_pragmas.py [-n 2000] [--profile balanced]
+"""
+import argparse
+import asyncio
+import subprocess
+import sys
+import time
+
+from _bench import use_temp_databases
+
+from src.config import DatabaseConfig
+
+
+async def run(count: int, users: int = 200):
+    use_temp_databases()
+    from src.database import ENGINE, init_database, resolve_pragmas
+    from src.database.score import LedgerReason, ScoreOperate
+
+    await init_database()
+    start = time.perf_counter()
+    results = await asyncio.gather(*(ScoreOperate.credit(i % users, 1, LedgerReason.SIGN) for i in range(count)),
+                                   return_exceptions=True)
+    writes = count / (time.perf_counter() - start)
+    errors = sum(isinstance(result, Exception) for result in results)
+    start = time.perf_counter()
+    await asyncio.gather(*(ScoreOperate.get_score(i % users) for i in range(count)))
+    reads = count / (time.perf_counter() - start)
+    print(f"{DatabaseConfig.PROFILE:9s} writes {writes:6.0f}/s ({errors} errors)  reads {reads:6.0f}/s  "
+          f"{resolve_pragmas()}")
+    await ENGINE.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=2000, help="并发读写的次数")
+    parser.add_argument("--profile", help="只测试一个预设，默认依次测试全部预设")
+    args = parser.parse_args()
+    if args.profile:
+        DatabaseConfig.PROFILE = args.profile
+        asyncio.run(run(args.n))
+        return
+    from src.database import PRAGMA_PROFILES
+
+    for profile in PRAGMA_PROFILES:
+        subprocess.run([sys.executable, __file__, "-n", str(args.n), "--profile", profile], check=True)
+
+
+if __name__ == "__main__":
+    main()
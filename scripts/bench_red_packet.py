@@ -0,0 +1,62 @@
+"""
+大量用户同时领取一个红包：每次点击在一条语句中领取一份未领取的份额
+分别测试逐个提交与组提交，检查没有重复领取与丢失的份额
+
+    python scripts/bench_red_packet.py [--clickers 1000] [--shares 500]
+"""
+import argparse
+import asyncio
+import time
+
+from _bench import latency, use_temp_databases
+
+use_temp_databases()
+
+from src.database import init_database  # noqa: E402
+from src.database.score import LedgerReason, RedPacketModel, ScoreOperate  # noqa: E402
+
+SENDER = 0
+
+
+async def run(name: str, clickers: int, shares: int, group_commit: bool) -> bool:
+    amount = shares * 10
+    packet = RedPacketModel(telegram_id=SENDER, amount=amount, count=shares, current_amount=amount,
+                            create_time=int(time.time()))
+    await ScoreOperate.create_red_packet(packet, [10] * shares)
+    seconds = []
+
+    async def click(telegram_id: int):
+        start = time.perf_counter()
+        # 每个用户点击两次，第二次应当领取失败
+        claimed = [await ScoreOperate.claim_red_packet(packet.id, telegram_id, f"user{telegram_id}", group_commit)
+                   for _ in range(2)]
+        seconds.append(time.perf_counter() - start)
+        return claimed
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(click(telegram_id) for telegram_id in range(1, clickers + 1)))
+    elapsed = time.perf_counter() - start
+    claims = [first for first, _ in results if first]
+    duplicates = sum(1 for _, second in results if second)
+    packet = await ScoreOperate.get_red_packet(packet.id)
+    ok = len(claims) == min(clickers, shares) and not duplicates and \
+        sum(claimed for claimed, _ in claims) == amount - packet.current_amount
+    print(latency(name, seconds), f" {clickers * 2 / elapsed:6.0f} clicks/s  {len(claims)} claimed, "
+                                  f"{duplicates} duplicates, remaining {packet.current_amount}  {'OK' if ok else 'WRONG'}")
+    return ok
+
+
+async def main(clickers: int, shares: int):
+    await init_database()
+    await ScoreOperate.credit(SENDER, shares * 10 * 2, LedgerReason.SIGN)
+    ok = await run("claim, one commit per click", clickers, shares, group_commit=False)
+    ok &= await run("claim, group commit", clickers, shares, group_commit=True)
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clickers", type=int, default=1000, help="同时领取的人数")
+    parser.add_argument("--shares", type=int, default=500, help="红包份数")
+    args = parser.parse_args()
+    asyncio.run(main(args.clickers, args.shares))
@@ -0,0 +1,79 @@
+"""
+比较建表移入 init_database 前后的启动耗时：导入全部数据库模块（python -X importtime）与 init_database 的耗时
+两个版本都通过 git worktree 检出到临时目录，每次测量都在新的子进程与空的数据库目录中进行
+
+    python scripts/bench_startup.py [--before REV] [--after REV] [-n 5]
+"""
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from _bench import ROOT_PATH
+
+MODULES = ("src.database.score", "src.database.cdk", "src.database.user")
+PROBE = """
+import asyncio, sys, time
+sys.path.insert(0, {root!r})
+from src.config import Config
+Config.DATABASES_DIR = {directory!r}
+Config.LOGGING = False
+start = time.perf_counter()
+import {modules}
+imported = time.perf_counter()
+import src.database
+if hasattr(src.database, "init_database"):
+    asyncio.run(src.database.init_database())
+print(imported - start, time.perf_counter() - imported if hasattr(src.database, "init_database") else -1)
+"""
+IMPORT_TIME = re.compile(r"import time:\s+\d+ \|\s+(\d+) \| (\S+)$")
+
+
+def user_010() -> str:
+    """user-010 的第一个提交"""
+    commits = subprocess.run(["git", "rev-list", "--reverse", r"--grep=^\[user-010\]", "HEAD"], cwd=ROOT_PATH,
+                             capture_output=True, text=True, check=True).stdout.split()
+    return commits[0]
+
+
+def measure(root: Path) -> tuple[float, float, float]:
+    """返回 importtime 统计的数据库模块累计耗时、导入耗时与 init_database 耗时（秒）"""
+    with tempfile.TemporaryDirectory(prefix="bot-bench-") as directory:
+        code = PROBE.format(root=str(root), directory=str(Path(directory) / "database"), modules=", ".join(MODULES))
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=root, capture_output=True,
+                                text=True, check=True)
+    cumulative = sum(int(match.group(1)) for line in result.stderr.splitlines()
+                     if (match := IMPORT_TIME.match(line)) and match.group(2) in MODULES)
+    imported, initialized = map(float, result.stdout.split()[-2:])
+    return cumulative / 1e6, imported, initialized
+
+
+def report(name: str, revision: str, rounds: int):
+    with tempfile.TemporaryDirectory(prefix="bot-bench-") as worktree:
+        subprocess.run(["git", "worktree", "add", "--detach", worktree, revision], cwd=ROOT_PATH, check=True,
+                       capture_output=True)
+        try:
+            samples = [measure(Path(worktree)) for _ in range(rounds)]
+        finally:
+            subprocess.run(["git", "worktree", "remove", "--force", worktree], cwd=ROOT_PATH, check=True)
+    cumulative, imported, initialized = (statistics.median(column) for column in zip(*samples))
+    init = "runs at import" if initialized < 0 else f"{initialized * 1e3:6.1f}ms"
+    print(f"{name:8s} importtime {cumulative * 1e3:6.1f}ms  import wall {imported * 1e3:6.1f}ms  "
+          f"init_database {init}")
+
+
+def main(before: str, after: str, rounds: int):
+    report("before", before, rounds)
+    report("after", after, rounds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--before", help="修改前的提交，默认为 user-010 第一个提交的父提交")
+    parser.add_argument("--after", help="修改后的提交，默认为 user-010 第一个提交，HEAD 为当前版本")
+    parser.add_argument("-n", type=int, default=5, help="每个版本测量的次数，取中位数")
+    args = parser.parse_args()
+    main(args.before or f"{user_010()}^", args.after or user_010(), args.n)
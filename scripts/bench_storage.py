@@ -0,0 +1,104 @@
+"""
+比较旧版按模块分别建立引擎（每个模块一个数据库文件与连接池，跨模块操作各自提交）与统一引擎（ATTACH 全部数据库，一个事务）
+两边使用相同的调优预设（resolve_pragmas），模拟注册流程同时写入用户与积分，输出每次操作的提交次数与提交延迟
+只统计 SQLAlchemy 的提交次数，不统计 fsync：balanced 预设（synchronous=NORMAL）下 WAL 提交本身不调用 fsync
+
+    python scripts/bench_storage.py [-n 2000] [--profile durable]
+"""
+import argparse
+import asyncio
+import time
+
+from _bench import latency, use_temp_databases
+
+from src.config import DatabaseConfig
+
+
+def count_commits(engine) -> list[int]:
+    from sqlalchemy import event
+
+    commits = [0]
+    event.listen(engine.sync_engine, "commit", lambda *_: commits.__setitem__(0, commits[0] + 1))
+    return commits
+
+
+async def separate_engines(directory, pragmas: dict):
+    """旧版的方式：每个模块一个数据库文件与引擎，连接使用与统一引擎相同的 PRAGMA"""
+    from sqlalchemy import event
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    from src.database.score import ScoreDatabaseModel
+    from src.database.user import UsersDatabaseModel
+
+    def apply_pragmas(dbapi_connection, _connection_record):
+        cursor = dbapi_connection.cursor()
+        for key, value in pragmas.items():
+            cursor.execute(f"PRAGMA {key} = {value}")
+        cursor.close()
+
+    engines = {}
+    for name, model in (("users", UsersDatabaseModel), ("score", ScoreDatabaseModel)):
+        engine = create_async_engine(f"sqlite+aiosqlite:///{directory / 'separate' / name}.db") \
+            .execution_options(schema_translate_map={"score": None})
+        event.listen(engine.sync_engine, "connect", apply_pragmas)
+        async with engine.begin() as connection:
+            await connection.exec_driver_sql("PRAGMA journal_mode = WAL")
+            await connection.run_sync(model.metadata.create_all)
+        engines[name] = engine
+    return engines
+
+
+async def main(count: int):
+    directory = use_temp_databases()
+    from sqlalchemy import insert
+    from sqlalchemy.ext.asyncio import async_sessionmaker
+
+    from src.database import ENGINE, SessionFactory, init_database, resolve_pragmas
+    from src.database.score import ScoreModel
+    from src.database.user import UserModel
+
+    (directory / "separate").mkdir()
+    await init_database()
+    engines = await separate_engines(directory, resolve_pragmas())
+    sessions = {name: async_sessionmaker(engine) for name, engine in engines.items()}
+    separate_commits = [count_commits(engine) for engine in engines.values()]
+    unified_commits = count_commits(ENGINE)
+
+    async def separate_write(telegram_id: int):
+        async with sessions["users"]() as session, session.begin():
+            await session.execute(insert(UserModel).values(telegram_id=telegram_id))
+        async with sessions["score"]() as session, session.begin():
+            await session.execute(insert(ScoreModel).values(telegram_id=telegram_id))
+
+    async def unified_write(telegram_id: int):
+        async with SessionFactory() as session, session.begin():
+            await session.execute(insert(UserModel).values(telegram_id=telegram_id))
+            await session.execute(insert(ScoreModel).values(telegram_id=telegram_id))
+
+    separate, unified = [], []
+    for telegram_id in range(count):
+        # 交替先后顺序，避免某一边总是在另一边的检查点之后运行
+        order = ((separate_write, separate), (unified_write, unified))
+        for write, samples in order if telegram_id % 2 else reversed(order):
+            start = time.perf_counter()
+            await write(telegram_id)
+            samples.append(time.perf_counter() - start)
+
+    print(f"{DatabaseConfig.PROFILE}: {resolve_pragmas()}")
+    print(latency("separate engines", separate), f" {count / sum(separate):6.0f} ops/s  "
+                                                 f"{sum(c[0] for c in separate_commits) / count:.1f} commits/op")
+    print(latency("unified engine", unified), f" {count / sum(unified):6.0f} ops/s  "
+                                             f"{unified_commits[0] / count:.1f} commits/op")
+    for engine in engines.values():
+        await engine.dispose()
+    await ENGINE.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=2000, help="注册次数")
+    parser.add_argument("--profile", help="调优预设，默认使用配置中的预设")
+    args = parser.parse_args()
+    if args.profile:
+        DatabaseConfig.PROFILE = args.profile
+    asyncio.run(main(args.n))
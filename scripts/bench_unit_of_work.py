@@ -0,0 +1,80 @@
+"""
+比较 /reg 与 /transfer 流程中每个 Operate 调用单独提交与合并到一个 unit_of_work 的提交次数与吞吐量
+
+    python scripts/bench_unit_of_work.py [-n 1000]
+"""
+import argparse
+import asyncio
+import time
+
+from _bench import use_temp_databases
+
+use_temp_databases()
+
+from sqlalchemy import event  # noqa: E402
+
+from src.database import ENGINE, init_database, unit_of_work  # noqa: E402
+from src.database.cdk import CdkModel, CdkOperate  # noqa: E402
+from src.database.score import LedgerReason, ScoreOperate  # noqa: E402
+from src.database.user import Role, UserCache, UserModel, UsersOperate  # noqa: E402
+
+CDK = "reg_benchmark"
+commits = 0
+
+
+def _count_commit(*_):
+    global commits
+    commits += 1
+
+
+async def reg(telegram_id: int):
+    """/reg：使用注册码、绑定账号、赠送积分"""
+    await CdkOperate.redeem(CDK, telegram_id)
+    user = await UsersOperate.get_user(telegram_id)
+    user.bind_id, user.role = f"emby-{telegram_id}", Role.ORDINARY.value
+    await UsersOperate.update_user(user)
+    await ScoreOperate.credit(telegram_id, 1, LedgerReason.SIGN)
+
+
+async def transfer(telegram_id: int):
+    """/transfer 旧版的做法：扣除与增加分开调用"""
+    await ScoreOperate.debit(0, 1, LedgerReason.TRANSFER)
+    await ScoreOperate.credit(telegram_id, 1, LedgerReason.TRANSFER)
+
+
+async def in_unit_of_work(flow, telegram_id: int):
+    async with unit_of_work():
+        await flow(telegram_id)
+
+
+async def run(name: str, flow, telegram_ids: range, grouped: bool):
+    global commits
+    commits = 0
+    start = time.perf_counter()
+    for telegram_id in telegram_ids:
+        await (in_unit_of_work(flow, telegram_id) if grouped else flow(telegram_id))
+    elapsed = time.perf_counter() - start
+    print(f"{name:28s} {len(telegram_ids) / elapsed:6.0f} flows/s  {commits / elapsed:6.0f} commits/s  "
+          f"{commits / len(telegram_ids):.1f} commits/flow")
+
+
+async def main(count: int):
+    await init_database()
+    event.listen(ENGINE.sync_engine, "commit", _count_commit)
+    await CdkOperate.add_cdk(CdkModel(cdk=CDK, limit=count * 2, expired_time=0))
+    await ScoreOperate.credit(0, count * 2, LedgerReason.SIGN)
+    for telegram_id in range(1, count * 2 + 1):
+        await UsersOperate.add_user(UserModel(telegram_id=telegram_id, username="user", fullname="User"))
+    # 关闭缓存，每次都从数据库读取用户
+    UserCache.maxsize = 0
+    await run("/reg, separate commits", reg, range(1, count + 1), grouped=False)
+    await run("/reg, unit_of_work", reg, range(count + 1, count * 2 + 1), grouped=True)
+    await run("/transfer, separate commits", transfer, range(1, count + 1), grouped=False)
+    await run("/transfer, unit_of_work", transfer, range(count + 1, count * 2 + 1), grouped=True)
+    await ENGINE.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=1000, help="每种流程的执行次数")
+    asyncio.run(main(parser.parse_args().n))
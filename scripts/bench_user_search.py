@@ -0,0 +1,77 @@
+"""
+在大量用户中按名字查找候选用户的耗时：完全匹配、三个字符以上的片段（FTS5 trigram）与短关键词
+分别输出 search_users 的总耗时与其中 SQLite 执行语句的耗时，差值是 aiosqlite 线程切换与 ORM 的开销
+
+    python scripts/bench_user_search.py [-n 100000] [--queries 500]
+"""
+import argparse
+import asyncio
+import random
+import string
+import time
+
+from _bench import latency, use_temp_databases
+
+use_temp_databases()
+
+from sqlalchemy import event, insert  # noqa: E402
+
+from src.database import ENGINE, init_database, session_scope  # noqa: E402
+from src.database.user import UserModel, UsersOperate  # noqa: E402
+
+_random = random.Random(0)
+_executing = [0.0, 0.0]  # 开始时间，累计耗时
+
+
+@event.listens_for(ENGINE.sync_engine, "before_cursor_execute")
+def _before_execute(*_):
+    _executing[0] = time.perf_counter()
+
+
+@event.listens_for(ENGINE.sync_engine, "after_cursor_execute")
+def _after_execute(*_):
+    _executing[1] += time.perf_counter() - _executing[0]
+
+
+def _name() -> str:
+    return "".join(_random.choices(string.ascii_letters, k=_random.randint(5, 14)))
+
+
+async def populate(count: int) -> list[dict]:
+    rows = [{"telegram_id": i + 1, "fullname": _name(), "username": _name() if i % 3 else None}
+            for i in range(count)]
+    async with session_scope() as session:
+        for start in range(0, count, 5000):
+            await session.execute(insert(UserModel), rows[start:start + 5000])
+    return rows
+
+
+async def run(name: str, keywords: list[str], limit: int):
+    samples, executing = [], []
+    for keyword in keywords:
+        _executing[1] = 0.0
+        start = time.perf_counter()
+        await UsersOperate.search_users(keyword, limit=limit)
+        samples.append(time.perf_counter() - start)
+        executing.append(_executing[1])
+    print(latency(name, samples), " sqlite", latency("", executing).strip())
+
+
+async def main(count: int, queries: int, limit: int):
+    await init_database()
+    rows = await populate(count)
+    sample = _random.sample(rows, queries)
+    await run("exact fullname", [row["fullname"] for row in sample], limit)
+    await run("exact username", [row["username"] or row["fullname"] for row in sample], limit)
+    await run("fragment (4 chars)", [row["fullname"][1:5] for row in sample], limit)
+    await run("short (2 chars)", [row["fullname"][:2] for row in sample], limit)
+    await run("no match", [_name() + "#" for _ in sample], limit)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=100000, help="用户数量")
+    parser.add_argument("--queries", type=int, default=500, help="每类查询的次数")
+    parser.add_argument("--limit", type=int, default=5, help="返回的候选数量")
+    args = parser.parse_args()
+    asyncio.run(main(args.n, args.queries, args.limit))
@@ -0,0 +1,57 @@
+"""
+并发使用同一个注册码：比较旧版的读取-修改-写回与 CdkOperate.redeem 的原子扣减
+检查成功次数是否超过使用次数
+
+    python scripts/stress_cdk_redeem.py [-n 500] [--limit 10]
+"""
+import argparse
+import asyncio
+import time
+
+from _bench import use_temp_databases
+
+use_temp_databases()
+
+from src.database import init_database  # noqa: E402
+from src.database.cdk import CdkModel, CdkOperate  # noqa: E402
+
+
+async def legacy_redeem(cdk: str, telegram_id: int) -> bool:
+    """旧版 start()/reg() 的做法：读取后在 Python 中检查并扣减，再整行写回"""
+    cdk_data = await CdkOperate.get_cdk(cdk)
+    if cdk_data is None or cdk_data.limit <= 0:
+        return False
+    await asyncio.sleep(0)  # 处理函数在读取与写回之间还有其他 await
+    cdk_data.limit -= 1
+    await CdkOperate.update_cdk(cdk_data)
+    return True
+
+
+async def run(name: str, redeem, code: str, count: int, limit: int):
+    await CdkOperate.add_cdk(CdkModel(cdk=code, limit=limit, expired_time=0))
+    start = time.perf_counter()
+    results = await asyncio.gather(*(redeem(code, telegram_id) for telegram_id in range(count)),
+                                   return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    succeeded = sum(result is True for result in results)
+    errors = [result for result in results if isinstance(result, Exception)]
+    remaining = (await CdkOperate.get_cdk(code)).limit
+    status = "OK" if succeeded == limit and remaining == 0 else "OVER-REDEEMED" if succeeded > limit else "WRONG"
+    print(f"{name:8s} {count} concurrent, limit {limit}: {succeeded} succeeded, remaining {remaining}, "
+          f"{len(errors)} errors, {elapsed * 1e3:.0f}ms  {status}")
+    return status == "OK"
+
+
+async def main(count: int, limit: int):
+    await init_database()
+    await run("legacy", legacy_redeem, "reg_legacy", count, limit)
+    ok = await run("redeem", CdkOperate.redeem, "reg_atomic", count, limit)
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=500, help="同时使用的人数")
+    parser.add_argument("--limit", type=int, default=10, help="注册码使用次数")
+    args = parser.parse_args()
+    asyncio.run(main(args.n, args.limit))
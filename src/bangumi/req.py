@@ -1,9 +1,10 @@
 from functools import wraps
 from typing import Any, Dict, Optional
 
-import httpx
 from httpx import Response
 
+from src.config import HttpConfig
+from src.http_client import create_client
 from src.logger import emby_logger
 
 
@@ -22,7 +23,7 @@ def json_response(func):
 class BangumiRequest:
     
     def __init__(self, access_token: Optional[str] = None):
-        self.client = httpx.AsyncClient(base_url="https://api.bgm.tv/")
+        self.client = create_client(HttpConfig.BANGUMI_PROXY, base_url="https://api.bgm.tv/")
         self.access_token = access_token
         self.user_data = None
         self.user_id = None
@@ -1,19 +1,29 @@
+import asyncio
+import gzip
+import html
 import json
 import logging
+import tempfile
 from asyncio import sleep
-from datetime import datetime
 from functools import wraps
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes
 
 from src.config import BotConfig
+from src.database.scope import update_scope
 from src.database.user import Role, UserModel, UsersOperate
-from src.utils import check_server_connectivity, is_user_in_group
-from src.logger import bot_logger
+from src.utils import AmbiguousUserError, EmbyHealth, is_user_in_group
 
-last_check_time = 0
-server_close = False
+
+def update_scoped(func):
+    """同一个 update 内共享已加载的数据库对象，结束时统一写回"""
+    @wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        async with update_scope():
+            return await func(update, context, *args, **kwargs)
+
+    return wrapper
 
 
 def check_admin(func):
@@ -88,7 +98,7 @@ def check_banned(func):
             if keyboard:
                 await update.message.reply_text("请先加入频道和群组", reply_markup=InlineKeyboardMarkup(keyboard))
                 return
-            else:
+            elif "check_pass" not in user_ex_data:
                 user_ex_data["check_pass"] = False
                 user_data.data = json.dumps(user_ex_data)
                 await UsersOperate.update_user(user_data)
@@ -100,24 +110,35 @@ def check_banned(func):
 def command_warp(func):
     @wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-        global last_check_time, server_close
-        if last_check_time + 60 < datetime.now().timestamp():
-            last_check_time = datetime.now().timestamp()
-            bot_logger.info(f"Server check")
-            if not await check_server_connectivity():
-                bot_logger.info(f"Server check close")
-                server_close = True
-                return await update.message.reply_text("服务器已经关闭，请稍后再试。")
-            else:
-                bot_logger.info(f"Server check successful")
-                server_close = False
-        if server_close:
+        # 服务器状态由后台任务定时检查，这里只读取结果
+        if not EmbyHealth.is_up():
             return await update.message.reply_text("服务器已经关闭，请稍后再试。")
         return await func(update, context, *args, **kwargs)
 
     return wrapper
 
 
+def choose_user(func):
+    """名字匹配到多个用户时列出候选，改用其中一个 Telegram ID 重新执行命令"""
+    @wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        try:
+            return await func(update, context, *args, **kwargs)
+        except AmbiguousUserError as e:
+            command, *arguments = update.message.text.split()
+            index = arguments.index(e.keyword) if e.keyword in arguments else None
+            text = f"找到多个匹配 {html.escape(e.keyword)} 的用户，请使用 Telegram ID 重新执行:\n"
+            for user in e.candidates:
+                if index is not None:
+                    arguments[index] = str(user.telegram_id)
+                choice = " ".join([command, *arguments]) if index is not None else str(user.telegram_id)
+                username = f" @{html.escape(user.username)}" if user.username else ""
+                text += f"<code>{html.escape(choice)}</code> {html.escape(user.fullname or '')}{username}\n"
+            return await update.message.reply_text(text, parse_mode="HTML")
+
+    return wrapper
+
+
 def check_private(func):
     @wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
@@ -132,3 +153,52 @@ def check_private(func):
         return await func(update, context, *args, **kwargs)
 
     return wrapper
+
+
+def page_keyboard(prefix: str, first_key: int, last_key: int, has_prev: bool,
+                  has_next: bool) -> InlineKeyboardMarkup | None:
+    """
+    键集分页的翻页按钮 回调数据为 {prefix}p_{本页第一个键} / {prefix}n_{本页最后一个键}
+    :param prefix: 回调前缀
+    :param first_key: 本页第一条数据的键
+    :param last_key: 本页最后一条数据的键
+    :param has_prev: 是否有上一页
+    :param has_next: 是否有下一页
+    """
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("上一页", callback_data=f"{prefix}p_{first_key}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("下一页", callback_data=f"{prefix}n_{last_key}"))
+    return InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+def parse_page(data: str, prefix: str) -> dict:
+    """
+    解析 page_keyboard 生成的回调数据
+    :return: 传给分页查询的 after/before 参数
+    """
+    direction, key = data.removeprefix(prefix).split("_")
+    return {"after": int(key)} if direction == "n" else {"before": int(key)}
+
+
+def _write_codes(file, header: str, codes: list[str]):
+    with gzip.GzipFile(fileobj=file, mode="wb", compresslevel=6) as gz:
+        gz.write(header.encode("utf-8"))
+        for start in range(0, len(codes), 4096):
+            gz.write("".join(f"{code}\n" for code in codes[start:start + 4096]).encode("utf-8"))
+
+
+async def reply_codes(update: Update, header: str, codes: list[str], filename: str = "registration_codes"):
+    """
+    回复生成的注册码 超出消息长度时写入 gzip 临时文件后作为文件发送
+    :param header: 注册码列表前的说明
+    :param codes: 注册码列表
+    :param filename: 文件名（不含扩展名）
+    """
+    if len(header) + sum(len(code) + 1 for code in codes) <= 4096:
+        return await update.message.reply_text(header + "".join(f"{code}\n" for code in codes))
+    with tempfile.TemporaryFile() as file:
+        await asyncio.to_thread(_write_codes, file, header, codes)
+        file.seek(0)
+        await update.message.reply_document(document=file, filename=f"{filename}.txt.gz")
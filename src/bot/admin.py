@@ -1,23 +1,25 @@
+import html
 import json
 import logging
 import os
-import random
-import string
 import subprocess
 import sys
 from datetime import datetime
-from io import BytesIO
 from pathlib import Path
 
 import toml
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, Update
 from telegram.ext import ContextTypes
 
-from src.bot import check_admin, check_private, command_warp
+from src.bot import check_admin, check_private, choose_user, command_warp, page_keyboard, parse_page, reply_codes
 from src.config import BotConfig
-from src.database.cdk import CdkModel, CdkOperate
+from src.database import pending_vacuum, unit_of_work, vacuum_database
+from src.database.archive import ArchiveKind, ArchiveOperate
+from src.database.backup import BackupError, backup_databases, list_backups, restore_databases, verify_backup
+from src.database.cdk import CdkModel, CdkOperate, signed_expiry
 from src.database.score import ScoreModel, ScoreOperate
 from src.database.user import Role, UserModel, UsersOperate
+from src.scheduler import paused_jobs
 from src.utils import convert_to_china_timezone, get_password_hash, get_user_info, is_integer, EmbyClient
 
 
@@ -43,10 +45,14 @@ async def shelp(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"<code>/requireList</code> 查看番剧请求列表\n"
                 f"<code>/getconfig</code> 获取配置\n"
                 f"<code>/setconfig [key] [value]</code> 设置配置\n"
-                f"<code>/cdk_info [cdk]</code> 获取某个CDK信息\n")
+                f"<code>/cdk_info [cdk]</code> 获取某个CDK信息\n"
+                f"<code>/archive [red_packet/require/cdk] [ID/查询键]</code> 查看归档数据，不带参数时显示归档统计\n"
+                f"<code>/backup [list/verify] [name]</code> 备份数据库，list 查看备份，verify 校验备份\n"
+                f"<code>/restore [name]</code> 从备份恢复数据库\n"
+                f"<code>/vacuum</code> 为旧数据库开启增量回收（执行一次 VACUUM）\n")
     all_key = ["/summon", "/checkinfo", "/deleteAccount", "/clearUser", "/move", "/requireList", "/setGroup",
                "/cdks", "/update", "/resetpw", "/setScore", "/setCDKgen", "/deleteCDK", "/setCdkLimit", "/setCdkTime",
-               "/getconfig", "/setconfig", "/cdk_info", "/cancel 取消"]
+               "/getconfig", "/setconfig", "/cdk_info", "/archive", "/backup", "/restore", "/vacuum", "/cancel 取消"]
     all_keyboard = []
     for i in range(0, len(all_key), 4):
         all_keyboard.append(all_key[i:i + 4])
@@ -72,6 +78,7 @@ async def set_cdk_limit(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 @check_admin
+@choose_user
 async def clear_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) != 1:
         return await update.message.reply_text("Usage: /clear_user <id/name>")
@@ -79,12 +86,14 @@ async def clear_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not user_info:
         return await update.message.reply_text("用户未找到")
     tg_id = user_info.telegram_id
-    await UsersOperate.delete(tg_id)
-    await ScoreOperate.delete(tg_id)
+    async with unit_of_work():
+        await UsersOperate.delete(tg_id)
+        await ScoreOperate.delete(tg_id)
     await update.message.reply_text(f"成功清除用户 {user_info.fullname} 的所有数据.")
 
 
 @check_admin
+@choose_user
 async def move(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) != 2:
         return await update.message.reply_text("Usage: /move <id/name> <new_tg_id>")
@@ -92,21 +101,18 @@ async def move(update: Update, context: ContextTypes.DEFAULT_TYPE):
     _, user_info = await get_user_info(old_id, only_tg_info=True)
     if not user_info:
         return await update.message.reply_text("用户未找到")
-    user_info.telegram_id = int(new_id)
     n_info = await UsersOperate.get_user(int(new_id))
     if n_info:
         # await UsersOperate.delete(int(new_id))
         keyboard = InlineKeyboardMarkup(
-            [[InlineKeyboardButton("确认", callback_data=f"move_{old_id}_{new_id}"),
+            [[InlineKeyboardButton("确认", callback_data=f"move_{user_info.telegram_id}_{new_id}"),
               InlineKeyboardButton("取消", callback_data="cancel")]])
         await update.message.reply_text(f"新账户 {n_info.fullname} {n_info.telegram_id}已存在，将会覆盖,是否确认?",
                                         reply_markup=keyboard)
         return
-    user_info.telegram_id = int(new_id)
-    await UsersOperate.update_user(user_info)
-    if score_data := await ScoreOperate.get_score(old_id):
-        score_data.telegram_id = int(new_id)
-        await ScoreOperate.update_score(score_data)
+    async with unit_of_work():
+        await UsersOperate.move(user_info.telegram_id, int(new_id))
+        await ScoreOperate.move(user_info.telegram_id, int(new_id))
     await update.message.reply_text(f"成功将用户 {user_info.fullname} 数据迁移到新账户 {new_id}.")
 
 
@@ -121,7 +127,11 @@ async def set_cdk_time(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await update.message.reply_text("注册码未找到")
     if cdk_info.expired_time == 0:
         return await update.message.reply_text("此注册码永久有效")
-    cdk_info.expired_time = cdk_info.expired_time + hours * 3600
+    expired_time = cdk_info.expired_time + hours * 3600
+    if (limit := signed_expiry(cdk)) and expired_time > limit:
+        return await update.message.reply_text(f"带签名的注册码有效期不能晚于签名中的 "
+                                               f"{convert_to_china_timezone(str(limit))}")
+    cdk_info.expired_time = expired_time
     await CdkOperate.update_cdk(cdk_info)
     await update.message.reply_text(f"成功设置 {cdk} 为 {convert_to_china_timezone(str(cdk_info.expired_time))} 小时.")
 
@@ -214,32 +224,22 @@ async def summon(update: Update, context: ContextTypes.DEFAULT_TYPE):
     usage_limit = int(context.args[0])
     quantity = int(context.args[1])
     validity_hours = int(context.args[2]) if len(context.args) > 2 else None
-    code_list = []
-    for _ in range(quantity):
-        code = f"reg_{''.join(random.choices(string.ascii_letters + string.digits, k=16))}_prej"
-        code_data = CdkModel(cdk=code, limit=usage_limit, expired_time=0)
-        code_list.append(code)
-        if validity_hours:
-            code_data.expired_time = int(datetime.now().timestamp()) + validity_hours * 3600
-        await CdkOperate.add_cdk(code_data)
-    text = f"总共生成了 {quantity} 个激活码 \n\n" + "".join(f"{code}\n" for code in code_list)
+    expired_time = int(datetime.now().timestamp()) + validity_hours * 3600 if validity_hours else 0
+    code_list = await CdkOperate.bulk_add_cdk(quantity, limit=usage_limit, expired_time=expired_time)
+    header = f"总共生成了 {quantity} 个激活码 \n\n"
     if quantity == 1:
+        text = header + f"{code_list[0]}\n"
         button = InlineKeyboardMarkup([[InlineKeyboardButton(text="发送至群组/频道",
                                                              switch_inline_query=f"cdk_{code_list[0]}\nEmby服务器注册码\n"
                                                                                  f"{code_list[0]}\n\n"
                                                                                  f"可点击按钮实现一键注册哦")]])
         await update.message.reply_text(text, reply_markup=button)
         return
-    if len(text) > 4096:
-        file_buffer = BytesIO()
-        file_buffer.write(text.encode('utf-8'))
-        file_buffer.seek(0)
-        await update.message.reply_document(document=file_buffer, filename="registration_codes.txt")
-    else:
-        await update.message.reply_text(text)
+    await reply_codes(update, header, code_list)
 
 
 @check_admin
+@choose_user
 async def checkinfo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) != 1:
         return await update.message.reply_text("使用方法: /checkinfo <Emby用户名/Telegram用户ID/Fullname>")
@@ -308,6 +308,7 @@ async def checkinfo(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @command_warp
 @check_admin
+@choose_user
 async def delete_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) != 1:
         return await update.message.reply_text("Usage: /deleteAccount <Emby_username>")
@@ -347,7 +348,8 @@ async def set_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if group not in Role.__members__:
         return await update.message.reply_text("无效的用户组")
     user_info.role = Role[group].value
-    await UsersOperate.update_user(user_info)
+    async with unit_of_work():
+        await UsersOperate.update_user(user_info)
     await update.message.reply_text(f"成功设置 {user_info.fullname} {user_info.telegram_id} 为 {group}")
 
 
@@ -355,21 +357,31 @@ async def set_group(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @check_admin
 @check_private
 async def get_all_cdk(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    code_list = await CdkOperate.get_all_cdk()
-    ret_text = ""
-    for code in code_list:
-        if (code.expired_time == 0 or code.expired_time > datetime.now().timestamp()) and code.limit > 0:
-            ret_text += (f"注册码<code>{code.cdk}</code> 使用次数: {code.limit} 到期时间: "
-                         f"{convert_to_china_timezone(code.expired_time) if code.expired_time is not None else '永久'}\n")
-
-    text = "全部注册码:\n\n" + ret_text
-    if len(text) > 4096:
-        file_buffer = BytesIO()
-        file_buffer.write(text.encode('utf-8'))
-        file_buffer.seek(0)
-        await update.message.reply_document(document=file_buffer, filename="codes.txt")
-    else:
-        await update.message.reply_text(text, parse_mode="HTML")
+    text, keyboard = await _render_cdk_page()
+    await update.message.reply_text(text, parse_mode="HTML", reply_markup=keyboard)
+
+
+CDK_PAGE_SIZE = 30
+CDK_HISTORY_PAGE_SIZE = 20
+
+
+async def _render_cdk_page(after: int = None, before: int = None) -> tuple[str, InlineKeyboardMarkup | None]:
+    codes, has_prev, has_next = await CdkOperate.page_available_cdk(CDK_PAGE_SIZE, after, before)
+    if not codes:
+        return "没有可用的注册码", None
+    text = "全部注册码:\n\n"
+    for code in codes:
+        text += (f"注册码<code>{code.cdk}</code> 使用次数: {code.limit} 到期时间: "
+                 f"{convert_to_china_timezone(code.expired_time) if code.expired_time else '永久'}\n")
+    return text, page_keyboard("cdkpage_", codes[0].id, codes[-1].id, has_prev, has_next)
+
+
+@check_admin
+async def cdk_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    text, keyboard = await _render_cdk_page(**parse_page(query.data, "cdkpage_"))
+    await query.answer()
+    await query.edit_message_text(text, parse_mode="HTML", reply_markup=keyboard)
 
 
 # noinspection PyUnusedLocal
@@ -385,6 +397,7 @@ async def update(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 @check_admin
+@choose_user
 async def set_score(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) != 2:
         return await update.message.reply_text("Usage: /setscore <id/username> <score>")
@@ -405,6 +418,7 @@ async def set_score(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @command_warp
 @check_admin
+@choose_user
 async def resetpw(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) != 2:
         return await update.message.reply_text("Usage: /resetpw <id/username> <new pw>")
@@ -418,7 +432,8 @@ async def resetpw(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if await EmbyClient.Users.change_password(new_pw, je_id):
         if user_info:
             user_info.password = get_password_hash(new_pw)
-            await UsersOperate.update_user(user_info)
+            async with unit_of_work():
+                await UsersOperate.update_user(user_info)
         return await update.message.reply_text("成功重置密码")
     else:
         return await update.message.reply_text("重置密码失败")
@@ -431,20 +446,127 @@ async def get_cdk_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     cdk = context.args[0]
     cdk_info = await CdkOperate.get_cdk(cdk)
     if not cdk_info:
+        if archived := await ArchiveOperate.find_archive(ArchiveKind.CDK, cdk, limit=1):
+            return await update.message.reply_text(_render_archive(archived), parse_mode="HTML")
         return await update.message.reply_text("注册码未找到")
+    msg, keyboard = await _render_cdk_info(cdk_info)
+    await update.message.reply_text(msg, parse_mode="HTML", reply_markup=keyboard)
+
+
+async def _render_cdk_info(cdk_info: CdkModel, after: int = None,
+                           before: int = None) -> tuple[str, InlineKeyboardMarkup | None]:
     if cdk_info.expired_time == 0:
         expired_time = "永久"
     else:
         expired_time = convert_to_china_timezone(cdk_info.expired_time)
-    history = json.loads(cdk_info.used_history) if cdk_info.used_history else []
+    usages, has_prev, has_next = await CdkOperate.page_usage(cdk_info.id, CDK_HISTORY_PAGE_SIZE, after, before)
     use_h = ""
-    for h in history:
-        user_info = await UsersOperate.get_user(int(h['tg_id']))
-        use_h += f"使用者: {user_info.fullname}\nID: {user_info.telegram_id}\n使用时间: {convert_to_china_timezone(h['time'])}\n"
+    for h, fullname in usages:
+        use_h += f"使用者: {fullname}\nID: {h.telegram_id}\n使用时间: {convert_to_china_timezone(h.use_time)}\n"
     msg = "=================注册码信息=================\n"
     msg += f"注册码: <code>{cdk_info.cdk}</code>\n"
     msg += f"剩余使用次数: {cdk_info.limit}\n"
     msg += f"到期时间: {expired_time}\n"
     msg += f"=================使用历史=================\n{use_h}"
     msg += "========================================"
-    await update.message.reply_text(msg, parse_mode="HTML")
+    keyboard = None
+    if usages:
+        keyboard = page_keyboard(f"cdkhis_{cdk_info.id}_", usages[0][0].id, usages[-1][0].id, has_prev, has_next)
+    return msg, keyboard
+
+
+@check_admin
+async def cdk_history_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    cdk_id, page = query.data.removeprefix("cdkhis_").split("_", 1)
+    cdk_info = await CdkOperate.get_cdk_by_id(int(cdk_id))
+    if not cdk_info:
+        return await query.answer("注册码未找到")
+    msg, keyboard = await _render_cdk_info(cdk_info, **parse_page(page, ""))
+    await query.answer()
+    await query.edit_message_text(msg, parse_mode="HTML", reply_markup=keyboard)
+
+
+def _render_archive(rows: list[dict]) -> str:
+    text = "\n".join(json.dumps(row, ensure_ascii=False, indent=1) for row in rows)
+    if len(text) > 4000:
+        text = text[:4000] + "\n..."
+    return f"已归档:\n<pre>{html.escape(text)}</pre>"
+
+
+@check_admin
+async def get_archive(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        stats = await ArchiveOperate.stats()
+        text = "\n".join(f"{kind}: {count} 条, {size / 1024:.1f} KiB" for kind, (count, size) in stats.items())
+        return await update.message.reply_text(f"归档统计:\n{text or '暂无归档'}")
+    if len(context.args) != 2 or context.args[0] not in {kind.value for kind in ArchiveKind}:
+        return await update.message.reply_text("Usage: /archive <red_packet/require/cdk> <ID/查询键>")
+    kind, value = ArchiveKind(context.args[0]), context.args[1]
+    # 先按原 ID 查找，再按查询键（红包为发送者ID，请求为番剧ID，注册码为注册码）查找
+    row = await ArchiveOperate.get_archive(kind, int(value)) if value.isdigit() else None
+    rows = [row] if row else await ArchiveOperate.find_archive(kind, value)
+    if not rows:
+        return await update.message.reply_text("未找到归档数据")
+    await update.message.reply_text(_render_archive(rows), parse_mode="HTML")
+
+
+def _render_manifest(name: str, manifest: dict) -> str:
+    text = f"备份: <code>{name}</code>\n创建时间: {manifest['created_at']}\n"
+    for db, info in manifest["databases"].items():
+        text += f"{db}: {info['size'] / 1024:.1f} KiB, 版本 {info['user_version']}\n"
+    return text
+
+
+@check_admin
+async def backup(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args:
+        message = await update.message.reply_text("正在备份...")
+        path = await backup_databases()
+        return await message.edit_text(_render_manifest(path.name, await verify_backup(path.name)), parse_mode="HTML")
+    if context.args[0] == "list":
+        names = [path.name for path in list_backups()]
+        return await update.message.reply_text("备份列表:\n" + "\n".join(f"<code>{name}</code>" for name in names)
+                                               if names else "暂无备份", parse_mode="HTML")
+    if context.args[0] == "verify" and len(context.args) == 2:
+        try:
+            manifest = await verify_backup(context.args[1])
+        except BackupError as e:
+            return await update.message.reply_text(f"校验失败: {e}")
+        return await update.message.reply_text(f"校验通过\n{_render_manifest(context.args[1], manifest)}",
+                                               parse_mode="HTML")
+    await update.message.reply_text("Usage: /backup [list/verify] [name]")
+
+
+@check_admin
+async def restore(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not context.args or len(context.args) > 2:
+        return await update.message.reply_text("Usage: /restore <name> [confirm]")
+    name = context.args[0]
+    try:
+        if context.args[1:] != ["confirm"]:
+            manifest = await verify_backup(name)
+            return await update.message.reply_text(
+                    f"{_render_manifest(name, manifest)}\n恢复将覆盖当前数据，确认请发送 "
+                    f"<code>/restore {name} confirm</code>", parse_mode="HTML")
+        message = await update.message.reply_text("正在恢复...")
+        with paused_jobs(context.job_queue):
+            current = await restore_databases(name)
+    except BackupError as e:
+        return await update.message.reply_text(f"恢复失败: {e}")
+    await message.edit_text(f"恢复完成，恢复前的数据已备份为 <code>{current.name}</code>", parse_mode="HTML")
+
+
+@check_admin
+async def vacuum(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    names = await pending_vacuum()
+    if not names:
+        return await update.message.reply_text("全部数据库已开启增量回收，无需 VACUUM")
+    if context.args != ["confirm"]:
+        return await update.message.reply_text(
+                f"{', '.join(names)} 尚未开启增量回收\nVACUUM 会重写数据库文件，期间 Bot 无法读写数据库，"
+                f"确认请发送 <code>/vacuum confirm</code>", parse_mode="HTML")
+    message = await update.message.reply_text("正在 VACUUM...")
+    with paused_jobs(context.job_queue):
+        shrunk = await vacuum_database()
+    await message.edit_text("VACUUM 完成\n" + "\n".join(f"{name}: 减少 {pages} 页" for name, pages in shrunk.items()))
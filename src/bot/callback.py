@@ -1,17 +1,15 @@
-import json
-import random
 from asyncio import sleep
-from datetime import datetime
 
 from telegram import Update
 from telegram.ext import ContextTypes, ConversationHandler
 
 from src.bot import command_warp
-from src.database.cdk import CdkOperate
-from src.database.score import ScoreModel, ScoreOperate
+from src.database import unit_of_work
+from src.database.cdk import CdkOperate, CdkSignature, verify_cdk
+from src.database.score import ScoreOperate
 from src.database.user import Role, UsersOperate, UserModel
 from src.logger import bot_logger
-from src.utils import base64_decode, base64_encode, get_user_info, EmbyClient, check_cdk, is_password_strong, \
+from src.utils import get_user_info, EmbyClient, check_cdk, is_password_strong, \
     get_password_hash
 
 
@@ -92,34 +90,17 @@ async def receive_red_packet(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return await query.answer("红包已经被领完")
         elif packet_data.status == 2:
             return await query.answer("红包已经被撤回")
-        if not packet_data.data:
-            return await query.answer("红包数据错误")
-        history = packet_data.history.split(",") if packet_data.history else []
-        if any(query.from_user.id == int(entry.split('#')[0]) for entry in history[:-1]):
-            return await query.answer("您已经领过这个红包了")
-        all_packet = json.loads(packet_data.data)
-        if len(all_packet) == 0:
-            packet_data.status = 1
-            await ScoreOperate.update_red_packet(packet_data)
-            return await query.answer("红包已经被领完")
-        e_score = random.choice(all_packet)
-        all_packet.remove(e_score)
+        elif packet_data.status == 3:
+            return await query.answer("红包已经过期")
         # 红包领取部分
-        from_user_score = await ScoreOperate.get_score(query.from_user.id)
-        if not from_user_score:
-            from_user_score = ScoreModel(telegram_id=query.from_user.id, score=e_score)
-            await ScoreOperate.add_score(from_user_score)
-        else:
-            from_user_score.score += e_score
-            await ScoreOperate.update_score(from_user_score)
-        packet_data.current_amount -= e_score
-        packet_data.history += f"{query.from_user.id}#{base64_encode(query.from_user.full_name)}#{e_score},"
-        packet_data.data = json.dumps(all_packet)
-        rec_count = len(history) if len(history) != 0 else 0
-        if rec_count == packet_data.count:  # 领完
-            packet_data.status = 1
-        await ScoreOperate.update_red_packet(packet_data)
-        await query.answer(f"您收到了 {e_score} 积分，当前总积分 {from_user_score.score}")
+        claim = await ScoreOperate.claim_red_packet(packet_id, query.from_user.id, query.from_user.full_name,
+                                                    group_commit=True)
+        if not claim:
+            if await ScoreOperate.has_claimed_red_packet(packet_id, query.from_user.id):
+                return await query.answer("您已经领过这个红包了")
+            return await query.answer("红包已经被领完")
+        e_score, score = claim
+        await query.answer(f"您收到了 {e_score} 积分，当前总积分 {score}")
     else:
         await query.answer("红包未找到")
 
@@ -130,16 +111,15 @@ async def red_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
     packet_id = int(query.data.split("_")[1])
     packet_data = await ScoreOperate.get_red_packet(packet_id)
     if packet_data:
-        history = packet_data.history.split(",") if packet_data.history else []
         his_t = ""
-        for i in range(len(history) - 1):
-            his_t += f"{base64_decode(history[i].split('#')[1])}: {history[i].split('#')[2]}\n"
+        for claim in await ScoreOperate.get_red_packet_claims(packet_id):
+            his_t += f"{claim.fullname}: {claim.amount}\n"
         ret_message = f"红包信息\n" \
                       f"总金额: {packet_data.amount}\n" \
                       f"总份数: {packet_data.count}\n" \
                       f"剩余金额: {packet_data.current_amount}\n" \
                       f"类型: {'随机' if packet_data.type == 0 else '平均'}\n" \
-                      f"状态: {'未领完' if packet_data.status == 0 else '已领完或撤回'}"
+                      f"状态: {['未领完', '已领完', '已撤回', '已过期'][packet_data.status]}"
         if his_t != "":
             ret_message += f"\n领取历史:\n{his_t}"
         rep = await update.effective_message.reply_text(ret_message)
@@ -162,11 +142,12 @@ async def withdraw_red(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return await query.answer("红包已经被领完")
         elif packet_data.status == 2:
             return await query.answer("红包已经被撤回")
-        packet_data.status = 2
-        await ScoreOperate.update_red_packet(packet_data)
-        score_data = await ScoreOperate.get_score(packet_data.telegram_id)
-        score_data.score += packet_data.current_amount
-        await query.answer(f"红包已经被撤回,已经返还{packet_data.current_amount}积分")
+        elif packet_data.status == 3:
+            return await query.answer("红包已经过期，剩余积分已经返还")
+        refund = await ScoreOperate.withdraw_red_packet(packet_id, query.from_user.id)
+        if refund is None:
+            return await query.answer("红包已经被领完或撤回")
+        await query.answer(f"红包已经被撤回,已经返还{refund}积分")
     else:
         await query.answer("红包未找到")
 
@@ -178,23 +159,12 @@ async def move_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if from_info.role != Role.ADMIN.value:
         return await query.answer("权限不足")
     _, from_id, to_id = query.data.split("_")
-    from_info = await UsersOperate.get_user(int(from_id))
-    to_info = await UsersOperate.get_user(int(to_id))
-    if to_info:
-        await UsersOperate.delete(to_info.telegram_id)
-    from_info.telegram_id = int(to_id)
-    await UsersOperate.update_user(from_info)
-
-    # 处理score
-    from_ore_data = await ScoreOperate.get_score(int(from_id))
-    to_ore_data = await ScoreOperate.get_score(int(to_id))
-    if to_ore_data:
+    # 覆盖目标账户，用户与积分在同一事务内迁移
+    async with unit_of_work():
+        await UsersOperate.delete(int(to_id))
         await ScoreOperate.delete(int(to_id))
-    if from_ore_data:
-        from_ore_data.telegram_id = int(to_id)
-        await ScoreOperate.update_score(from_ore_data)
-        await query.answer("已经将用户移动到该ID")
-        await query.delete_message()
+        await UsersOperate.move(int(from_id), int(to_id))
+        await ScoreOperate.move(int(from_id), int(to_id))
     await query.answer("已经将用户移动到该ID")
     await query.delete_message()
 
@@ -202,12 +172,17 @@ async def move_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def user_reg_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     cdk = query.data.replace("user_", "")
-    cdk_info = await CdkOperate.get_cdk(cdk)
     await query.answer()
+    # 签名不匹配或签名中的过期时间已过的注册码无需查询数据库
+    signature = verify_cdk(cdk)
+    if signature == CdkSignature.EXPIRED:
+        await update.effective_user.send_message("注册码已经失效")
+        return ConversationHandler.END
+    cdk_info = None if signature == CdkSignature.INVALID else await CdkOperate.get_cdk(cdk)
     if not cdk_info:
         await update.effective_user.send_message("注册码不存在")
         return ConversationHandler.END
-    if not check_cdk(cdk_info, update.effective_user.id):
+    if not await check_cdk(cdk_info, update.effective_user.id):
         await update.effective_user.send_message("注册码已经失效")
         return ConversationHandler.END
     context.user_data["cdk"] = cdk
@@ -250,37 +225,40 @@ async def complete_registration(update: Update, context: ContextTypes.DEFAULT_TY
     username = context.user_data["username"]
     password = context.user_data["password"]
     cdk = context.user_data["cdk"]
-    cdk_info = await CdkOperate.get_cdk(cdk)
-    if not cdk_info:
+    signature = verify_cdk(cdk)
+    if signature == CdkSignature.EXPIRED:
+        await update.effective_user.send_message("注册码已经失效")
+        return ConversationHandler.END
+    if signature == CdkSignature.INVALID or not await CdkOperate.get_cdk(cdk):
         await update.effective_user.send_message("注册码不存在")
         return ConversationHandler.END
+    if not await CdkOperate.redeem(cdk, update.effective_user.id):
+        await update.effective_user.send_message("注册码已经失效")
+        return ConversationHandler.END
     try:
         ret_user = await EmbyClient.Users.new_user(username)
         emby_id = ret_user["Id"]
         await EmbyClient.Users.change_password(password, emby_id)
     except Exception as e:
         bot_logger.error(f"Error: {e}")
+        await CdkOperate.release(cdk, update.effective_user.id)
         await update.effective_user.send_message("[Server]创建用户失败(服务器故障或已经存在相同用户)。\n"
                                                  "请稍后点击按钮重试。\n此次注册流程已经结束")
         return  ConversationHandler.END
-    cdk_info.limit -= 1
-    history = json.loads(cdk_info.used_history) if cdk_info.used_history else []
-    history.append({"tg_id": update.effective_user.id, "time": datetime.now().timestamp()})
-    cdk_info.used_history = json.dumps(history)
-    await CdkOperate.update_cdk(cdk_info)
     await update.effective_user.send_message("注册成功！")
     password_hash = get_password_hash(password)
-    user_info = await UsersOperate.get_user(update.effective_user.id)
-    if user_info:
-        user_info.account, user_info.password, user_info.bind_id = username, password_hash, emby_id
-        if user_info.role == Role.SEA.value:
-            user_info.role = Role.ORDINARY.value
-        await UsersOperate.update_user(user_info)
-    else:
-        user_info = UserModel(telegram_id=update.effective_user.id, username=update.effective_user.username,
-                              fullname=update.effective_user.full_name,
-                              account=username, password=password_hash, bind_id=emby_id,
-                              role=Role.ORDINARY.value)
-        await UsersOperate.add_user(user_info)
+    async with unit_of_work():
+        user_info = await UsersOperate.get_user(update.effective_user.id)
+        if user_info:
+            user_info.account, user_info.password, user_info.bind_id = username, password_hash, emby_id
+            if user_info.role == Role.SEA.value:
+                user_info.role = Role.ORDINARY.value
+            await UsersOperate.update_user(user_info)
+        else:
+            user_info = UserModel(telegram_id=update.effective_user.id, username=update.effective_user.username,
+                                  fullname=update.effective_user.full_name,
+                                  account=username, password=password_hash, bind_id=emby_id,
+                                  role=Role.ORDINARY.value)
+            await UsersOperate.add_user(user_info)
 
     return ConversationHandler.END
@@ -5,7 +5,7 @@ from telegram import Update, InlineQueryResultArticle, InputTextMessageContent,
 from telegram.ext import ContextTypes
 
 from src.bot import check_banned
-from src.database.cdk import CdkOperate
+from src.database.cdk import CdkOperate, CdkSignature, verify_cdk
 
 
 @check_banned
@@ -28,8 +28,9 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     if "cdk_" in query:
         split_result = query.split("\n", 1)
         cdk = split_result[0]
-        cdk_info = await CdkOperate.get_cdk(cdk.replace("cdk_", ""))
-        if not cdk_info:
+        code = cdk.replace("cdk_", "")
+        # 签名不匹配或签名中的过期时间已过的注册码无需查询数据库
+        if verify_cdk(code) in (CdkSignature.INVALID, CdkSignature.EXPIRED) or not await CdkOperate.get_cdk(code):
             await update.inline_query.answer(
                 [
                     InlineQueryResultArticle(
@@ -7,7 +7,7 @@ from httpx import HTTPError
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import ContextTypes
 
-from src.bot import check_admin, check_banned, check_private
+from src.bot import check_admin, check_banned, check_private, page_keyboard, parse_page
 from src.config import BotConfig
 from src.database.bangumi import BangumiOperate, BangumiRequireModel, ReqStatue
 from src.database.user import Role, UsersOperate
@@ -42,6 +42,9 @@ async def check_require(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return await update.message.reply_text("Usage: /check_require <require_id>")
     req_id = int(context.args[0])
     req_info = await BangumiOperate.get_req_bgm(req_id)
+    archived = req_info is None
+    if archived:
+        req_info = await BangumiOperate.get_archived_req_bgm(req_id)
     if not req_info:
         return await update.message.reply_text("请求ID不存在")
     if req_info.telegram_id != update.effective_user.id and user_info.role != Role.ADMIN.value:
@@ -54,7 +57,7 @@ async def check_require(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"集数: {other_info['total_episodes']}\n"
         f"Bgm链接: https://bgm.tv/subject/{req_info.bangumi_id}\n"
         f"当前状态: {str(ReqStatue(req_info.status)).replace('ReqStatue.', '')}")
-    if user_info.role == Role.ADMIN.value:
+    if user_info.role == Role.ADMIN.value and not archived:
         keyboard = [
             [InlineKeyboardButton("接受", callback_data=f'reqa_accepted_{req_info.id}'),
              InlineKeyboardButton("拒绝", callback_data=f'reqa_rejected_{req_info.id}'),
@@ -199,15 +202,24 @@ async def require_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # noinspection PyUnusedLocal
 @check_admin
 async def require_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    req_list = await BangumiOperate.get_all_handle_list()
+    rep_text, keyboard = await _render_require_page()
+    await update.message.reply_text(rep_text, parse_mode='HTML', reply_markup=keyboard)
+
+
+REQUIRE_PAGE_SIZE = 5
+
+
+async def _render_require_page(after: int = None, before: int = None) -> tuple[str, InlineKeyboardMarkup | None]:
+    req_list, has_prev, has_next = await BangumiOperate.page_handle_list(REQUIRE_PAGE_SIZE, after, before)
+    if not req_list:
+        return "没有待处理的请求", None
     rep_text = ""
-    for req in req_list:
+    for req, fullname, username in req_list:
         other_info = json.loads(str(req.other_info))
-        tg_info = await UsersOperate.get_user(req.telegram_id)
-        rep_text += (f"来自 <b>{tg_info.fullname}</b> 的请求:\n"
+        rep_text += (f"来自 <b>{fullname}</b> 的请求:\n"
                      f"请求ID: <code>{req.id}</code>\n"
-                     f"用户ID: <code>{tg_info.telegram_id}</code>\n"
-                     f"Username: @{tg_info.username if tg_info.username else "N/A"}\n"
+                     f"用户ID: <code>{req.telegram_id}</code>\n"
+                     f"Username: @{username if username else "N/A"}\n"
                      f"发起时间: {convert_to_china_timezone(req.timestamp)}\n"
                      f"<b>番剧名</b>: {other_info['name_cn']}\n"
                      f"<b>上映日期</b>: {other_info['date']}\n"
@@ -215,14 +227,12 @@ async def require_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
                      f"<b>Bgm链接</b>: https://bgm.tv/subject/{req.bangumi_id}\n"
                      f"当前状态: <b>{str(ReqStatue(req.status)).replace('ReqStatue.', '')}</b>\n"
                      f"============================\n")
-    while len(rep_text) > 4096:
-        part_text = rep_text[:4096]
-        last_newline_index = part_text.rfind('\n')
-        if last_newline_index != -1:
-            part_text = rep_text[:last_newline_index]
-        else:
-            part_text = rep_text[:4096]
-        await update.message.reply_text(part_text, parse_mode='HTML')
-        rep_text = rep_text[len(part_text):]
-    if rep_text:
-        await update.message.reply_text(rep_text, parse_mode='HTML')
+    return rep_text, page_keyboard("reqpage_", req_list[0][0].id, req_list[-1][0].id, has_prev, has_next)
+
+
+@check_admin
+async def require_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    rep_text, keyboard = await _render_require_page(**parse_page(query.data, "reqpage_"))
+    await query.answer()
+    await query.edit_message_text(rep_text, parse_mode='HTML', reply_markup=keyboard)
@@ -1,6 +1,6 @@
+import html
 import json
 import random
-import string
 from asyncio import sleep
 from datetime import datetime
 
@@ -8,16 +8,15 @@ import pytz
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove, Update
 from telegram.ext import ContextTypes
 
-import src.bot
-from src.bot import check_banned, check_private, command_warp
+from src.bot import check_banned, check_private, choose_user, command_warp, reply_codes
 from src.config import BotConfig, EmbyConfig, ProgramConfig
-from src.database.cdk import CdkModel, CdkOperate
-from src.database.score import RedPacketModel, ScoreModel, ScoreOperate
+from src.database import unit_of_work
+from src.database.cdk import CdkOperate, CdkSignature, verify_cdk
+from src.database.score import LedgerReason, RedPacketModel, ScoreOperate
 from src.database.user import Role, UserModel, UsersOperate
-from src.emby.api import EmbyAPI
 from src.logger import bot_logger
 from src.utils import convert_to_china_timezone, generate_red_packets, get_password_hash, get_user_info, \
-    is_password_strong, EmbyClient, check_server_connectivity, get_latest_commit_info, check_cdk
+    is_password_strong, EmbyClient, EmbyHealth, get_latest_commit_info
 
 
 # noinspection PyUnusedLocal
@@ -28,21 +27,22 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if user_info and user_info.bind_id:
                 return await update.message.reply_text("你已绑定一个Emby账号，无法注册。")
             ori_cdk = context.args[0].replace("cdk_", "")
-            cdk_info = await CdkOperate.get_cdk(ori_cdk)
-            if cdk_info:
-                if not check_cdk(cdk_info, update.effective_user.id):
-                    return await update.message.reply_text("注册码已经被抢光了")
-                cdk_info.limit -= 1
-                history = json.loads(cdk_info.used_history) if cdk_info.used_history else []
-                history.append({"tg_id": update.effective_user.id, "time": datetime.now().timestamp()})
-                cdk_info.used_history = json.dumps(history)
-                await CdkOperate.update_cdk(cdk_info)
-            else:
+            signature = verify_cdk(ori_cdk)
+            if signature == CdkSignature.EXPIRED:
+                return await update.message.reply_text("注册码已经过期")
+            cdk_info = None if signature == CdkSignature.INVALID else await CdkOperate.get_cdk(ori_cdk)
+            if not cdk_info:
                 return await update.message.reply_text("注册码无效")
+            if cdk_info.expired_time and cdk_info.expired_time < datetime.now().timestamp():
+                return await update.message.reply_text("注册码已经过期")
+            new_cdk = None
+            async with unit_of_work():
+                if await CdkOperate.redeem(ori_cdk, update.effective_user.id):
+                    expired_time = int(datetime.now().timestamp()) + 24 * 3600
+                    new_cdk, = await CdkOperate.bulk_add_cdk(1, expired_time=expired_time)
+            if new_cdk is None:
+                return await update.message.reply_text("注册码已经被抢光了")
 
-            new_cdk = f"reg_{''.join(random.choices(string.ascii_letters + string.digits, k=16))}_prej"
-            code_data = CdkModel(cdk=new_cdk, limit=1, expired_time=int(datetime.now().timestamp()) + 24 * 3600)
-            await CdkOperate.add_cdk(code_data)
             cb = "user_" + new_cdk
             button = InlineKeyboardMarkup([[InlineKeyboardButton(text="点此开始注册流程,请注意，您必须在24h内完成注册",
                                                                  callback_data=cb)]])
@@ -86,13 +86,17 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # noinspection PyUnusedLocal
 @check_banned
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    server = await check_server_connectivity()
     server_address = json.loads(EmbyConfig.ADDRESS)
     git_info = get_latest_commit_info()
     s_text = (("===========状态详情===========\n"
                "当前版本信息: " + git_info + "\n当前服务器状态: ") +
-              ("正常" if server else "异常") + "\n")
-    src.bot.server_close = not server
+              ("正常" if EmbyHealth.is_up() else "异常") + "\n")
+    if EmbyHealth.up and EmbyHealth.latency is not None:
+        s_text += f"延迟: {EmbyHealth.latency:.0f}ms\n"
+    if EmbyHealth.since:
+        s_text += f"状态持续自: {convert_to_china_timezone(EmbyHealth.since)}\n"
+    if (availability := EmbyHealth.availability()) is not None:
+        s_text += f"最近{len(EmbyHealth.history)}次检查可用率: {availability:.0%}\n"
     if not server_address:
         server_address = [{"address": EmbyConfig.BASE_URL, "description": "默认地址"}]
     for address in server_address:
@@ -112,18 +116,15 @@ async def gen_cdk(update: Update, context: ContextTypes.DEFAULT_TYPE):
     quantity = 1
     if len(context.args) == 1 and context.args[0].isdigit():
         quantity = int(context.args[0])
-    if quantity * BotConfig.USER_GEN_CDK_POINT > score_data.score:
+    # 扣除积分与生成注册码在同一事务内完成，生成失败时不扣除积分
+    code_list = None
+    async with unit_of_work():
+        if await ScoreOperate.debit(update.effective_user.id, quantity * BotConfig.USER_GEN_CDK_POINT,
+                                    LedgerReason.GEN_CDK) is not None:
+            code_list = await CdkOperate.bulk_add_cdk(quantity)
+    if code_list is None:
         return await update.message.reply_text(f"积分不足，当前积分: {score_data.score}")
-    code_list = []
-    for _ in range(quantity):
-        code = f"reg_{''.join(random.choices(string.ascii_letters + string.digits, k=16))}_prej"
-        code_data = CdkModel(cdk=code, limit=1, expired_time=0)
-        code_list.append(code)
-        await CdkOperate.add_cdk(code_data)
-    text = f"生成 {quantity} 个注册码\n\n" + "".join(f"{code}\n" for code in code_list)
-    score_data.score -= quantity * BotConfig.USER_GEN_CDK_POINT
-    await ScoreOperate.update_score(score_data)
-    await update.message.reply_text(text)
+    await reply_codes(update, f"生成 {quantity} 个注册码\n\n", code_list)
 
 
 @check_banned
@@ -149,35 +150,32 @@ async def reg(update: Update, context: ContextTypes.DEFAULT_TYPE):
         cdk_info = await CdkOperate.get_cdk(reg_code)
         if not cdk_info:
             return await update.message.reply_text("注册码不可用")
-        if not check_cdk(cdk_info, eff_user.id):
-            return "注册码无法使用（无效/已经过期/已使用）"
+        if not await CdkOperate.redeem(reg_code, eff_user.id):
+            return await update.message.reply_text("注册码无法使用（无效/已经过期/已使用）")
     try:
         ret_user = await EmbyClient.Users.new_user(username)
         await EmbyClient.Users.change_password(password, ret_user["Id"])
     except Exception as e:
         bot_logger.error(f"Error: {e}")
+        if cdk_info:
+            await CdkOperate.release(reg_code, eff_user.id)
         return await update.message.reply_text("[Server]创建用户失败(服务器故障或已经存在相同用户)。")
-    if cdk_info:
-        cdk_info.limit -= 1
-        history = json.loads(cdk_info.used_history) if cdk_info.used_history else []
-        history.append({"tg_id": eff_user.id, "time": datetime.now().timestamp()})
-        cdk_info.used_history = json.dumps(history)
-        await CdkOperate.update_cdk(cdk_info)
 
-    # 绑定 Telegram 和 Emby 账号
+    # 绑定 Telegram 和 Emby 账号 注册码已在创建用户前使用，这里只剩一次提交
 
     password_hash = get_password_hash(password)
-    if user_info:
-        user_info.account, user_info.password, user_info.bind_id = username, password_hash, ret_user[
-            "Id"]
-        if user_info.role == Role.SEA.value:
-            user_info.role = Role.ORDINARY.value
-        await UsersOperate.update_user(user_info)
-    else:
-        user_info = UserModel(telegram_id=eff_user.id, username=eff_user.username, fullname=eff_user.full_name,
-                              account=username, password=password_hash, bind_id=ret_user["Id"],
-                              role=Role.ORDINARY.value)
-        await UsersOperate.add_user(user_info)
+    async with unit_of_work():
+        if user_info:
+            user_info.account, user_info.password, user_info.bind_id = username, password_hash, ret_user[
+                "Id"]
+            if user_info.role == Role.SEA.value:
+                user_info.role = Role.ORDINARY.value
+            await UsersOperate.update_user(user_info)
+        else:
+            user_info = UserModel(telegram_id=eff_user.id, username=eff_user.username, fullname=eff_user.full_name,
+                                  account=username, password=password_hash, bind_id=ret_user["Id"],
+                                  role=Role.ORDINARY.value)
+            await UsersOperate.add_user(user_info)
     return await update.message.reply_text(f"注册成功，自动与Telegram绑定. 用户名: {username}")
 
 
@@ -241,21 +239,13 @@ async def delete_account(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def sign(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id == 136817688 :
         return await update.message.reply_text("Channel禁止此操作.")
-    score_info = await ScoreOperate.get_score(update.effective_user.id)
-    if not score_info:
-        score_info = ScoreModel(telegram_id=update.effective_user.id)
-        score_info = await ScoreOperate.add_score(score_info)
-        score_info.checkin_time = 0
     tz = pytz.timezone('Asia/Shanghai')
-    now = datetime.now(tz).date()
-    last_sign_date = datetime.fromtimestamp(score_info.checkin_time, tz).date()
-    if last_sign_date == now:
-        return await update.message.reply_text("今天已经签到过了。")
+    day_start = int(datetime.now(tz).replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
     points = random.randint(BotConfig.CHECKIN_POINT_MIN, BotConfig.CHECKIN_POINT_MAX)
-    score_info.score += points
-    score_info.checkin_time = int(datetime.now(tz).timestamp())
-    await ScoreOperate.update_score(score_info)
-    await update.message.reply_text(f"签到成功! 你获得了 {points} 积分。当前积分: {score_info.score}")
+    score = await ScoreOperate.checkin(update.effective_user.id, points, day_start, group_commit=True)
+    if score is None:
+        return await update.message.reply_text("今天已经签到过了。")
+    await update.message.reply_text(f"签到成功! 你获得了 {points} 积分。当前积分: {score}")
 
 
 @check_banned
@@ -265,9 +255,8 @@ async def bind(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) != 2:
         return await update.message.reply_text("使用方法: /bind 用户名 密码")
     username, password = context.args
-    user_client = EmbyAPI(EmbyConfig.BASE_URL, 2)
     try:
-        emby_user = await user_client.EmbyReq.login(username, password)
+        emby_user = await EmbyClient.Auth.authenticate(username, password)
     except Exception as e:
         bot_logger.error(f"Error: {e}")
         return await update.message.reply_text(f"[Server]Failed: {e}")
@@ -280,15 +269,16 @@ async def bind(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user_info:
         if user_info.bind_id:
             return await update.message.reply_text("你已绑定一个Emby账号。请先解绑")
-        user_info.account, user_info.password, user_info.bind_id = username, password_hash, emby_user["User"][
-            "Id"]
+        user_info.account, user_info.password, user_info.bind_id = username, password_hash, emby_user["Id"]
         if user_info.role == Role.SEA.value:
             user_info.role = Role.ORDINARY.value
-        await UsersOperate.update_user(user_info)
+        # 先提交再回复，写入失败时不会提示绑定成功
+        async with unit_of_work():
+            await UsersOperate.update_user(user_info)
         await update.message.reply_text(f"成功与Emby用户 {username} 绑定.")
     else:
         user_info = UserModel(telegram_id=eff_user.id, username=eff_user.username, fullname=eff_user.full_name,
-                              account=username, password=password_hash, bind_id=emby_user["User"]["Id"],
+                              account=username, password=password_hash, bind_id=emby_user["Id"],
                               role=Role.ORDINARY.value)
         await UsersOperate.add_user(user_info)
         await update.message.reply_text(f"成功与Emby用户 {username} 绑定.")
@@ -325,7 +315,8 @@ async def reset_pw(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         await EmbyClient.Users.change_password(new_password, user_info.bind_id)
         user_info.password = get_password_hash(new_password)
-        await UsersOperate.update_user(user_info)
+        async with unit_of_work():
+            await UsersOperate.update_user(user_info)
         return await update.message.reply_text("密码修改成功.")
     except Exception as e:
         bot_logger.error(f"Error: {e}")
@@ -367,18 +358,16 @@ async def red_packet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         return await update.message.reply_text("模式错误.")
     new_packet = RedPacketModel(telegram_id=update.effective_user.id, amount=total, count=count, type=mode,
-                                current_amount=total,
-                                create_time=int(datetime.now().timestamp()), data=json.dumps(red_data))
-    await ScoreOperate.add_red_packet(new_packet)
-    score_data.score -= total
-    await ScoreOperate.update_score(score_data)
+                                current_amount=total, create_time=int(datetime.now().timestamp()))
+    if await ScoreOperate.create_red_packet(new_packet, red_data) is None:
+        return await update.message.reply_text("积分不足.")
     keyboard = [[InlineKeyboardButton("点击领取红包", callback_data=f'red_{new_packet.id}')],
                 [InlineKeyboardButton("查看红包详情", callback_data=f'redinfo_{new_packet.id}'),
                  InlineKeyboardButton("撤回红包", callback_data=f'withdraw_{new_packet.id}')]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     if BotConfig.REDPACKET_IMG != "":
         if ProgramConfig.REDPACKET_FILEID:
-            await update.message.reply_photo(ProgramConfig.REDPACKET_FILEID,
+            msg = await update.message.reply_photo(ProgramConfig.REDPACKET_FILEID,
                                                    caption=f"用户{update.effective_user.full_name}发出了一个红包，总积分{total}, 数量{count}, 模式{mode}",
                                                    reply_markup=reply_markup)
         else:
@@ -388,9 +377,11 @@ async def red_packet(update: Update, context: ContextTypes.DEFAULT_TYPE):
                                                          reply_markup=reply_markup)
             ProgramConfig.REDPACKET_FILEID = msg.photo[-1].file_id
     else:
-        await update.message.reply_text(
+        msg = await update.message.reply_text(
             f"用户{update.effective_user.full_name}发出了一个红包，总积分{total}, 数量{count}, 模式{mode}",
             reply_markup=reply_markup)
+    # 过期时需要编辑这条消息
+    await ScoreOperate.set_red_packet_message(new_packet.id, msg.chat_id, msg.message_id)
 
 
 # noinspection PyShadowingNames
@@ -414,7 +405,8 @@ async def emby_reg(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_info.data = json.dumps(u_d)
         password_hash = get_password_hash(password)
         user_info.account, user_info.password, user_info.bind_id = username, password_hash, user_id
-        await UsersOperate.update_user(user_info)
+        async with unit_of_work():
+            await UsersOperate.update_user(user_info)
         return await update.message.reply_text(f"注册成功，自动与Telegram绑定. 用户名: {username}")
     except Exception as e:
         bot_logger.error(f"Error: {e}")
@@ -424,16 +416,15 @@ async def emby_reg(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # noinspection PyUnusedLocal
 @check_banned
 async def score_rank(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    rank_list = await ScoreOperate.rank()
+    rank_list = await ScoreOperate.leaderboard()
     text = "积分排行榜:\n"
-    for i, rank in enumerate(rank_list):
-        tg_id = rank.telegram_id
-        user_info = await UsersOperate.get_user(tg_id)
-        text += f"{i + 1}. {user_info.fullname} <b>{rank.score}</b>\n"
+    for i, (tg_id, fullname, score) in enumerate(rank_list):
+        text += f"{i + 1}. {html.escape(fullname or str(tg_id))} <b>{score}</b>\n"
     await update.message.reply_text(text, parse_mode="HTML")
 
 
 @check_banned
+@choose_user
 async def transfer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) == 1:
         if update.message.reply_to_message:
@@ -457,21 +448,11 @@ async def transfer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if target_info.telegram_id == 136817688 :
         return await update.message.reply_text("无法给Channel转账.")
     amount = int(amount)
-    score_data = await ScoreOperate.get_score(eff_user)
-    if not score_data or score_data.score < amount:
-        return await update.message.reply_text("积分不足.")
     target_user = await UsersOperate.get_user(target_info.telegram_id)
     if not target_user:
         return await update.message.reply_text("目标用户不存在.")
-    target_score = await ScoreOperate.get_score(target_user.telegram_id)
-    if not target_score:
-        target_score = ScoreModel(telegram_id=target_user.telegram_id, score=amount)
-        await ScoreOperate.add_score(target_score)
-    else:
-        target_score.score += amount
-        await ScoreOperate.update_score(target_score)
-    score_data.score -= amount
-    await ScoreOperate.update_score(score_data)
+    if await ScoreOperate.transfer(eff_user, target_user.telegram_id, amount) is None:
+        return await update.message.reply_text("积分不足.")
     username = target_user.fullname if target_user.fullname else target_user.telegram_id
     await update.message.reply_text(
         f'成功转账 {amount} 积分给 <a href="tg://user?id={target_user.telegram_id}">{username}</a>',
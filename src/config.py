@@ -61,10 +61,14 @@ class Config(BaseConfig):
     LOGGING: bool = True  # 是否开启日志输出本地
     LOG_LEVE: int = 20  # 日志等级
     SQLALCHEMY_LOG = False  # 是否开启SQLAlchemy日志
-    PROXY: str = None  # 代理
-    MAX_RETRY: int = 3  # 重试次数
+    PROXY: str = None  # 代理，用于 Telegram，以及未单独设置代理的 Emby/Bangumi 客户端
+    MAX_RETRY: int = 3  # 请求 Emby 失败时的重试次数
     DATABASES_DIR: Path = ROOT_PATH / 'database'  # 数据库路径
+    BACKUP_DIR: Path = None  # 数据库备份路径，为空时使用数据库路径下的 backup 目录
+    USER_CACHE_SIZE: int = 4096  # 用户缓存条目数，0 为关闭
+    USER_CACHE_TTL: int = 300  # 用户缓存过期秒数
     SALT = 'Emby'  # 加密盐
+    SIGNED_CDK: bool = False  # 是否生成带签名的注册码，签名使用 SALT（为空时不生效），无需查询数据库即可拒绝伪造或过期的注册码
     BANGUMI_TOKEN: str = ""  # Bangumi Token
 
 
@@ -107,9 +111,55 @@ class EmbyConfig(BaseConfig):
     BASE_URL: str = ""  # Emby URL
     API_KEY: str = ""  # Emby API Key
     ADDRESS: str = "[]"  # Emby地址 json数组
+    USER_DIRECTORY_REFRESH: int = 600  # 后台刷新 Emby 用户目录缓存的间隔（秒）
+    CIRCUIT_FAILURES: int = 5  # 连续失败多少次后熔断，熔断期间请求直接失败
+    CIRCUIT_RESET: int = 30  # 熔断多少秒后放行一个请求探测 Emby 是否恢复
+    HEALTH_INTERVAL: int = 60  # 后台检查服务器状态的间隔（秒）
+    HEALTH_DOWN_INTERVAL: int = 10  # 服务器异常时的检查间隔（秒）
+
+
+class DatabaseConfig(BaseConfig):
+    """
+    SQLite 连接调优 PROFILE 可选 durable/balanced/fast，其余项留空时使用预设的值
+    """
+    PROFILE: str = "balanced"  # 调优预设
+    SYNCHRONOUS: str = None  # OFF/NORMAL/FULL
+    CACHE_SIZE: int = None  # 每个数据库的页缓存，负数为 KiB
+    MMAP_SIZE: int = None  # 每个数据库的内存映射大小（字节）
+    TEMP_STORE: str = None  # DEFAULT/FILE/MEMORY
+    BUSY_TIMEOUT: int = None  # 等待写锁的毫秒数
+
+
+class SchedulerConfig(BaseConfig):
+    """
+    定时维护任务配置
+    """
+    ENABLE: bool = True  # 是否启用定时任务
+    CLEAN_INTERVAL: int = 3600  # 清理注册码与红包的间隔（秒）
+    OPTIMIZE_INTERVAL: int = 86400  # 数据库维护（回收空间、ANALYZE）的间隔（秒）
+    CDK_RETENTION_DAYS: int = 7  # 过期或用完的注册码保留天数
+    RED_PACKET_TTL: int = 86400  # 红包有效秒数，过期后返还剩余积分，0 为不过期
+    ARCHIVE_AFTER_DAYS: int = 30  # 已结束的红包与番剧请求在多少天后移入归档，0 为不归档
+    BACKUP_INTERVAL: int = 86400  # 自动备份数据库的间隔（秒），0 为不自动备份
+    BACKUP_KEEP: int = 7  # 保留的备份数量
+
+
+class HttpConfig(BaseConfig):
+    """
+    Emby 与 Bangumi 客户端共用的 HTTP 连接池配置
+    """
+    MAX_CONNECTIONS: int = 100  # 最大连接数
+    MAX_KEEPALIVE_CONNECTIONS: int = 20  # 最多保持的空闲连接数
+    KEEPALIVE_EXPIRY: float = 30.0  # 空闲连接保持秒数
+    HTTP2: bool = True  # 服务器支持时使用 HTTP/2，需要安装 httpx[http2]
+    EMBY_PROXY: str = ""  # Emby 使用的代理，留空使用全局 PROXY，direct 为不使用代理
+    BANGUMI_PROXY: str = ""  # Bangumi 使用的代理，同上
 
 
 Config.update_from_toml()
 BotConfig.update_from_toml('Bot')
 EmbyConfig.update_from_toml('Emby')
 FlaskConfig.update_from_toml('Flask')
+DatabaseConfig.update_from_toml('Database')
+SchedulerConfig.update_from_toml('Scheduler')
+HttpConfig.update_from_toml('Http')
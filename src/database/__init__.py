@@ -1,15 +1,327 @@
+import asyncio
 import os
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Sequence
 
-from sqlalchemy import create_engine, text
+from sqlalchemy import Connection, ColumnElement, Select, event, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 
-from src.config import Config
+from src.config import Config, DatabaseConfig
 
+MAIN_DATABASE = "users"  # 主库，其余数据库通过 ATTACH 挂载
+ATTACHED_DATABASES = ("score", "cdk", "bangumi", "archive")  # 挂载的数据库，schema 名与文件名一致
 
-def create_database(database_name: str, model):
-    os.makedirs(Config.DATABASES_DIR, exist_ok=True)
-    database_url = f"sqlite:///{os.path.join(Config.DATABASES_DIR, f'{database_name}.db')}"
-    engine = create_engine(database_url)
-    model.metadata.create_all(engine)
-    connection = engine.connect()
-    connection.execute(text('PRAGMA journal_mode = WAL'))
-    connection.close()
+
+def database_path(database_name: str) -> str:
+    return os.path.join(Config.DATABASES_DIR, f'{database_name}.db')
+
+
+# 连接调优预设 synchronous/cache_size/mmap_size 作用于每个数据库，temp_store/busy_timeout 作用于连接
+PRAGMA_PROFILES = {
+    "durable": {"synchronous": "FULL", "cache_size": -8000, "mmap_size": 0, "temp_store": "DEFAULT",
+                "busy_timeout": 10000},
+    "balanced": {"synchronous": "NORMAL", "cache_size": -32000, "mmap_size": 64 * 1024 * 1024,
+                 "temp_store": "MEMORY", "busy_timeout": 5000},
+    "fast": {"synchronous": "OFF", "cache_size": -64000, "mmap_size": 256 * 1024 * 1024, "temp_store": "MEMORY",
+             "busy_timeout": 5000},
+}
+_PRAGMA_CHOICES = {"synchronous": ("OFF", "NORMAL", "FULL", "EXTRA"), "temp_store": ("DEFAULT", "FILE", "MEMORY")}
+
+
+def resolve_pragmas(profile: str | None = None) -> dict:
+    """
+    根据 DatabaseConfig 计算最终的 PRAGMA 设置
+    :param profile: 预设名，默认使用配置中的预设
+    :return: PRAGMA 名 -> 值
+    """
+    profile = (profile or DatabaseConfig.PROFILE).lower()
+    if profile not in PRAGMA_PROFILES:
+        raise ValueError(f"Unknown database profile: {profile}, expected one of {', '.join(PRAGMA_PROFILES)}")
+    pragmas = dict(PRAGMA_PROFILES[profile])
+    for key in pragmas:
+        value = getattr(DatabaseConfig, key.upper())
+        if value is not None:
+            pragmas[key] = value
+    for key, value in pragmas.items():
+        if key in _PRAGMA_CHOICES:
+            pragmas[key] = str(value).upper()
+            if pragmas[key] not in _PRAGMA_CHOICES[key]:
+                raise ValueError(f"Invalid database {key}: {value}")
+        else:
+            pragmas[key] = int(value)
+    return pragmas
+
+
+_pragmas = resolve_pragmas()
+
+
+def _attach_databases(dbapi_connection, _connection_record):
+    """
+    每个新连接都挂载全部数据库并应用调优设置，使跨模块操作可以共用一个连接与事务
+    注意：WAL 模式下跨文件提交只保证单个文件内的原子性
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {_pragmas['busy_timeout']}")
+    cursor.execute(f"PRAGMA temp_store = {_pragmas['temp_store']}")
+    for name in ATTACHED_DATABASES:
+        cursor.execute(f"ATTACH DATABASE ? AS {name}", (database_path(name),))
+    for name in ("main",) + ATTACHED_DATABASES:
+        for key in ("synchronous", "cache_size", "mmap_size"):
+            cursor.execute(f"PRAGMA {name}.{key} = {_pragmas[key]}")
+    cursor.close()
+
+
+# 引擎在首次连接时才会打开数据库文件，导入本模块没有 IO
+ENGINE = create_async_engine(f"sqlite+aiosqlite:///{database_path(MAIN_DATABASE)}", echo=Config.SQLALCHEMY_LOG)
+event.listen(ENGINE.sync_engine, "connect", _attach_databases)
+SessionFactory = async_sessionmaker(bind=ENGINE, expire_on_commit=False)
+_unit_of_work: ContextVar[AsyncSession | None] = ContextVar("unit_of_work", default=None)
+
+
+def _run_on_commit(session: AsyncSession):
+    for callback in session.info.pop("on_commit", ()):
+        callback()
+
+
+def on_commit(session: AsyncSession, callback: Callable[[], None]):
+    """
+    注册提交成功后执行的回调，例如更新缓存；回滚时不会执行
+    :param session: 当前会话
+    :param callback: 回调
+    """
+    session.info.setdefault("on_commit", []).append(callback)
+
+
+class MaintenanceGate:
+    """
+    维护（如恢复备份）期间暂停新的会话，并等待进行中的会话结束
+    会话内再开启的独立会话不受影响，避免等待自身
+    """
+
+    def __init__(self):
+        self._open = asyncio.Event()
+        self._open.set()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._active = 0
+        self._lock = asyncio.Lock()
+        self._inside: ContextVar[bool] = ContextVar("inside_session", default=False)
+
+    @property
+    def active(self) -> bool:
+        """是否正在维护"""
+        return not self._open.is_set()
+
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator[None]:
+        if self._inside.get():
+            yield
+            return
+        while not self._open.is_set():
+            await self._open.wait()
+        self._active += 1
+        self._idle.clear()
+        token = self._inside.set(True)
+        try:
+            yield
+        finally:
+            self._inside.reset(token)
+            self._active -= 1
+            if not self._active:
+                self._idle.set()
+
+    @asynccontextmanager
+    async def closed(self) -> AsyncIterator[None]:
+        """关闭入口并等待进行中的会话结束，退出时重新开放"""
+        async with self._lock:
+            self._open.clear()
+            try:
+                await self._idle.wait()
+                yield
+            finally:
+                self._open.set()
+
+
+Maintenance = MaintenanceGate()
+
+
+@asynccontextmanager
+async def session_scope() -> AsyncIterator[AsyncSession]:
+    """
+    获取带事务的会话：处于 unit_of_work 内时加入其事务，否则单独开启一个事务并在结束时提交
+    维护期间等待维护结束后再开启
+    """
+    session = _unit_of_work.get()
+    if session is not None:
+        yield session
+        return
+    async with Maintenance.session(), SessionFactory() as session:
+        async with session.begin():
+            yield session
+        _run_on_commit(session)
+
+
+@asynccontextmanager
+async def unit_of_work() -> AsyncIterator[AsyncSession]:
+    """
+    将其中的多次 Operate 调用合并为一个事务，结束时只提交一次，出现异常时全部回滚
+    嵌套调用时加入外层事务
+    注意不要在其中等待网络请求等耗时操作，事务期间会一直持有数据库写锁
+    """
+    async with session_scope() as session:
+        token = _unit_of_work.set(session)
+        try:
+            yield session
+        finally:
+            _unit_of_work.reset(token)
+
+
+def in_unit_of_work() -> bool:
+    """当前是否处于 unit_of_work 内"""
+    return _unit_of_work.get() is not None
+
+
+_databases: list[tuple[type, Sequence[Callable[[Connection], None]]]] = []
+_init_lock = asyncio.Lock()
+_initialized = False
+
+
+def create_database(model, migrations: Sequence[Callable[[Connection], None]] = ()):
+    """
+    登记数据库模型与迁移，实际的建表与迁移在 init_database 中执行
+    :param model: 数据库模型基类
+    :param migrations: 按顺序执行的迁移函数
+    """
+    _databases.append((model, tuple(migrations)))
+
+
+def index_migration(*models) -> Callable[[Connection], None]:
+    """
+    生成为已有数据表补建索引的迁移，新建的数据表由 create_all 直接创建索引
+    唯一索引不在此补建：已有数据可能重复，需要由专门的迁移先去重再创建
+    :param models: 数据库模型
+    """
+    def migration(connection: Connection):
+        for model in models:
+            for index in model.__table__.indexes:
+                if not index.unique:
+                    index.create(connection, checkfirst=True)
+
+    return migration
+
+
+def _create_schema(connection: Connection, model, migrations: Sequence[Callable[[Connection], None]]):
+    """
+    创建数据表并执行尚未执行的迁移
+    已执行的迁移数量记录在对应数据库的 user_version 中
+    """
+    schema = model.metadata.schema or "main"
+    model.metadata.create_all(connection)
+    version = connection.execute(text(f"PRAGMA {schema}.user_version")).scalar()
+    for migration in migrations[version:]:
+        migration(connection)
+    if version < len(migrations):
+        connection.execute(text(f"PRAGMA {schema}.user_version = {len(migrations)}"))
+
+
+async def init_database(force: bool = False):
+    """
+    初始化数据库：开启 WAL，并行创建各数据库的数据表并执行迁移
+    只会执行一次，需要在使用任何 Operate 之前调用
+    :param force: 再次执行建表与迁移，用于恢复备份之后
+    """
+    global _initialized
+    async with _init_lock:
+        if _initialized and not force:
+            return
+        os.makedirs(Config.DATABASES_DIR, exist_ok=True)
+        async with ENGINE.connect() as connection:
+            # WAL 会持久化在数据库文件中，只需设置一次；auto_vacuum 只对尚未建表的新数据库生效
+            for name in ("main",) + ATTACHED_DATABASES:
+                await connection.exec_driver_sql(f"PRAGMA {name}.auto_vacuum = INCREMENTAL")
+                await connection.exec_driver_sql(f"PRAGMA {name}.journal_mode = WAL")
+
+        async def create(model, migrations):
+            async with ENGINE.begin() as connection:
+                await connection.run_sync(_create_schema, model, migrations)
+
+        # 各数据库是独立的文件，建表互不阻塞
+        await asyncio.gather(*(create(model, migrations) for model, migrations in _databases))
+        _initialized = True
+
+
+async def pending_vacuum() -> list[str]:
+    """尚未开启增量回收的数据库，需要执行一次 vacuum_database 切换模式"""
+    async with Maintenance.session(), ENGINE.connect() as connection:
+        return [name for name in ("main",) + ATTACHED_DATABASES
+                if (await connection.exec_driver_sql(f"PRAGMA {name}.auto_vacuum")).scalar() != 2]
+
+
+async def optimize_database() -> dict[str, int]:
+    """
+    数据库维护：回收空闲页、ANALYZE 并执行 PRAGMA optimize
+    未开启增量回收的旧数据库不回收空闲页，需要管理员执行 vacuum_database
+    :return: 各数据库回收的页数
+    """
+    freed = {}
+    # 与会话一样经过维护入口，恢复备份时等待正在进行的维护结束，恢复期间开始的维护等待恢复结束
+    async with Maintenance.session(), ENGINE.connect() as connection:
+        for name in ("main",) + ATTACHED_DATABASES:
+            if (await connection.exec_driver_sql(f"PRAGMA {name}.auto_vacuum")).scalar() == 2:
+                before = (await connection.exec_driver_sql(f"PRAGMA {name}.freelist_count")).scalar()
+                # sqlite3 的 execute 只会执行一步（回收一页），executescript 会执行到结束
+                raw = await connection.get_raw_connection()
+                await raw.driver_connection.executescript(f"PRAGMA {name}.incremental_vacuum")
+                after = (await connection.exec_driver_sql(f"PRAGMA {name}.freelist_count")).scalar()
+                freed[name] = before - after
+            await connection.exec_driver_sql(f"ANALYZE {name}")
+            await connection.exec_driver_sql(f"PRAGMA {name}.optimize")
+            await connection.commit()
+    return freed
+
+
+async def vacuum_database() -> dict[str, int]:
+    """
+    对尚未开启增量回收的数据库执行一次完整的 VACUUM 切换为增量回收
+    VACUUM 会重写整个数据库文件，期间关闭维护入口，所有数据库会话等待其结束，只应由管理员手动执行
+    :return: 各数据库减少的页数
+    """
+    shrunk = {}
+    names = await pending_vacuum()
+    async with Maintenance.closed():
+        async with ENGINE.connect() as connection:
+            for name in names:
+                before = (await connection.exec_driver_sql(f"PRAGMA {name}.page_count")).scalar()
+                await connection.exec_driver_sql(f"PRAGMA {name}.auto_vacuum = INCREMENTAL")
+                await connection.exec_driver_sql(f"VACUUM {name}")
+                shrunk[name] = before - (await connection.exec_driver_sql(f"PRAGMA {name}.page_count")).scalar()
+        # 连接池中的其他连接仍然缓存着旧的 auto_vacuum 设置
+        await ENGINE.dispose()
+    return shrunk
+
+
+async def paginate(stmt: Select, key: ColumnElement, size: int, after=None, before=None) -> tuple[list, bool, bool]:
+    """
+    按 key 列进行键集分页，每页只需一次走索引的查询，与页码无关
+    :param stmt: 已经带有过滤条件的查询
+    :param key: 唯一且有索引的排序列
+    :param size: 每页数量
+    :param after: 返回 key 大于该值的一页
+    :param before: 返回 key 小于该值的一页
+    :return: (本页数据, 是否有上一页, 是否有下一页)
+    """
+    if before is not None:
+        stmt = stmt.filter(key < before).order_by(key.desc())
+    else:
+        if after is not None:
+            stmt = stmt.filter(key > after)
+        stmt = stmt.order_by(key)
+    async with session_scope() as session:
+        rows = list((await session.execute(stmt.limit(size + 1))).all())
+    more = len(rows) > size
+    rows = rows[:size]
+    if before is not None:
+        rows.reverse()
+        return rows, more, True
+    return rows, after is not None, more
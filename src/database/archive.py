@@ -0,0 +1,99 @@
+import json
+import zlib
+from datetime import datetime
+from enum import Enum
+from typing import Sequence
+
+from sqlalchemy import Index, LargeBinary, MetaData, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncAttrs, AsyncSession
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
+
+from src.database import create_database, session_scope
+
+
+class ArchiveKind(Enum):
+    """归档数据类型"""
+    RED_PACKET = "red_packet"  # 查询键为发送者 Telegram ID
+    REQUIRE = "require"  # 查询键为番剧 ID
+    CDK = "cdk"  # 查询键为注册码
+
+
+class ArchiveDatabaseModel(AsyncAttrs, DeclarativeBase):
+    metadata = MetaData(schema="archive")
+
+
+class ArchiveModel(ArchiveDatabaseModel):
+    """已归档的行 内容为压缩后的 json"""
+    __tablename__ = 'archive'
+    __table_args__ = (Index('ix_archive_kind_source_id', 'kind', 'source_id', unique=True),
+                      Index('ix_archive_kind_key', 'kind', 'key'))
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    kind: Mapped[str] = mapped_column(nullable=False)  # 数据类型 ArchiveKind
+    source_id: Mapped[int] = mapped_column(nullable=False)  # 原表中的 ID
+    key: Mapped[str] = mapped_column(nullable=True)  # 查询键
+    archived_at: Mapped[int] = mapped_column(nullable=False)  # 归档时间
+    payload: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)  # zlib 压缩的 json
+
+
+create_database(ArchiveDatabaseModel, [])
+
+
+def row_dict(row) -> dict:
+    """将模型对象转为可归档的字典"""
+    return {column.key: getattr(row, column.key) for column in row.__table__.columns}
+
+
+async def archive_rows(session: AsyncSession, kind: ArchiveKind, rows: Sequence[tuple[int, str | None, dict]]):
+    """
+    在调用者的事务内写入归档 调用者随后删除原表中的行
+    :param session: 会话
+    :param kind: 数据类型
+    :param rows: [(原表 ID, 查询键, 内容)]
+    """
+    if not rows:
+        return
+    now = int(datetime.now().timestamp())
+    await session.execute(sqlite_insert(ArchiveModel).on_conflict_do_nothing(), [
+        {"kind": kind.value, "source_id": source_id, "key": key, "archived_at": now,
+         "payload": zlib.compress(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode())}
+        for source_id, key, data in rows])
+
+
+class ArchiveOperate:
+    @staticmethod
+    async def get_archive(kind: ArchiveKind, source_id: int) -> dict | None:
+        """
+        按原表 ID 读取归档
+        :param kind: 数据类型
+        :param source_id: 原表中的 ID
+        """
+        async with session_scope() as session:
+            payload = (await session.execute(select(ArchiveModel.payload).filter(
+                    ArchiveModel.kind == kind.value, ArchiveModel.source_id == source_id))).scalar_one_or_none()
+        return json.loads(zlib.decompress(payload)) if payload is not None else None
+
+    @staticmethod
+    async def find_archive(kind: ArchiveKind, key: str, limit: int = 5) -> list[dict]:
+        """
+        按查询键读取最近归档的数据
+        :param kind: 数据类型
+        :param key: 查询键
+        :param limit: 最多返回的数量
+        """
+        async with session_scope() as session:
+            payloads = (await session.execute(select(ArchiveModel.payload).filter(
+                    ArchiveModel.kind == kind.value, ArchiveModel.key == key
+            ).order_by(ArchiveModel.id.desc()).limit(limit))).scalars().all()
+        return [json.loads(zlib.decompress(payload)) for payload in payloads]
+
+    @staticmethod
+    async def stats() -> dict[str, tuple[int, int]]:
+        """
+        各类型的归档数量与压缩后的大小
+        :return: {类型: (数量, 字节数)}
+        """
+        async with session_scope() as session:
+            rows = await session.execute(select(ArchiveModel.kind, func.count(), func.sum(func.length(
+                    ArchiveModel.payload))).group_by(ArchiveModel.kind))
+            return {kind: (count, size or 0) for kind, count, size in rows}
@@ -0,0 +1,229 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+from src.config import Config, SchedulerConfig
+from src.database import ATTACHED_DATABASES, ENGINE, MAIN_DATABASE, Maintenance, database_path, init_database, \
+    resolve_pragmas
+from src.database.cdk import KnownCdks
+from src.database.score import ScoreLeaderboard
+from src.database.user import UserCache
+
+DATABASE_FILES = (MAIN_DATABASE,) + ATTACHED_DATABASES
+_CHUNK = 1 << 20
+
+
+class BackupError(Exception):
+    """备份不存在或校验失败"""
+
+
+def _schema(name: str) -> str:
+    return "main" if name == MAIN_DATABASE else name
+
+
+def _connect(path: str, isolation_level: str | None = "") -> sqlite3.Connection:
+    connection = sqlite3.connect(path, isolation_level=isolation_level)
+    connection.execute(f"PRAGMA busy_timeout = {resolve_pragmas()['busy_timeout']}")
+    return connection
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(_CHUNK):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _compress(raw: Path, target: Path) -> dict:
+    """压缩单个数据库文件，返回 manifest 中的记录"""
+    digest = hashlib.sha256()
+    with open(raw, "rb") as f, gzip.open(target, "wb", compresslevel=6) as out:
+        while chunk := f.read(_CHUNK):
+            digest.update(chunk)
+            out.write(chunk)
+    return {"file": target.name, "size": raw.stat().st_size, "sha256": digest.hexdigest(),
+            "gz_sha256": _sha256(target)}
+
+
+def backup_dir() -> Path:
+    """备份目录 默认放在数据库目录下，Docker 部署时与数据库在同一个卷中"""
+    return Path(Config.BACKUP_DIR or Path(Config.DATABASES_DIR) / "backup")
+
+
+def _reserve(base: str) -> tuple[str, Path]:
+    """
+    创建临时目录占用备份名 同一秒内已有备份时依次加上 -01、-02 等后缀，保持按名称排序即按时间排序
+    :return: (备份名, 临时目录)
+    """
+    backup_dir().mkdir(parents=True, exist_ok=True)
+    for suffix in range(100):
+        name = f"{base}-{suffix:02d}" if suffix else base
+        partial = backup_dir() / f".{name}.partial"
+        if (backup_dir() / name).exists():
+            continue
+        try:
+            partial.mkdir()
+        except FileExistsError:
+            continue
+        return name, partial
+    raise BackupError(f"Too many backups named {base}")
+
+
+def _backup() -> Path:
+    """
+    在同一个读事务内用 backup API 复制全部数据库，各文件是同一时刻的快照
+    WAL 模式下读事务不阻塞写入
+    """
+    now = datetime.now()
+    name, partial = _reserve(now.strftime("%Y%m%d-%H%M%S"))
+    source = _connect(database_path(MAIN_DATABASE), isolation_level=None)
+    try:
+        for schema in ATTACHED_DATABASES:
+            source.execute(f"ATTACH DATABASE ? AS {schema}", (database_path(schema),))
+        source.execute("BEGIN")
+        # 在每个数据库上读取一次以固定快照
+        versions = {}
+        for db in DATABASE_FILES:
+            source.execute(f"SELECT count(*) FROM {_schema(db)}.sqlite_master").fetchone()
+            versions[db] = source.execute(f"PRAGMA {_schema(db)}.user_version").fetchone()[0]
+        for db in DATABASE_FILES:
+            target = sqlite3.connect(partial / f"{db}.db")
+            try:
+                source.backup(target, name=_schema(db))
+            finally:
+                target.close()
+        source.execute("COMMIT")
+    finally:
+        source.close()
+    databases = {}
+    for db in DATABASE_FILES:
+        raw = partial / f"{db}.db"
+        databases[db] = _compress(raw, partial / f"{db}.db.gz") | {"user_version": versions[db]}
+        raw.unlink()
+    with open(partial / "manifest.json", "w") as f:
+        json.dump({"created_at": now.isoformat(timespec="seconds"), "databases": databases}, f, indent=2)
+    final = backup_dir() / name
+    partial.rename(final)
+    return final
+
+
+def _prune(keep: int):
+    for path in list_backups()[keep:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def list_backups() -> list[Path]:
+    """已完成的备份，最新的在前"""
+    if not backup_dir().is_dir():
+        return []
+    return sorted((path for path in backup_dir().iterdir() if (path / "manifest.json").is_file()), reverse=True)
+
+
+def _verify(path: Path, extract_to: Path | None = None) -> dict:
+    """
+    校验压缩文件与解压后内容的 sha256，可同时解压到 extract_to
+    :return: manifest
+    """
+    try:
+        with open(path / "manifest.json") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        raise BackupError(f"Invalid backup {path.name}: {e}")
+    for db, info in manifest["databases"].items():
+        compressed = path / info["file"]
+        if not compressed.is_file() or _sha256(compressed) != info["gz_sha256"]:
+            raise BackupError(f"Checksum mismatch: {info['file']}")
+        digest = hashlib.sha256()
+        out = open(extract_to / f"{db}.db", "wb") if extract_to else None
+        try:
+            with gzip.open(compressed, "rb") as f:
+                while chunk := f.read(_CHUNK):
+                    digest.update(chunk)
+                    if out:
+                        out.write(chunk)
+        finally:
+            if out:
+                out.close()
+        if digest.hexdigest() != info["sha256"]:
+            raise BackupError(f"Checksum mismatch: {db}.db")
+    return manifest
+
+
+def _restore(path: Path):
+    """
+    校验并检查完整性后，用 backup API 写回数据库 调用前需暂停其他会话，多个数据库之间不是原子写回
+    """
+    with tempfile.TemporaryDirectory(dir=backup_dir()) as tmp:
+        manifest = _verify(path, Path(tmp))
+        for db in manifest["databases"]:
+            check = sqlite3.connect(Path(tmp) / f"{db}.db")
+            try:
+                result = check.execute("PRAGMA integrity_check").fetchone()[0]
+            finally:
+                check.close()
+            if result != "ok":
+                raise BackupError(f"Integrity check failed: {db}.db: {result}")
+        for db in manifest["databases"]:
+            source = sqlite3.connect(Path(tmp) / f"{db}.db")
+            target = _connect(database_path(db))
+            try:
+                source.backup(target)
+            finally:
+                source.close()
+                target.close()
+
+
+async def backup_databases() -> Path:
+    """
+    在线备份全部数据库，并只保留最近 BACKUP_KEEP 份 恢复备份期间等待恢复结束
+    :return: 备份目录
+    """
+    async with Maintenance.session():
+        path = await asyncio.to_thread(_backup)
+        await asyncio.to_thread(_prune, SchedulerConfig.BACKUP_KEEP)
+    return path
+
+
+async def verify_backup(name: str) -> dict:
+    """
+    校验备份
+    :param name: 备份名
+    :return: manifest
+    """
+    return await asyncio.to_thread(_verify, _backup_path(name))
+
+
+async def restore_databases(name: str) -> Path:
+    """
+    恢复备份 恢复期间暂停新的数据库会话并关闭连接池，恢复前会先备份当前数据；恢复后重新执行迁移并清空内存中的缓存
+    定时任务需要由调用方暂停
+    :param name: 备份名
+    :return: 恢复前自动创建的备份目录
+    """
+    path = _backup_path(name)
+    await asyncio.to_thread(_verify, path)
+    async with Maintenance.closed():
+        await ENGINE.dispose()
+        current = await asyncio.to_thread(_backup)
+        await asyncio.to_thread(_restore, path)
+        await init_database(force=True)
+        UserCache.clear()
+        ScoreLeaderboard.invalidate()
+        KnownCdks.unload()
+    await KnownCdks.load()
+    return current
+
+
+def _backup_path(name: str) -> Path:
+    path = backup_dir() / name
+    if os.sep in name or name.startswith(".") or not (path / "manifest.json").is_file():
+        raise BackupError(f"Backup not found: {name}")
+    return path
@@ -1,12 +1,12 @@
 from enum import Enum
-from typing import Sequence
 
-from sqlalchemy import or_, select
-from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
+from sqlalchemy import Index, MetaData, delete, literal_column, select
+from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
-from src.config import Config
-from src.database import create_database
+from src.database import SessionFactory, create_database, index_migration, paginate, session_scope
+from src.database.archive import ArchiveKind, ArchiveOperate, archive_rows, row_dict
+from src.database.user import UserModel
 
 
 class ReqStatue(Enum):
@@ -18,7 +18,7 @@ class ReqStatue(Enum):
 
 
 class BangumiDatabaseModel(AsyncAttrs, DeclarativeBase):
-    pass
+    metadata = MetaData(schema="bangumi")
 
 
 class BangumiUserModel(BangumiDatabaseModel):
@@ -41,49 +41,85 @@ class BangumiRequireModel(BangumiDatabaseModel):
     other_info: Mapped[str] = mapped_column(nullable=True)  # 预留的其他信息
 
 
-create_database("bangumi", BangumiDatabaseModel)
-DATABASE_URL = f'sqlite+aiosqlite:///{Config.DATABASES_DIR / "bangumi.db"}'
-ENGINE = create_async_engine(DATABASE_URL, echo=Config.SQLALCHEMY_LOG)
-BangumiSessionFactory = async_sessionmaker(bind=ENGINE, expire_on_commit=False)
+# 待处理的请求 IN 中必须是字面量，SQLite 才会使用该部分索引
+_pending_require = BangumiRequireModel.status.in_([literal_column(str(ReqStatue.UNHANDLED.value)),
+                                                   literal_column(str(ReqStatue.ACCEPTED.value))])
+Index('ix_require_pending', BangumiRequireModel.id, sqlite_where=_pending_require)
+create_database(BangumiDatabaseModel, [index_migration(BangumiRequireModel)])
+BangumiSessionFactory = SessionFactory
 
 
 class BangumiOperate:
     @staticmethod
     async def add_req_bgm(data: BangumiRequireModel) -> None:
-        async with BangumiSessionFactory() as session:
-            async with session.begin():
-                session.add(data)
+        async with session_scope() as session:
+            session.add(data)
     
     @staticmethod
     async def get_req_bgm(req_id: int) -> BangumiRequireModel | None:
-        async with BangumiSessionFactory() as session:
-            async with session.begin():
-                scalar = await session.execute(select(BangumiRequireModel).filter(BangumiRequireModel.id == req_id).limit(1))
-                return scalar.scalar_one_or_none()
+        async with session_scope() as session:
+            scalar = await session.execute(select(BangumiRequireModel).filter(BangumiRequireModel.id == req_id).limit(1))
+            return scalar.scalar_one_or_none()
     
     @staticmethod
     async def update_req_bgm(data: BangumiRequireModel):
-        async with BangumiSessionFactory() as session:
-            async with session.begin():
-                await session.merge(data)
+        async with session_scope() as session:
+            await session.merge(data)
+    
+    @staticmethod
+    async def get_archived_req_bgm(req_id: int) -> BangumiRequireModel | None:
+        """
+        读取已归档的请求 返回的对象只用于展示
+        :param req_id: 请求ID
+        """
+        data = await ArchiveOperate.get_archive(ArchiveKind.REQUIRE, req_id)
+        return BangumiRequireModel(**data) if data else None
     
     @staticmethod
     async def is_bgm_exist(bgm_id: int) -> BangumiRequireModel | None:
-        async with BangumiSessionFactory() as session:
-            async with session.begin():
-                scalar = await session.execute(select(BangumiRequireModel).filter(BangumiRequireModel.bangumi_id == bgm_id).limit(1))
-                return scalar.scalar_one_or_none()
+        async with session_scope() as session:
+            scalar = await session.execute(select(BangumiRequireModel).filter(BangumiRequireModel.bangumi_id == bgm_id).limit(1))
+            if req := scalar.scalar_one_or_none():
+                return req
+        archived = await ArchiveOperate.find_archive(ArchiveKind.REQUIRE, str(bgm_id), limit=1)
+        return BangumiRequireModel(**archived[0]) if archived else None
+    
+    @staticmethod
+    async def archive_requires(before: int, batch_size: int = 500) -> int:
+        """
+        将 before 之前发起且已经完成或被拒绝的请求移入归档
+        :param before: 时间戳
+        :param batch_size: 每个事务处理的请求数量
+        :return: 归档的请求数量
+        """
+        finished = select(BangumiRequireModel).where(
+                BangumiRequireModel.status.in_([ReqStatue.REJECTED.value, ReqStatue.COMPLETED.value]),
+                BangumiRequireModel.timestamp < before).limit(batch_size)
+        total = 0
+        while True:
+            async with session_scope() as session:
+                requires = (await session.execute(finished)).scalars().all()
+                if not requires:
+                    break
+                await archive_rows(session, ArchiveKind.REQUIRE,
+                                   [(req.id, str(req.bangumi_id), row_dict(req)) for req in requires])
+                await session.execute(delete(BangumiRequireModel).where(
+                        BangumiRequireModel.id.in_([req.id for req in requires])))
+            total += len(requires)
+        return total
     
     @staticmethod
-    async def get_all_handle_list() -> Sequence[BangumiRequireModel]:
-        async with BangumiSessionFactory() as session:
-            async with session.begin():
-                scalar = await session.execute(
-                        select(BangumiRequireModel).filter(
-                                or_(
-                                        BangumiRequireModel.status == ReqStatue.UNHANDLED.value,
-                                        BangumiRequireModel.status == ReqStatue.ACCEPTED.value
-                                )
-                        )
-                )
-                return scalar.scalars().all()
+    async def page_handle_list(size: int, after: int = None,
+                               before: int = None) -> tuple[list[tuple[BangumiRequireModel, str | None, str | None]],
+                                                            bool, bool]:
+        """
+        分页获取待处理的请求及发起者信息
+        :param size: 每页数量
+        :param after: 上一页最后一个请求的ID
+        :param before: 下一页第一个请求的ID
+        :return: ([(请求, 发起者昵称, 发起者用户名)], 是否有上一页, 是否有下一页)
+        """
+        stmt = select(BangumiRequireModel, UserModel.fullname, UserModel.username).outerjoin(
+                UserModel, UserModel.telegram_id == BangumiRequireModel.telegram_id).filter(_pending_require)
+        rows, has_prev, has_next = await paginate(stmt, BangumiRequireModel.id, size, after, before)
+        return [tuple(row) for row in rows], has_prev, has_next
@@ -0,0 +1,144 @@
+import hashlib
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable
+
+
+class LRUCache:
+    """
+    带过期时间的 LRU 缓存，只在单个事件循环内使用，不加锁
+    写入方修改数据后调用 put/invalidate，读取方从数据库加载后用 put(..., generation=...) 回填，
+    若期间发生过写入则放弃回填，避免旧数据覆盖新数据
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        """
+        :param maxsize: 最大条目数
+        :param ttl: 条目存活秒数
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0  # 每次写入/失效递增
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable) -> Any | None:
+        """
+        读取缓存，过期或不存在时返回 None
+        :param key: 键
+        """
+        item = self._data.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key: Hashable, value: Any, generation: int | None = None):
+        """
+        写入缓存
+        :param key: 键
+        :param value: 值
+        :param generation: 读取前记录的 generation，不传表示这是一次写入
+        """
+        if generation is None:
+            self.generation += 1
+        elif generation != self.generation:
+            return
+        if self.maxsize <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        """
+        使某个键失效
+        :param key: 键
+        """
+        self.generation += 1
+        self._data.pop(key, None)
+
+    def clear(self):
+        """清空缓存"""
+        self.generation += 1
+        self._data.clear()
+
+    def stats(self) -> dict:
+        """命中统计"""
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class BloomFilter:
+    """
+    字符串的布隆过滤器，用于在访问数据库前排除一定不存在的键
+    不支持删除，删除只会让已删除的键继续被判定为可能存在，由数据库兜底
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        """
+        :param capacity: 预计的键数量，超出后误判率上升
+        :param error_rate: 达到 capacity 时的目标误判率
+        """
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        self.size = max(8, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))  # 位数
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.count = 0  # 加入过的键数量（含重复加入）
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key: str) -> range:
+        # 双重哈希：第 i 个位置为 h1 + i * h2，返回未取模的等差数列
+        h = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=16).digest(), "little")
+        h1, h2 = h & 0xFFFFFFFFFFFFFFFF, (h >> 64) | 1
+        return range(h1, h1 + self.hashes * h2, h2)
+
+    def add(self, key: str):
+        self.update((key,))
+
+    def update(self, keys: Iterable[str]):
+        """批量加入"""
+        bits, size = self._bits, self.size
+        for key in keys:
+            for pos in self._positions(key):
+                pos %= size
+                bits[pos >> 3] |= 1 << (pos & 7)
+            self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        bits, size = self._bits, self.size
+        for pos in self._positions(key):
+            pos %= size
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def false_positive_rate(self) -> float:
+        """按当前键数量估算的误判率"""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+    def stats(self) -> dict:
+        return {
+            "count": self.count,
+            "capacity": self.capacity,
+            "bits": self.size,
+            "hashes": self.hashes,
+            "memory_bytes": len(self._bits),
+            "false_positive_rate": self.false_positive_rate(),
+        }
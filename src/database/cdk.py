@@ -1,30 +1,285 @@
-from sqlalchemy import delete, select
-from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import re
+import string
+import struct
+from datetime import datetime
+from enum import Enum
+from functools import partial
+from typing import Callable, Iterable, Sequence
+
+from sqlalchemy import Connection, Index, MetaData, and_, delete, exists, func, or_, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 from src.config import Config
-from src.database import create_database
+from src.database import SessionFactory, create_database, in_unit_of_work, index_migration, on_commit, paginate, \
+    session_scope
+from src.database.archive import ArchiveKind, archive_rows, row_dict
+from src.database.cache import BloomFilter
+from src.database.scope import current_scope
+from src.logger import bot_logger
+from src.database.user import UserModel
 
 
 class CdkDatabaseModel(AsyncAttrs, DeclarativeBase):
-    pass
+    metadata = MetaData(schema="cdk")
 
 
 class CdkModel(CdkDatabaseModel):
     """cdk"""
     __tablename__ = 'cdk'
-    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True, index=True)
-    cdk: Mapped[str] = mapped_column(index=True, nullable=False)  # cdk
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    cdk: Mapped[str] = mapped_column(index=True, unique=True, nullable=False)  # cdk
     limit: Mapped[int] = mapped_column(default=1)  # 使用次数
     expired_time: Mapped[int] = mapped_column(default=0)  # 过期时间
-    used_history: Mapped[str] = mapped_column(default="")  # 使用历史 可能考虑往里面塞一个json
+    used_history: Mapped[str] = mapped_column(default="")  # 旧版使用历史 已迁移至 cdk_usage 表
     other: Mapped[str] = mapped_column(nullable=True)  # 预留的其他配置
 
 
-create_database("cdk", CdkDatabaseModel)
-DATABASE_URL = f'sqlite+aiosqlite:///{Config.DATABASES_DIR / "cdk.db"}'
-ENGINE = create_async_engine(DATABASE_URL, echo=Config.SQLALCHEMY_LOG)
-CdkSessionFactory = async_sessionmaker(bind=ENGINE, expire_on_commit=False)
+class CdkUsageModel(CdkDatabaseModel):
+    """cdk使用记录"""
+    __tablename__ = 'cdk_usage'
+    __table_args__ = (Index('ix_cdk_usage_cdk_id_telegram_id', 'cdk_id', 'telegram_id', unique=True),
+                      Index('ix_cdk_usage_cdk_id', 'cdk_id'))
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    cdk_id: Mapped[int] = mapped_column(nullable=False)  # cdk ID
+    telegram_id: Mapped[int] = mapped_column(nullable=False)  # 使用者 Telegram ID
+    use_time: Mapped[int] = mapped_column(nullable=False)  # 使用时间
+
+
+# 剩余次数大于 0 的 cdk，用于分页列出可用的 cdk
+Index('ix_cdk_available', CdkModel.id, sqlite_where=CdkModel.limit > 0)
+
+
+def _migrate_used_history(connection: Connection):
+    """将 used_history 中的 json 使用历史迁移到 cdk_usage 表"""
+    rows = connection.execute(select(CdkModel.id, CdkModel.used_history).where(CdkModel.used_history != "")).all()
+    usages = [{"cdk_id": cdk_id, "telegram_id": int(h["tg_id"]), "use_time": int(h["time"])}
+              for cdk_id, used_history in rows for h in json.loads(used_history)]
+    if usages:
+        connection.execute(sqlite_insert(CdkUsageModel).on_conflict_do_nothing(), usages)
+    connection.execute(update(CdkModel).where(CdkModel.used_history != "").values(used_history=""))
+
+
+def _unique_cdk(connection: Connection):
+    """合并重复的 cdk（保留最早的一条，剩余次数与使用记录并入其中），并将 cdk 索引重建为唯一索引"""
+    duplicates = connection.execute(select(CdkModel.cdk, func.min(CdkModel.id)).group_by(CdkModel.cdk)
+                                    .having(func.count() > 1)).all()
+    for cdk, keep_id in duplicates:
+        others = select(CdkModel.id).where(CdkModel.cdk == cdk, CdkModel.id != keep_id).scalar_subquery()
+        extra = connection.execute(select(func.sum(CdkModel.limit)).where(CdkModel.id.in_(others))).scalar()
+        connection.execute(update(CdkModel).where(CdkModel.id == keep_id).values(limit=CdkModel.limit + extra))
+        connection.execute(update(CdkUsageModel).where(CdkUsageModel.cdk_id.in_(others))
+                           .values(cdk_id=keep_id).prefix_with("OR IGNORE"))
+        connection.execute(delete(CdkUsageModel).where(CdkUsageModel.cdk_id.in_(others)))
+        connection.execute(delete(CdkModel).where(CdkModel.id.in_(others)))
+    # 旧版本在未使用 schema 时创建的索引名为 ix_cdk_cdk，与新的唯一索引重复
+    connection.exec_driver_sql("DROP INDEX IF EXISTS cdk.ix_cdk_cdk")
+    for index in CdkModel.__table__.indexes:
+        if index.unique:
+            connection.exec_driver_sql(f"DROP INDEX IF EXISTS cdk.{index.name}")
+            index.create(connection)
+
+
+def _drop_id_index(connection: Connection):
+    """删除主键上多余的索引（旧版本为 ix_cdk_id，使用 schema 后为 ix_cdk_cdk_id）"""
+    connection.exec_driver_sql("DROP INDEX IF EXISTS cdk.ix_cdk_id")
+    connection.exec_driver_sql("DROP INDEX IF EXISTS cdk.ix_cdk_cdk_id")
+
+
+create_database(CdkDatabaseModel, [_migrate_used_history, index_migration(CdkModel, CdkUsageModel), _unique_cdk,
+                                   _drop_id_index])
+CdkSessionFactory = SessionFactory
+_random = random.SystemRandom()
+_alphabet = string.ascii_letters + string.digits
+_legacy_cdk = re.compile(r"reg_[A-Za-z0-9]{16}_prej")
+_signed_cdk = re.compile(r"reg_([12])([A-Za-z0-9]{30})_prej")  # 签名格式版本 1 只有随机数，2 带过期时间
+_signed_body_size = 12
+_signed_body = struct.Struct(">8sI")  # 版本 2：随机数, 过期时间（0 为不过期）
+_signature_size = 10
+
+
+class CdkSignature(Enum):
+    """注册码签名校验结果"""
+    UNSIGNED = 0  # 无签名的随机注册码，或未设置 SALT 时无法校验签名
+    INVALID = 1  # 格式错误或签名不匹配
+    VALID = 2  # 签名有效且签名中的过期时间未到，剩余次数与过期时间仍以数据库为准
+    EXPIRED = 3  # 签名有效但签名中的过期时间已过，无需查询数据库
+
+
+def _b62encode(data: bytes, length: int) -> str:
+    value = int.from_bytes(data, "big")
+    chars = []
+    for _ in range(length):
+        value, rem = divmod(value, 62)
+        chars.append(_alphabet[rem])
+    return "".join(reversed(chars))
+
+
+def _b62decode(text: str, size: int) -> bytes | None:
+    value = 0
+    for char in text:
+        value = value * 62 + _alphabet.index(char)
+    return value.to_bytes(size, "big") if value.bit_length() <= size * 8 else None
+
+
+def _sign(version: str, body: bytes) -> bytes:
+    # 版本 1 的签名不含版本号，保持已生成的注册码有效
+    prefix = b"cdk" if version == "1" else f"cdk{version}".encode()
+    return hmac.new(Config.SALT.encode(), prefix + body, hashlib.sha256).digest()[:_signature_size]
+
+
+def signing_enabled() -> bool:
+    """是否生成带签名的注册码 SALT 为空时任何人都能伪造签名，拒绝开启"""
+    if not Config.SIGNED_CDK:
+        return False
+    if not Config.SALT:
+        bot_logger.warning("SIGNED_CDK is enabled but SALT is empty, generating unsigned cdk instead")
+        Config.SIGNED_CDK = False
+        return False
+    return True
+
+
+def generate_cdk(expired_time: int = 0) -> str:
+    """
+    生成一个注册码 开启 SIGNED_CDK 时生成带签名的注册码，签名中包含过期时间
+    :param expired_time: 过期时间 0 为不过期，只写入带签名的注册码
+    """
+    if not signing_enabled():
+        return f"reg_{''.join(_random.choices(_alphabet, k=16))}_prej"
+    body = _signed_body.pack(os.urandom(8), expired_time)
+    return f"reg_2{_b62encode(body + _sign('2', body), 30)}_prej"
+
+
+def _parse_signed(cdk: str) -> tuple[CdkSignature, int]:
+    """
+    校验注册码的格式与签名
+    :return: (校验结果, 签名中的过期时间 0 为不过期或不含过期时间)
+    """
+    if _legacy_cdk.fullmatch(cdk):
+        return CdkSignature.UNSIGNED, 0
+    match = _signed_cdk.fullmatch(cdk)
+    raw = match and _b62decode(match.group(2), _signed_body_size + _signature_size)
+    if not raw:
+        return CdkSignature.INVALID, 0
+    if not Config.SALT:
+        return CdkSignature.UNSIGNED, 0
+    version, body, signature = match.group(1), raw[:_signed_body_size], raw[_signed_body_size:]
+    if not hmac.compare_digest(signature, _sign(version, body)):
+        return CdkSignature.INVALID, 0
+    return CdkSignature.VALID, _signed_body.unpack(body)[1] if version == "2" else 0
+
+
+def verify_cdk(cdk: str) -> CdkSignature:
+    """
+    只用 CPU 校验注册码的格式、签名与签名中的过期时间，不访问数据库
+    签名只证明注册码由本机生成；签名有效时数据库中的过期时间与剩余次数仍然生效，签名中的过期时间是有效期的上限
+    :param cdk: 注册码
+    """
+    signature, expired_time = _parse_signed(cdk)
+    if signature == CdkSignature.VALID and expired_time and expired_time < datetime.now().timestamp():
+        return CdkSignature.EXPIRED
+    return signature
+
+
+def signed_expiry(cdk: str) -> int:
+    """
+    带签名的注册码中的过期时间 数据库中的过期时间不能晚于它
+    :return: 过期时间，0 为无签名、无法校验或不过期
+    """
+    signature, expired_time = _parse_signed(cdk)
+    return expired_time if signature == CdkSignature.VALID else 0
+
+
+class CdkFilter:
+    """
+    已存在 cdk 的布隆过滤器 判定为不存在的 cdk 无需查询数据库
+    新增的 cdk 在提交后加入，重新加载期间提交的会在加载完成后补入；删除单个 cdk 不更新过滤器，只会多一次数据库查询
+    未加载时所有 cdk 都视为可能存在
+    """
+    
+    def __init__(self, error_rate: float = 0.001, min_capacity: int = 10000):
+        """
+        :param error_rate: 目标误判率
+        :param min_capacity: 最小容量，实际容量为加载时 cdk 数量的两倍，超出后重新加载
+        """
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self.rejected = 0  # 直接排除的查询
+        self.passed = 0  # 通过过滤器、需要查询数据库的次数
+        self.db_misses = 0  # 通过过滤器但数据库中不存在的次数（误判或已删除）
+        self._filter: BloomFilter | None = None
+        self._pending: list[str] | None = None  # 加载期间提交的 cdk
+        self._lock = asyncio.Lock()
+    
+    def might_contain(self, cdk: str) -> bool:
+        if self._filter is None:
+            return True
+        if cdk in self._filter:
+            self.passed += 1
+            return True
+        self.rejected += 1
+        return False
+    
+    def miss(self):
+        """通过过滤器的 cdk 在数据库中不存在"""
+        if self._filter is not None:
+            self.db_misses += 1
+    
+    def add(self, codes: Iterable[str]):
+        """
+        cdk 提交后调用
+        :param codes: cdk 列表
+        """
+        if self._pending is not None:
+            self._pending.extend(codes)
+        if self._filter is not None:
+            self._filter.update(codes)
+    
+    def clear(self):
+        """所有 cdk 已删除"""
+        if self._filter is not None:
+            self._filter = BloomFilter(self._filter.capacity, self.error_rate)
+    
+    def unload(self):
+        """数据被整体替换（如恢复备份）时停用过滤器，重新加载前所有 cdk 都视为可能存在"""
+        self._filter = None
+    
+    @property
+    def full(self) -> bool:
+        return self._filter is not None and self._filter.count > self._filter.capacity
+    
+    async def load(self):
+        """从数据库重新构建过滤器"""
+        async with self._lock:
+            self._pending = []
+            try:
+                async with session_scope() as session:
+                    codes = (await session.scalars(select(CdkModel.cdk))).all()
+                bloom = BloomFilter(max(self.min_capacity, len(codes) * 2), self.error_rate)
+                # 新的过滤器尚未发布，可以在线程中构建，期间提交的 cdk 记录在 _pending 中
+                await asyncio.to_thread(bloom.update, codes)
+                bloom.update(self._pending)
+                self._filter = bloom
+            finally:
+                self._pending = None
+    
+    def stats(self) -> dict:
+        """过滤器大小、估算误判率与命中统计"""
+        stats = self._filter.stats() if self._filter is not None else {"loaded": False}
+        checked = self.rejected + self.db_misses
+        stats.update(rejected=self.rejected, passed=self.passed, db_misses=self.db_misses,
+                     observed_false_positive_rate=self.db_misses / checked if checked else 0.0)
+        return stats
+
+
+KnownCdks = CdkFilter()
 
 
 class CdkOperate:
@@ -34,21 +289,78 @@ class CdkOperate:
         添加cdk到数据库
         :param cdk_data: cdk数据
         """
-        async with CdkSessionFactory() as session:
-            async with session.begin():
-                session.add(cdk_data)
+        async with session_scope() as session:
+            session.add(cdk_data)
+            on_commit(session, partial(KnownCdks.add, [cdk_data.cdk]))
+        if scope := current_scope():
+            scope.put(CdkModel, cdk_data.cdk, cdk_data)
+    
+    @staticmethod
+    async def bulk_add_cdk(quantity: int, limit: int = 1, expired_time: int = 0,
+                           generator: Callable[[], str] = None, max_rounds: int = 10) -> list[str]:
+        """
+        在一个事务内批量生成cdk 与已有cdk冲突的会被忽略并重新生成
+        :param quantity: 数量
+        :param limit: 使用次数
+        :param expired_time: 过期时间 0 为不过期
+        :param generator: cdk生成函数 默认使用 generate_cdk 并写入过期时间
+        :param max_rounds: 最多重新生成的轮数
+        :return: 生成的cdk列表
+        """
+        generator = generator or partial(generate_cdk, expired_time)
+        codes: list[str] = []
+        stmt = sqlite_insert(CdkModel.__table__).on_conflict_do_nothing().returning(CdkModel.cdk)
+        async with session_scope() as session:
+            for _ in range(max_rounds):
+                missing = quantity - len(codes)
+                if missing <= 0:
+                    break
+                batch = set()
+                while len(batch) < missing:
+                    batch.add(generator())
+                rows = [{"cdk": code, "limit": limit, "expired_time": expired_time} for code in batch]
+                scalar = await session.execute(stmt, rows)
+                codes.extend(scalar.scalars().all())
+            if len(codes) < quantity:
+                raise RuntimeError(f"Failed to generate {quantity} unique cdk, got {len(codes)}")
+            on_commit(session, partial(KnownCdks.add, codes))
+        if KnownCdks.full:
+            await KnownCdks.load()
+        return codes
     
     @staticmethod
     async def get_cdk(cdk: str) -> CdkModel | None:
         """
-        获取cdk
+        获取cdk 同一 update 内只加载一次，过滤器判定不存在时不查询数据库
         :param cdk: cdk
+        :return: cdk 为空或不是字符串时返回 None
+        """
+        if not cdk or not isinstance(cdk, str):
+            return None
+        scope = current_scope()
+        if scope and (cdk_data := scope.get(CdkModel, cdk)):
+            return cdk_data
+        # 事务内新增的 cdk 尚未加入过滤器
+        if not in_unit_of_work() and not KnownCdks.might_contain(cdk):
+            return None
+        async with session_scope() as session:
+            scalar = await session.execute(select(CdkModel).filter(CdkModel.cdk == cdk).limit(1))
+            cdk_data = scalar.scalar_one_or_none()
+        if cdk_data is None:
+            KnownCdks.miss()
+        if scope and cdk_data:
+            cdk_data = scope.add(CdkModel, cdk, cdk_data)
+        return cdk_data
+    
+    @staticmethod
+    async def get_cdk_by_id(cdk_id: int) -> CdkModel | None:
+        """
+        通过ID获取cdk
+        :param cdk_id: cdk ID
         :return: cdk
         """
-        async with CdkSessionFactory() as session:
-            async with session.begin():
-                scalar = await session.execute(select(CdkModel).filter(CdkModel.cdk == cdk).limit(1))
-                return scalar.scalar_one_or_none()
+        async with session_scope() as session:
+            return await session.get(CdkModel, cdk_id)
     
     @staticmethod
     async def update_cdk(cdk_data: CdkModel):
@@ -56,9 +368,11 @@ class CdkOperate:
         更新cdk
         :param cdk_data: cdk数据
         """
-        async with CdkSessionFactory() as session:
-            async with session.begin():
-                await session.merge(cdk_data)
+        async with session_scope() as session:
+            await session.merge(cdk_data)
+            on_commit(session, partial(KnownCdks.add, [cdk_data.cdk]))
+        if scope := current_scope():
+            scope.put(CdkModel, cdk_data.cdk, cdk_data)
     
     @staticmethod
     async def delete_cdk(cdk: str):
@@ -66,9 +380,12 @@ class CdkOperate:
         删除cdk
         :param cdk: cdk
         """
-        async with CdkSessionFactory() as session:
-            async with session.begin():
-                await session.execute(delete(CdkModel).where(CdkModel.cdk == cdk))
+        async with session_scope() as session:
+            await session.execute(delete(CdkUsageModel).where(
+                    CdkUsageModel.cdk_id.in_(select(CdkModel.id).where(CdkModel.cdk == cdk))))
+            await session.execute(delete(CdkModel).where(CdkModel.cdk == cdk))
+        if scope := current_scope():
+            scope.discard(CdkModel, cdk)
     
     @staticmethod
     async def get_all_cdk():
@@ -76,16 +393,159 @@ class CdkOperate:
         获取所有cdk
         :return:
         """
-        async with CdkSessionFactory() as session:
-            async with session.begin():
-                scalar = await session.execute(select(CdkModel))
-                return scalar.scalars().all()
+        async with session_scope() as session:
+            scalar = await session.execute(select(CdkModel))
+            return scalar.scalars().all()
+    
+    @staticmethod
+    async def page_available_cdk(size: int, after: int = None, before: int = None) -> tuple[list[CdkModel], bool, bool]:
+        """
+        分页获取未过期且有剩余次数的cdk
+        :param size: 每页数量
+        :param after: 上一页最后一个cdk的ID
+        :param before: 下一页第一个cdk的ID
+        :return: (cdk列表, 是否有上一页, 是否有下一页)
+        """
+        now = int(datetime.now().timestamp())
+        stmt = select(CdkModel).filter(CdkModel.limit > 0, or_(CdkModel.expired_time == 0, CdkModel.expired_time > now))
+        rows, has_prev, has_next = await paginate(stmt, CdkModel.id, size, after, before)
+        return [row[0] for row in rows], has_prev, has_next
     
     @staticmethod
     async def delete_all_cdk():
         """
         删除所有cdk
         """
-        async with CdkSessionFactory() as session:
-            async with session.begin():
-                await session.execute(delete(CdkModel))
+        async with session_scope() as session:
+            await session.execute(delete(CdkUsageModel))
+            await session.execute(delete(CdkModel))
+            on_commit(session, KnownCdks.clear)
+        if scope := current_scope():
+            scope.discard_model(CdkModel)
+    
+    @staticmethod
+    async def purge_cdk(before: int, batch_size: int = 500) -> int:
+        """
+        将在 before 之前过期或用完的cdk连同使用记录移入归档
+        :param before: 时间戳 用完的cdk以最后一次使用时间为准
+        :param batch_size: 每个事务处理的cdk数量
+        :return: 归档的cdk数量
+        """
+        finished = select(CdkModel).where(or_(
+                and_(CdkModel.expired_time != 0, CdkModel.expired_time < before),
+                and_(CdkModel.limit <= 0,
+                     ~exists().where(CdkUsageModel.cdk_id == CdkModel.id, CdkUsageModel.use_time >= before))
+        )).order_by(CdkModel.id).limit(batch_size)
+        total = 0
+        while True:
+            async with session_scope() as session:
+                cdks = (await session.execute(finished)).scalars().all()
+                if not cdks:
+                    break
+                cdk_ids = [cdk.id for cdk in cdks]
+                usages: dict[int, list] = {}
+                for usage in (await session.execute(select(CdkUsageModel).where(
+                        CdkUsageModel.cdk_id.in_(cdk_ids)).order_by(CdkUsageModel.id))).scalars():
+                    usages.setdefault(usage.cdk_id, []).append([usage.telegram_id, usage.use_time])
+                await archive_rows(session, ArchiveKind.CDK, [
+                    (cdk.id, cdk.cdk, row_dict(cdk) | {"usage": usages.get(cdk.id, [])}) for cdk in cdks])
+                await session.execute(delete(CdkUsageModel).where(CdkUsageModel.cdk_id.in_(cdk_ids)))
+                await session.execute(delete(CdkModel).where(CdkModel.id.in_(cdk_ids)))
+            total += len(cdks)
+        if total and (scope := current_scope()):
+            scope.discard_model(CdkModel)
+        return total
+    
+    @staticmethod
+    async def is_used(cdk_id: int, telegram_id: int) -> bool:
+        """
+        用户是否已经使用过cdk
+        :param cdk_id: cdk ID
+        :param telegram_id: Telegram ID
+        """
+        async with session_scope() as session:
+            scalar = await session.execute(select(CdkUsageModel.id).filter(
+                    CdkUsageModel.cdk_id == cdk_id, CdkUsageModel.telegram_id == telegram_id).limit(1))
+            return scalar.scalar_one_or_none() is not None
+    
+    @staticmethod
+    async def add_usage(cdk_id: int, telegram_id: int) -> bool:
+        """
+        记录cdk使用
+        :param cdk_id: cdk ID
+        :param telegram_id: Telegram ID
+        :return: 是否为新的使用记录
+        """
+        async with session_scope() as session:
+            result = await session.execute(sqlite_insert(CdkUsageModel).values(
+                    cdk_id=cdk_id, telegram_id=telegram_id, use_time=int(datetime.now().timestamp())
+            ).on_conflict_do_nothing())
+            return result.rowcount == 1
+    
+    @staticmethod
+    async def get_usage(cdk_id: int) -> Sequence[CdkUsageModel]:
+        """
+        获取cdk使用记录
+        :param cdk_id: cdk ID
+        """
+        async with session_scope() as session:
+            scalar = await session.execute(select(CdkUsageModel).filter(CdkUsageModel.cdk_id == cdk_id)
+                                           .order_by(CdkUsageModel.id))
+            return scalar.scalars().all()
+    
+    @staticmethod
+    async def page_usage(cdk_id: int, size: int, after: int = None,
+                         before: int = None) -> tuple[list[tuple[CdkUsageModel, str | None]], bool, bool]:
+        """
+        分页获取cdk使用记录及使用者昵称
+        :param cdk_id: cdk ID
+        :param size: 每页数量
+        :param after: 上一页最后一条记录的ID
+        :param before: 下一页第一条记录的ID
+        :return: ([(使用记录, 使用者昵称)], 是否有上一页, 是否有下一页)
+        """
+        stmt = select(CdkUsageModel, UserModel.fullname).outerjoin(
+                UserModel, UserModel.telegram_id == CdkUsageModel.telegram_id).filter(CdkUsageModel.cdk_id == cdk_id)
+        rows, has_prev, has_next = await paginate(stmt, CdkUsageModel.id, size, after, before)
+        return [tuple(row) for row in rows], has_prev, has_next
+    
+    @staticmethod
+    async def redeem(cdk: str, telegram_id: int) -> bool:
+        """
+        使用cdk 剩余次数的检查与扣减在一条语句中完成，并发使用时不会超出次数
+        :param cdk: cdk
+        :param telegram_id: 使用者 Telegram ID
+        :return: 是否使用成功（不存在/已过期/次数用尽/已经使用过时返回 False）
+        """
+        now = int(datetime.now().timestamp())
+        async with session_scope() as session:
+            scalar = await session.execute(update(CdkModel.__table__).where(
+                    CdkModel.id == select(CdkModel.id).where(CdkModel.cdk == cdk).limit(1).scalar_subquery(),
+                    CdkModel.limit > 0,
+                    or_(CdkModel.expired_time == 0, CdkModel.expired_time > now),
+                    ~exists().where(CdkUsageModel.cdk_id == CdkModel.id, CdkUsageModel.telegram_id == telegram_id)
+            ).values(limit=CdkModel.limit - 1).returning(CdkModel.id))
+            cdk_id = scalar.scalar_one_or_none()
+            if cdk_id is not None:
+                await session.execute(sqlite_insert(CdkUsageModel).values(
+                        cdk_id=cdk_id, telegram_id=telegram_id, use_time=now).on_conflict_do_nothing())
+        if cdk_id is not None and (scope := current_scope()):
+            scope.discard(CdkModel, cdk)
+        return cdk_id is not None
+    
+    @staticmethod
+    async def release(cdk: str, telegram_id: int):
+        """
+        撤销一次cdk使用 用于使用成功但后续注册失败的情况
+        :param cdk: cdk
+        :param telegram_id: 使用者 Telegram ID
+        """
+        async with session_scope() as session:
+            cdk_id = select(CdkModel.id).where(CdkModel.cdk == cdk).limit(1).scalar_subquery()
+            result = await session.execute(delete(CdkUsageModel).where(
+                    CdkUsageModel.cdk_id == cdk_id, CdkUsageModel.telegram_id == telegram_id))
+            if result.rowcount:
+                await session.execute(update(CdkModel).where(CdkModel.id == cdk_id)
+                                      .values(limit=CdkModel.limit + 1))
+        if scope := current_scope():
+            scope.discard(CdkModel, cdk)
@@ -0,0 +1,121 @@
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Hashable, Sequence
+
+# 模型 -> 批量写回函数，由各数据库模块注册
+_flushers: dict[type, Callable[[Sequence[Any]], Awaitable[None]]] = {}
+_current: ContextVar["UpdateScope | None"] = ContextVar("update_scope", default=None)
+
+
+def register_flusher(model: type, flusher: Callable[[Sequence[Any]], Awaitable[None]]):
+    """
+    注册模型的批量写回函数
+    :param model: 数据库模型
+    :param flusher: 接收脏对象列表并写回数据库
+    """
+    _flushers[model] = flusher
+
+
+class UpdateScope:
+    """
+    单个 Telegram update 内的标识映射
+    同一行在一次 update 中只加载一次，延迟写入的对象在 update 正常结束时统一写回
+    加载时可记录原始值，写回时只更新有变化的列
+    """
+
+    def __init__(self):
+        self.rows: dict[tuple[type, Hashable], Any] = {}
+        self.dirty: dict[tuple[type, Hashable], Any] = {}
+        self.originals: dict[tuple[type, Hashable], dict] = {}  # 加载或上次写回时的列值
+        self.loads = 0  # 实际从缓存/数据库加载的次数
+        self.hits = 0  # 命中标识映射的次数
+
+    def get(self, model: type, key: Hashable) -> Any | None:
+        obj = self.rows.get((model, key))
+        if obj is not None:
+            self.hits += 1
+        return obj
+
+    def add(self, model: type, key: Hashable, obj: Any, original: dict | None = None) -> Any:
+        """
+        记录加载到的对象，已存在时返回已记录的对象
+        :param original: 加载时的列值
+        """
+        existing = self.rows.get((model, key))
+        if existing is not None:
+            return existing
+        self.loads += 1
+        self.rows[(model, key)] = obj
+        if original is not None:
+            self.originals[(model, key)] = original
+        return obj
+
+    def put(self, model: type, key: Hashable, obj: Any, original: dict | None = None):
+        """
+        记录刚写入数据库的对象
+        :param original: 写入的列值，不传表示未知
+        """
+        self.rows[(model, key)] = obj
+        if original is None:
+            self.originals.pop((model, key), None)
+        else:
+            self.originals[(model, key)] = original
+
+    def original(self, model: type, key: Hashable) -> dict | None:
+        """加载或上次写回时的列值，未知时返回 None"""
+        return self.originals.get((model, key))
+
+    def mark_dirty(self, model: type, key: Hashable, obj: Any):
+        self.rows[(model, key)] = obj
+        self.dirty[(model, key)] = obj
+
+    def mark_clean(self, model: type, key: Hashable, original: dict):
+        """
+        对象已经写回，不再需要在结束时写回
+        :param original: 写回后的列值
+        """
+        self.dirty.pop((model, key), None)
+        self.originals[(model, key)] = original
+
+    def discard(self, model: type, key: Hashable):
+        self.rows.pop((model, key), None)
+        self.dirty.pop((model, key), None)
+        self.originals.pop((model, key), None)
+
+    def discard_model(self, model: type):
+        for key in [key for key in self.rows if key[0] is model]:
+            self.discard(*key)
+
+    async def flush(self):
+        """将脏对象按模型分组写回"""
+        groups: dict[type, list] = {}
+        for (model, _), obj in self.dirty.items():
+            groups.setdefault(model, []).append(obj)
+        self.dirty.clear()
+        for model, objs in groups.items():
+            await _flushers[model](objs)
+
+
+def current_scope() -> UpdateScope | None:
+    """当前 update 的标识映射，不在 update 内时为 None"""
+    return _current.get()
+
+
+@asynccontextmanager
+async def update_scope():
+    """
+    开启一个 update 作用域，正常结束时写回脏对象，抛出异常时丢弃
+    嵌套调用时复用外层作用域
+    """
+    scope = _current.get()
+    if scope is not None:
+        yield scope
+        return
+    scope = UpdateScope()
+    token = _current.set(scope)
+    try:
+        yield scope
+        # 写回时作用域仍然有效，写回函数可以读取原始值
+        await scope.flush()
+    finally:
+        _current.reset(token)
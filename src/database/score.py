@@ -1,15 +1,30 @@
-from typing import Optional, Sequence
+import asyncio
+import base64
+import bisect
+import contextvars
+import json
+import random
+import time
+from datetime import datetime
+from enum import Enum
+from functools import partial
+from typing import Awaitable, Callable, Optional, Sequence
 
-from sqlalchemy import delete, select, update
-from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
+from sqlalchemy import Connection, Index, MetaData, bindparam, case, delete, exists, insert, or_, select, text, \
+    update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncAttrs, AsyncSession
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
-from src.config import Config
-from src.database import create_database
+from src.database import SessionFactory, create_database, in_unit_of_work, index_migration, on_commit, \
+    session_scope
+from src.database.archive import ArchiveKind, archive_rows, row_dict
+from src.database.scope import current_scope
+from src.database.user import UserModel
 
 
 class ScoreDatabaseModel(AsyncAttrs, DeclarativeBase):
-    pass
+    metadata = MetaData(schema="score")
 
 
 class ScoreModel(ScoreDatabaseModel):
@@ -24,22 +39,378 @@ class ScoreModel(ScoreDatabaseModel):
 class RedPacketModel(ScoreDatabaseModel):
     """红包"""
     __tablename__ = 'red_packet'
+    __table_args__ = (Index('ix_red_packet_status_create_time', 'status', 'create_time'),)
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True, index=True)
     telegram_id: Mapped[int] = mapped_column(index=True)  # Telegram ID 发出红包者
     amount: Mapped[int] = mapped_column(nullable=False)  # 红包金额
     count: Mapped[int] = mapped_column(nullable=False)  # 红包个数
     current_amount: Mapped[int] = mapped_column(nullable=False)  # 当前剩余金额
-    status: Mapped[int] = mapped_column(default=0)  # 状态 0 未领取 1 已领完 2 已经撤回
+    status: Mapped[int] = mapped_column(default=0)  # 状态 0 未领取 1 已领完 2 已经撤回 3 已过期
     type: Mapped[int] = mapped_column(default=0)  # 类型 0 随机红包 1 均分
-    history: Mapped[str] = mapped_column(default="")  # 领取历史
+    history: Mapped[str] = mapped_column(default="")  # 旧版领取历史 已迁移至 red_packet_share 表
     create_time: Mapped[int] = mapped_column(nullable=True)  # 创建时间
-    data: Mapped[str] = mapped_column(nullable=True)  # 预留的其他配置
+    data: Mapped[str] = mapped_column(nullable=True)  # 旧版红包金额列表 已迁移至 red_packet_share 表
+    chat_id: Mapped[int] = mapped_column(nullable=True)  # 红包消息所在的聊天
+    message_id: Mapped[int] = mapped_column(nullable=True)  # 红包消息 ID
+
+
+class RedPacketShareModel(ScoreDatabaseModel):
+    """红包份额 每份一行，创建时已打乱顺序"""
+    __tablename__ = 'red_packet_share'
+    __table_args__ = (Index('ix_red_packet_share_packet_id_telegram_id', 'packet_id', 'telegram_id', unique=True),)
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    packet_id: Mapped[int] = mapped_column(nullable=False)  # 红包 ID
+    amount: Mapped[int] = mapped_column(nullable=False)  # 份额金额
+    telegram_id: Mapped[int] = mapped_column(nullable=True)  # 领取者 Telegram ID 未领取为空
+    fullname: Mapped[str] = mapped_column(nullable=True)  # 领取者名字
+    claim_time: Mapped[int] = mapped_column(nullable=True)  # 领取时间
+
+
+class LedgerReason(Enum):
+    """积分变动原因"""
+    SIGN = "sign"
+    TRANSFER = "transfer"
+    GEN_CDK = "gen_cdk"
+    RED_PACKET = "red_packet"
+    RED_PACKET_CLAIM = "red_packet_claim"
+    RED_PACKET_REFUND = "red_packet_refund"
+    RED_PACKET_EXPIRED = "red_packet_expired"
+
+
+class ScoreJournalModel(ScoreDatabaseModel):
+    """积分流水 只追加不修改"""
+    __tablename__ = 'score_journal'
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    telegram_id: Mapped[int] = mapped_column(index=True)  # Telegram ID
+    change: Mapped[int] = mapped_column(nullable=False)  # 变动积分
+    balance: Mapped[int] = mapped_column(nullable=False)  # 变动后积分
+    reason: Mapped[str] = mapped_column(nullable=False)  # 变动原因
+    timestamp: Mapped[int] = mapped_column(nullable=False)  # 时间戳
+
+
+def _history_shares(packet_id: int, history: str | None) -> list[dict]:
+    """解析旧版的领取历史 tg_id#base64(名字)#金额,"""
+    shares = []
+    for entry in filter(None, (history or "").split(",")):
+        tg_id, name, amount = entry.split("#")
+        shares.append({"packet_id": packet_id, "amount": int(amount), "telegram_id": int(tg_id),
+                       "fullname": base64.b64decode(name).decode("utf-8"), "claim_time": None})
+    return shares
+
+
+def _migrate_red_packet_data(connection: Connection):
+    """将未结束红包的 data 与 history 迁移到 red_packet_share 表"""
+    packets = connection.execute(select(RedPacketModel.id, RedPacketModel.data, RedPacketModel.history)
+                                 .where(RedPacketModel.status == 0)).all()
+    shares = []
+    for packet_id, data, history in packets:
+        shares.extend(_history_shares(packet_id, history))
+        for amount in json.loads(data) if data else []:
+            shares.append({"packet_id": packet_id, "amount": amount, "telegram_id": None, "fullname": None,
+                           "claim_time": None})
+    if shares:
+        connection.execute(sqlite_insert(RedPacketShareModel).on_conflict_do_nothing(), shares)
+
+
+def _add_red_packet_message(connection: Connection):
+    """为红包表添加消息字段，没有创建时间的未结束红包从升级时开始计算有效期"""
+    columns = {row[1] for row in connection.exec_driver_sql("PRAGMA score.table_info(red_packet)")}
+    for name in ("chat_id", "message_id"):
+        if name not in columns:
+            connection.exec_driver_sql(f"ALTER TABLE score.red_packet ADD COLUMN {name} INTEGER")
+    _backfill_open_create_time(connection)
+
+
+def _backfill_open_create_time(connection: Connection):
+    """
+    旧版本的红包没有记录发送时间，未结束的红包以升级时间作为创建时间，避免升级后第一次过期清理就退款
+    之前的迁移将其创建时间设为了 0，一并修正
+    """
+    connection.execute(update(RedPacketModel).where(
+            RedPacketModel.status == 0, or_(RedPacketModel.create_time.is_(None), RedPacketModel.create_time == 0)
+    ).values(create_time=int(datetime.now().timestamp())))
+
+
+def _backfill_create_time(connection: Connection):
+    """旧版本已结束的红包没有创建时间，视为最早创建，由归档任务处理"""
+    connection.execute(update(RedPacketModel).where(RedPacketModel.create_time.is_(None)).values(create_time=0))
 
 
-create_database("score", ScoreDatabaseModel)
-DATABASE_URL = f'sqlite+aiosqlite:///{Config.DATABASES_DIR / "score.db"}'
-ENGINE = create_async_engine(DATABASE_URL, echo=Config.SQLALCHEMY_LOG)
-ScoreSessionFactory = async_sessionmaker(bind=ENGINE, expire_on_commit=False)
+def _migrate_finished_red_packet_history(connection: Connection):
+    """将已结束红包的领取历史迁移到 red_packet_share 表，红包信息与归档只读取该表"""
+    packets = connection.execute(select(RedPacketModel.id, RedPacketModel.history)
+                                 .where(RedPacketModel.status != 0, RedPacketModel.history != "")).all()
+    shares = [share for packet_id, history in packets for share in _history_shares(packet_id, history)]
+    if shares:
+        connection.execute(sqlite_insert(RedPacketShareModel).on_conflict_do_nothing(), shares)
+
+
+create_database(ScoreDatabaseModel, [_migrate_red_packet_data, _add_red_packet_message,
+                                     index_migration(RedPacketModel), _backfill_create_time,
+                                     _migrate_finished_red_packet_history, _backfill_open_create_time])
+ScoreSessionFactory = SessionFactory
+
+LedgerOperation = Callable[[AsyncSession], Awaitable]
+
+_score_table = ScoreModel.__table__
+_credit_stmt = sqlite_insert(_score_table).values(telegram_id=bindparam("tg_id"), score=bindparam("amount"),
+                                                  checkin_time=0)
+_credit_stmt = _credit_stmt.on_conflict_do_update(
+        index_elements=[_score_table.c.telegram_id],
+        set_={"score": _score_table.c.score + _credit_stmt.excluded.score}
+).returning(_score_table.c.score)
+_debit_stmt = update(_score_table).where(
+        _score_table.c.telegram_id == bindparam("tg_id"), _score_table.c.score >= bindparam("amount")
+).values(score=_score_table.c.score - bindparam("amount")).returning(_score_table.c.score)
+_checkin_stmt = sqlite_insert(_score_table).values(telegram_id=bindparam("tg_id"), score=bindparam("amount"),
+                                                   checkin_time=bindparam("now"))
+_checkin_stmt = _checkin_stmt.on_conflict_do_update(
+        index_elements=[_score_table.c.telegram_id],
+        set_={"score": _score_table.c.score + _checkin_stmt.excluded.score,
+              "checkin_time": _checkin_stmt.excluded.checkin_time},
+        where=_score_table.c.checkin_time < bindparam("day_start")
+).returning(_score_table.c.score)
+
+
+class Leaderboard:
+    """
+    内存中的积分排行榜 只保存前 size + slack 名，积分变动提交后增量更新
+    无法确定排名时（前几名积分下降、删除、管理员直接修改积分）标记为过期，下次读取时用一条 JOIN 查询重新加载
+    """
+    
+    def __init__(self, size: int = 20, slack: int = 20, ttl: float = 300):
+        self.size = size  # 对外提供的最大名次
+        self.capacity = size + slack  # 实际保存的名次，多出的部分用于容纳前几名的积分下降
+        self.ttl = ttl  # 定期重新加载以更新用户名
+        self._entries: list[tuple[int, int]] = []  # (-积分, Telegram ID) 升序
+        self._scores: dict[int, int] = {}
+        self._names: dict[int, str | None] = {}
+        self._complete = False  # 是否保存了全部用户
+        self._loaded_at: float | None = None
+        self._generation = 0  # 每次标记过期时加一，加载期间被标记过期的结果不视为最新
+        self._pending: list[tuple[int, int]] | None = None  # 加载期间收到的变动
+        self._lock = asyncio.Lock()
+    
+    def invalidate(self):
+        self._generation += 1
+        self._loaded_at = None
+    
+    def update(self, telegram_id: int, balance: int):
+        """
+        积分变动提交后调用
+        :param telegram_id: Telegram ID
+        :param balance: 变动后积分
+        """
+        if self._pending is not None:
+            self._pending.append((telegram_id, balance))
+        if self._loaded_at is None:
+            return
+        if telegram_id in self._scores:
+            self._entries.remove((-self._scores.pop(telegram_id), telegram_id))
+        elif not self._complete and self._entries and (-balance, telegram_id) > self._entries[-1]:
+            return
+        else:
+            self._names.setdefault(telegram_id, None)
+        key = (-balance, telegram_id)
+        if not self._complete and self._entries and key > self._entries[-1]:
+            # 掉出了保存的范围，真实名次未知
+            self._names.pop(telegram_id, None)
+            if len(self._entries) < self.size:
+                self.invalidate()
+            return
+        bisect.insort(self._entries, key)
+        self._scores[telegram_id] = balance
+        if len(self._entries) > self.capacity:
+            _, dropped = self._entries.pop()
+            self._scores.pop(dropped)
+            self._names.pop(dropped, None)
+            self._complete = False
+    
+    async def _load(self):
+        generation = self._generation
+        self._pending = []
+        try:
+            async with session_scope() as session:
+                rows = (await session.execute(
+                        select(ScoreModel.telegram_id, ScoreModel.score, UserModel.fullname)
+                        .outerjoin(UserModel, UserModel.telegram_id == ScoreModel.telegram_id)
+                        .order_by(ScoreModel.score.desc(), ScoreModel.telegram_id).limit(self.capacity))).all()
+            self._entries = [(-score, telegram_id) for telegram_id, score, _ in rows]
+            self._scores = {telegram_id: score for telegram_id, score, _ in rows}
+            self._names = {telegram_id: fullname for telegram_id, _, fullname in rows}
+            self._complete = len(rows) < self.capacity
+            # 查询期间被标记过期时，本次结果仍可返回，但下次读取需要重新加载
+            self._loaded_at = time.monotonic() if generation == self._generation else None
+            pending, self._pending = self._pending, None
+            for telegram_id, balance in pending:
+                self.update(telegram_id, balance)
+        finally:
+            self._pending = None
+    
+    async def top(self, limit: int = 20) -> list[tuple[int, str | None, int]]:
+        """
+        获取排行榜
+        :param limit: 名次数量，不超过 size
+        :return: [(Telegram ID, 用户名, 积分)]
+        """
+        limit = min(limit, self.size)
+        async with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+                await self._load()
+            entries = self._entries[:limit]
+            missing = [telegram_id for _, telegram_id in entries if self._names.get(telegram_id) is None]
+            if missing:
+                async with session_scope() as session:
+                    rows = await session.execute(select(UserModel.telegram_id, UserModel.fullname).filter(
+                            UserModel.telegram_id.in_(missing)))
+                    self._names.update(rows.tuples().all())
+        return [(telegram_id, self._names.get(telegram_id), -score) for score, telegram_id in entries]
+
+
+ScoreLeaderboard = Leaderboard()
+
+
+def _journal(session: AsyncSession, telegram_id: int, change: int, balance: int, reason: LedgerReason):
+    """记录流水 流水在事务提交前由 _write_journal 一次性写入，提交后同步到排行榜"""
+    session.info.setdefault("score_journal", []).append({
+        "telegram_id": telegram_id, "change": change, "balance": balance, "reason": reason.value,
+        "timestamp": int(datetime.now().timestamp())})
+    on_commit(session, partial(ScoreLeaderboard.update, telegram_id, balance))
+
+
+async def _write_journal(session: AsyncSession):
+    if entries := session.info.pop("score_journal", None):
+        await session.execute(insert(ScoreJournalModel), entries)
+
+
+async def _credit(session: AsyncSession, telegram_id: int, amount: int, reason: LedgerReason) -> int:
+    balance = (await session.execute(_credit_stmt, {"tg_id": telegram_id, "amount": amount})).scalar_one()
+    _journal(session, telegram_id, amount, balance, reason)
+    return balance
+
+
+async def _debit(session: AsyncSession, telegram_id: int, amount: int, reason: LedgerReason) -> int | None:
+    balance = (await session.execute(_debit_stmt, {"tg_id": telegram_id, "amount": amount})).scalar_one_or_none()
+    if balance is not None:
+        _journal(session, telegram_id, -amount, balance, reason)
+    return balance
+
+
+async def _transfer(session: AsyncSession, from_id: int, to_id: int, amount: int) -> tuple[int, int] | None:
+    from_balance = await _debit(session, from_id, amount, LedgerReason.TRANSFER)
+    if from_balance is None:
+        return None
+    return from_balance, await _credit(session, to_id, amount, LedgerReason.TRANSFER)
+
+
+async def _checkin(session: AsyncSession, telegram_id: int, points: int, day_start: int) -> int | None:
+    balance = (await session.execute(_checkin_stmt, {"tg_id": telegram_id, "amount": points,
+                                                     "now": int(datetime.now().timestamp()),
+                                                     "day_start": day_start})).scalar_one_or_none()
+    if balance is not None:
+        _journal(session, telegram_id, points, balance, LedgerReason.SIGN)
+    return balance
+
+
+_share = RedPacketShareModel.__table__
+_claim_stmt = update(_share).where(
+        _share.c.id == select(_share.c.id).where(_share.c.packet_id == bindparam("red_id"),
+                                                 _share.c.telegram_id.is_(None)).limit(1).scalar_subquery(),
+        ~exists().where(_share.c.packet_id == bindparam("red_id"), _share.c.telegram_id == bindparam("tg_id")),
+        exists().where(RedPacketModel.id == bindparam("red_id"), RedPacketModel.status == 0)
+).values(telegram_id=bindparam("tg_id"), fullname=bindparam("name"),
+         claim_time=bindparam("now")).returning(_share.c.amount)
+
+
+async def _claim_red_packet(session: AsyncSession, packet_id: int, telegram_id: int,
+                            fullname: str) -> tuple[int, int] | None:
+    amount = (await session.execute(_claim_stmt, {"red_id": packet_id, "tg_id": telegram_id, "name": fullname,
+                                                  "now": int(datetime.now().timestamp())})).scalar_one_or_none()
+    if amount is None:
+        return None
+    remaining = exists().where(RedPacketShareModel.packet_id == packet_id, RedPacketShareModel.telegram_id.is_(None))
+    await session.execute(update(RedPacketModel.__table__).where(RedPacketModel.id == packet_id).values(
+            current_amount=RedPacketModel.current_amount - amount,
+            status=case((remaining, RedPacketModel.status), else_=1)))
+    return amount, await _credit(session, telegram_id, amount, LedgerReason.RED_PACKET_CLAIM)
+
+
+class LedgerGroupCommit:
+    """
+    组提交 将短时间内的大量积分操作合并到少数几个事务中写入
+    """
+    
+    def __init__(self, window: float = 0.005, max_batch: int = 500):
+        self.window = window  # 等待合并的时间窗口（秒）
+        self.max_batch = max_batch  # 单个事务最多包含的操作数
+        self._pending: list[tuple[LedgerOperation, asyncio.Future]] = []
+        self._flusher: Optional[asyncio.Task] = None
+    
+    async def submit(self, operation: LedgerOperation):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((operation, future))
+        if self._flusher is None or self._flusher.done():
+            # 在空的上下文中创建，不继承第一个提交者的 update 作用域与维护入口状态
+            self._flusher = contextvars.Context().run(asyncio.create_task, self._flush())
+        return await future
+    
+    @staticmethod
+    async def _run(session: AsyncSession, operation: LedgerOperation):
+        """
+        在 SAVEPOINT 内执行单个操作，失败时只回滚该操作及其流水与提交回调
+        :return: (是否成功, 结果或异常)
+        """
+        journal = session.info.setdefault("score_journal", [])
+        callbacks = session.info.setdefault("on_commit", [])
+        journal_size, callbacks_size = len(journal), len(callbacks)
+        try:
+            async with session.begin_nested():
+                return True, await operation(session)
+        except Exception as e:
+            del journal[journal_size:], callbacks[callbacks_size:]
+            return False, e
+    
+    async def _flush(self):
+        await asyncio.sleep(self.window)
+        while self._pending:
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            try:
+                async with session_scope() as session:
+                    # pysqlite 只在 DML 前自动开启事务，先显式开启，避免第一个 SAVEPOINT 释放时直接提交
+                    await session.execute(text("BEGIN"))
+                    outcomes = [await self._run(session, operation) for operation, _ in batch]
+                    await _write_journal(session)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future), (ok, result) in zip(batch, outcomes):
+                    if future.done():
+                        continue
+                    if ok:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(result)
+
+
+LedgerCommitter = LedgerGroupCommit()
+
+
+def _discard_scores(*telegram_ids: int):
+    """积分通过 SQL 原子修改后，丢弃当前 update 中已加载的积分对象"""
+    if scope := current_scope():
+        for telegram_id in telegram_ids:
+            scope.discard(ScoreModel, telegram_id)
+
+
+async def _run_ledger(operation: LedgerOperation, group_commit: bool):
+    if group_commit and not in_unit_of_work():
+        return await LedgerCommitter.submit(operation)
+    async with session_scope() as session:
+        result = await operation(session)
+        await _write_journal(session)
+        return result
 
 
 class ScoreOperate:
@@ -49,10 +420,28 @@ class ScoreOperate:
         删除用户积分
         :param telegram_id: Telegram ID
         """
-        async with ScoreSessionFactory() as session:
-            async with session.begin():
-                await session.execute(delete(ScoreModel).filter(ScoreModel.telegram_id == telegram_id))
-                await session.execute(delete(RedPacketModel).filter(RedPacketModel.telegram_id == telegram_id))
+        async with session_scope() as session:
+            await session.execute(delete(ScoreModel).filter(ScoreModel.telegram_id == telegram_id))
+            await session.execute(delete(RedPacketShareModel).filter(RedPacketShareModel.packet_id.in_(
+                    select(RedPacketModel.id).filter(RedPacketModel.telegram_id == telegram_id))))
+            await session.execute(delete(RedPacketModel).filter(RedPacketModel.telegram_id == telegram_id))
+            on_commit(session, ScoreLeaderboard.invalidate)
+        _discard_scores(telegram_id)
+    
+    @staticmethod
+    async def move(old_id: int, new_id: int):
+        """
+        将积分与发出的红包迁移到新的 Telegram ID
+        :param old_id: 原 Telegram ID
+        :param new_id: 新 Telegram ID
+        """
+        async with session_scope() as session:
+            await session.execute(update(ScoreModel).filter(ScoreModel.telegram_id == old_id).values(
+                    telegram_id=new_id))
+            await session.execute(update(RedPacketModel).filter(RedPacketModel.telegram_id == old_id).values(
+                    telegram_id=new_id))
+            on_commit(session, ScoreLeaderboard.invalidate)
+        _discard_scores(old_id, new_id)
     
     @staticmethod
     async def add_score(score_data: ScoreModel) -> ScoreModel:
@@ -60,22 +449,29 @@ class ScoreOperate:
         添加积分到数据库
         :param score_data: 积分数据
         """
-        async with ScoreSessionFactory() as session:
-            async with session.begin():
-                session.add(score_data)
+        async with session_scope() as session:
+            session.add(score_data)
+            on_commit(session, ScoreLeaderboard.invalidate)
+        if scope := current_scope():
+            scope.put(ScoreModel, score_data.telegram_id, score_data)
         return score_data
     
     @staticmethod
     async def get_score(telegram_id: int) -> ScoreModel | None:
         """
-        获取积分
+        获取积分 同一 update 内只加载一次
         :param telegram_id: Telegram ID
         :return: 积分
         """
-        async with ScoreSessionFactory() as session:
-            async with session.begin():
-                scalar = await session.execute(select(ScoreModel).filter(ScoreModel.telegram_id == telegram_id).limit(1))
-                return scalar.scalar_one_or_none()
+        scope = current_scope()
+        if scope and (score := scope.get(ScoreModel, telegram_id)):
+            return score
+        async with session_scope() as session:
+            scalar = await session.execute(select(ScoreModel).filter(ScoreModel.telegram_id == telegram_id).limit(1))
+            score = scalar.scalar_one_or_none()
+        if scope and score:
+            score = scope.add(ScoreModel, telegram_id, score)
+        return score
     
     @staticmethod
     async def change_score(telegram_id: int, change_score: int) -> None:
@@ -84,10 +480,11 @@ class ScoreOperate:
         :param telegram_id: Telegram ID
         :param change_score: 待变化的积分
         """
-        async with ScoreSessionFactory() as session:
-            async with session.begin():
-                await session.execute(update(ScoreModel).filter(ScoreModel.telegram_id == telegram_id).values(
-                        score=ScoreModel.score + change_score))
+        async with session_scope() as session:
+            await session.execute(update(ScoreModel).filter(ScoreModel.telegram_id == telegram_id).values(
+                    score=ScoreModel.score + change_score))
+            on_commit(session, ScoreLeaderboard.invalidate)
+        _discard_scores(telegram_id)
     
     @staticmethod
     async def update_score(score_data: ScoreModel):
@@ -95,9 +492,11 @@ class ScoreOperate:
         更新积分数据
         :param score_data: 积分数据
         """
-        async with ScoreSessionFactory() as session:
-            async with session.begin():
-                await session.merge(score_data)
+        async with session_scope() as session:
+            await session.merge(score_data)
+            on_commit(session, ScoreLeaderboard.invalidate)
+        if scope := current_scope():
+            scope.put(ScoreModel, score_data.telegram_id, score_data)
     
     @staticmethod
     async def add_red_packet(red_packet_data: RedPacketModel):
@@ -105,9 +504,8 @@ class ScoreOperate:
         添加红包到数据库
         :param red_packet_data: 红包数据
         """
-        async with ScoreSessionFactory() as session:
-            async with session.begin():
-                session.add(red_packet_data)
+        async with session_scope() as session:
+            session.add(red_packet_data)
     
     @staticmethod
     async def get_red_packet(red_packet_id: int) -> RedPacketModel | None:
@@ -116,10 +514,9 @@ class ScoreOperate:
         :param red_packet_id: 红包 ID
         :return: 红包
         """
-        async with ScoreSessionFactory() as session:
-            async with session.begin():
-                scalar = await session.execute(select(RedPacketModel).filter(RedPacketModel.id == red_packet_id).limit(1))
-                return scalar.scalar_one_or_none()
+        async with session_scope() as session:
+            scalar = await session.execute(select(RedPacketModel).filter(RedPacketModel.id == red_packet_id).limit(1))
+            return scalar.scalar_one_or_none()
     
     @staticmethod
     async def update_red_packet(red_packet_data: RedPacketModel):
@@ -127,16 +524,253 @@ class ScoreOperate:
         更新红包数据
         :param red_packet_data: 红包数据
         """
-        async with ScoreSessionFactory() as session:
-            async with session.begin():
-                await session.merge(red_packet_data)
+        async with session_scope() as session:
+            await session.merge(red_packet_data)
     
     @staticmethod
     async def rank(limit: Optional[int] = 20) -> Sequence[ScoreModel]:
         """
-        获取积分排行榜
+        获取积分排行榜 需要用户名时使用 leaderboard
+        """
+        async with session_scope() as session:
+            scalar = await session.execute(select(ScoreModel).order_by(ScoreModel.score.desc()).limit(limit))
+            return scalar.scalars().all()
+    
+    @staticmethod
+    async def leaderboard(limit: int = 20) -> list[tuple[int, str | None, int]]:
+        """
+        获取带用户名的积分排行榜 由内存中的排行榜提供
+        :param limit: 名次数量
+        :return: [(Telegram ID, Telegram 昵称, 积分)]
+        """
+        return await ScoreLeaderboard.top(limit)
+    
+    @staticmethod
+    async def credit(telegram_id: int, amount: int, reason: LedgerReason, group_commit: bool = False) -> int:
+        """
+        增加积分 用户无积分记录时自动创建
+        :param telegram_id: Telegram ID
+        :param amount: 增加的积分
+        :param reason: 变动原因
+        :param group_commit: 是否使用组提交
+        :return: 变动后积分
+        """
+        balance = await _run_ledger(partial(_credit, telegram_id=telegram_id, amount=amount, reason=reason),
+                                    group_commit)
+        _discard_scores(telegram_id)
+        return balance
+    
+    @staticmethod
+    async def debit(telegram_id: int, amount: int, reason: LedgerReason, group_commit: bool = False) -> int | None:
+        """
+        扣除积分 仅在积分充足时扣除
+        :param telegram_id: Telegram ID
+        :param amount: 扣除的积分
+        :param reason: 变动原因
+        :param group_commit: 是否使用组提交
+        :return: 变动后积分 积分不足时返回 None
+        """
+        balance = await _run_ledger(partial(_debit, telegram_id=telegram_id, amount=amount, reason=reason),
+                                    group_commit)
+        _discard_scores(telegram_id)
+        return balance
+    
+    @staticmethod
+    async def transfer(from_id: int, to_id: int, amount: int, group_commit: bool = False) -> tuple[int, int] | None:
+        """
+        转账 扣除与增加在同一事务内完成
+        :param from_id: 转出者 Telegram ID
+        :param to_id: 接收者 Telegram ID
+        :param amount: 转账积分
+        :param group_commit: 是否使用组提交
+        :return: (转出者积分, 接收者积分) 积分不足时返回 None
+        """
+        balances = await _run_ledger(partial(_transfer, from_id=from_id, to_id=to_id, amount=amount), group_commit)
+        _discard_scores(from_id, to_id)
+        return balances
+    
+    @staticmethod
+    async def checkin(telegram_id: int, points: int, day_start: int, group_commit: bool = False) -> int | None:
+        """
+        签到 当天已经签到过则不做任何修改
+        :param telegram_id: Telegram ID
+        :param points: 签到获得的积分
+        :param day_start: 当天开始的时间戳
+        :param group_commit: 是否使用组提交
+        :return: 签到后积分 已签到时返回 None
+        """
+        balance = await _run_ledger(partial(_checkin, telegram_id=telegram_id, points=points, day_start=day_start),
+                                    group_commit)
+        _discard_scores(telegram_id)
+        return balance
+    
+    @staticmethod
+    async def create_red_packet(red_packet_data: RedPacketModel, shares: list[int]) -> int | None:
+        """
+        扣除发送者积分并添加红包
+        :param red_packet_data: 红包数据
+        :param shares: 每一份红包的金额
+        :return: 发送者剩余积分 积分不足时返回 None
+        """
+        shares = random.sample(shares, len(shares))
+        async with session_scope() as session:
+            balance = await _debit(session, red_packet_data.telegram_id, red_packet_data.amount,
+                                   LedgerReason.RED_PACKET)
+            if balance is not None:
+                session.add(red_packet_data)
+                await session.flush()
+                await session.execute(insert(RedPacketShareModel),
+                                      [{"packet_id": red_packet_data.id, "amount": amount} for amount in shares])
+                await _write_journal(session)
+        _discard_scores(red_packet_data.telegram_id)
+        return balance
+    
+    @staticmethod
+    async def claim_red_packet(packet_id: int, telegram_id: int, fullname: str,
+                               group_commit: bool = False) -> tuple[int, int] | None:
+        """
+        领取一份红包 领取、记账与红包余额更新在同一事务内完成
+        :param packet_id: 红包 ID
+        :param telegram_id: 领取者 Telegram ID
+        :param fullname: 领取者名字
+        :param group_commit: 是否使用组提交
+        :return: (领取的积分, 领取后积分) 红包已领完/已撤回/已经领取过时返回 None
+        """
+        claimed = await _run_ledger(partial(_claim_red_packet, packet_id=packet_id, telegram_id=telegram_id,
+                                            fullname=fullname), group_commit)
+        _discard_scores(telegram_id)
+        return claimed
+    
+    @staticmethod
+    async def has_claimed_red_packet(packet_id: int, telegram_id: int) -> bool:
+        """
+        是否已经领取过红包
+        :param packet_id: 红包 ID
+        :param telegram_id: Telegram ID
+        """
+        async with session_scope() as session:
+            scalar = await session.execute(select(RedPacketShareModel.id).filter(
+                    RedPacketShareModel.packet_id == packet_id, RedPacketShareModel.telegram_id == telegram_id))
+            return scalar.scalar_one_or_none() is not None
+    
+    @staticmethod
+    async def get_red_packet_claims(packet_id: int) -> Sequence[RedPacketShareModel]:
+        """
+        获取红包领取记录
+        :param packet_id: 红包 ID
+        """
+        async with session_scope() as session:
+            scalar = await session.execute(select(RedPacketShareModel).filter(
+                    RedPacketShareModel.packet_id == packet_id, RedPacketShareModel.telegram_id.is_not(None)
+            ).order_by(RedPacketShareModel.claim_time))
+            return scalar.scalars().all()
+    
+    @staticmethod
+    async def settle_red_packets() -> int:
+        """
+        将份额已经全部领取但仍为未领完状态的红包标记为已领完
+        :return: 更新的红包数量
+        """
+        remaining = exists().where(RedPacketShareModel.packet_id == RedPacketModel.id,
+                                   RedPacketShareModel.telegram_id.is_(None))
+        async with session_scope() as session:
+            result = await session.execute(update(RedPacketModel.__table__).where(
+                    RedPacketModel.status == 0, ~remaining).values(status=1))
+            return result.rowcount
+    
+    @staticmethod
+    async def set_red_packet_message(packet_id: int, chat_id: int, message_id: int):
+        """
+        记录红包消息 用于过期时编辑消息
+        :param packet_id: 红包 ID
+        :param chat_id: 聊天 ID
+        :param message_id: 消息 ID
+        """
+        async with session_scope() as session:
+            await session.execute(update(RedPacketModel).where(RedPacketModel.id == packet_id)
+                                  .values(chat_id=chat_id, message_id=message_id))
+    
+    @staticmethod
+    async def expire_red_packets(before: int, batch_size: int = 100) -> list[RedPacketModel]:
+        """
+        将 before 之前创建且未结束的红包标记为过期，并返还剩余积分
+        通过 (status, create_time) 索引只扫描过期的红包，每批在一个事务内完成
+        :param before: 时间戳
+        :param batch_size: 每个事务处理的红包数量
+        :return: 过期的红包 current_amount 为返还的积分
+        """
+        expired = []
+        expiring = select(RedPacketModel.id).where(RedPacketModel.status == 0, RedPacketModel.create_time < before) \
+            .order_by(RedPacketModel.create_time).limit(batch_size).scalar_subquery()
+        while True:
+            async with session_scope() as session:
+                scalar = await session.execute(update(RedPacketModel.__table__).where(
+                        RedPacketModel.id.in_(expiring)).values(status=3).returning(*RedPacketModel.__table__.c))
+                packets = [RedPacketModel(**row._mapping) for row in scalar]
+                if not packets:
+                    break
+                await session.execute(delete(RedPacketShareModel).where(
+                        RedPacketShareModel.packet_id.in_([packet.id for packet in packets]),
+                        RedPacketShareModel.telegram_id.is_(None)))
+                for packet in packets:
+                    if packet.current_amount > 0:
+                        await _credit(session, packet.telegram_id, packet.current_amount,
+                                      LedgerReason.RED_PACKET_EXPIRED)
+                await _write_journal(session)
+            _discard_scores(*{packet.telegram_id for packet in packets})
+            expired.extend(packets)
+        return expired
+    
+    @staticmethod
+    async def archive_red_packets(before: int, batch_size: int = 500) -> int:
+        """
+        将 before 之前创建且已经结束（领完/撤回/过期）的红包连同领取记录移入归档
+        :param before: 时间戳
+        :param batch_size: 每个事务处理的红包数量
+        :return: 归档的红包数量
+        """
+        finished = select(RedPacketModel).where(RedPacketModel.status.in_([1, 2, 3]),
+                                                RedPacketModel.create_time < before).limit(batch_size)
+        total = 0
+        while True:
+            async with session_scope() as session:
+                packets = (await session.execute(finished)).scalars().all()
+                if not packets:
+                    break
+                packet_ids = [packet.id for packet in packets]
+                claims: dict[int, list] = {}
+                for share in (await session.execute(select(RedPacketShareModel).where(
+                        RedPacketShareModel.packet_id.in_(packet_ids), RedPacketShareModel.telegram_id.is_not(None)
+                ).order_by(RedPacketShareModel.claim_time))).scalars():
+                    claims.setdefault(share.packet_id, []).append(
+                            [share.telegram_id, share.fullname, share.amount, share.claim_time])
+                await archive_rows(session, ArchiveKind.RED_PACKET, [
+                    (packet.id, str(packet.telegram_id), row_dict(packet) | {"claims": claims.get(packet.id, [])})
+                    for packet in packets])
+                await session.execute(delete(RedPacketShareModel).where(RedPacketShareModel.packet_id.in_(packet_ids)))
+                await session.execute(delete(RedPacketModel).where(RedPacketModel.id.in_(packet_ids)))
+            total += len(packets)
+        return total
+    
+    @staticmethod
+    async def withdraw_red_packet(packet_id: int, telegram_id: int) -> int | None:
+        """
+        撤回红包并返还剩余积分
+        :param packet_id: 红包 ID
+        :param telegram_id: 发送者 Telegram ID
+        :return: 返还的积分 红包不可撤回时返回 None
         """
-        async with ScoreSessionFactory() as session:
-            async with session.begin():
-                scalar = await session.execute(select(ScoreModel).order_by(ScoreModel.score.desc()).limit(limit))
-                return scalar.scalars().all()
+        async with session_scope() as session:
+            refund = (await session.execute(update(RedPacketModel.__table__).where(
+                    RedPacketModel.id == packet_id, RedPacketModel.telegram_id == telegram_id,
+                    RedPacketModel.status == 0
+            ).values(status=2).returning(RedPacketModel.current_amount))).scalar_one_or_none()
+            if refund is None:
+                return None
+            await session.execute(delete(RedPacketShareModel).where(
+                    RedPacketShareModel.packet_id == packet_id, RedPacketShareModel.telegram_id.is_(None)))
+            if refund > 0:
+                await _credit(session, telegram_id, refund, LedgerReason.RED_PACKET_REFUND)
+                await _write_journal(session)
+        _discard_scores(telegram_id)
+        return refund
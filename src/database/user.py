@@ -1,11 +1,15 @@
 from enum import Enum
+from functools import partial
+from typing import Sequence
 
-from sqlalchemy import delete, select, update
-from sqlalchemy.ext.asyncio import AsyncAttrs, async_sessionmaker, create_async_engine
+from sqlalchemy import Connection, column, delete, func, literal_column, or_, select, table, text, update
+from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 from src.config import Config
-from src.database import create_database
+from src.database import SessionFactory, create_database, in_unit_of_work, on_commit, session_scope
+from src.database.cache import LRUCache
+from src.database.scope import current_scope, register_flusher
 
 
 class UsersDatabaseModel(AsyncAttrs, DeclarativeBase):
@@ -25,53 +29,135 @@ class UserModel(UsersDatabaseModel):
     """用户"""
     __tablename__ = 'user'
     telegram_id: Mapped[int] = mapped_column(primary_key=True, index=True)  # Telegram ID
-    username: Mapped[str] = mapped_column(nullable=True)  # 用户名
-    fullname: Mapped[str] = mapped_column(nullable=True)  # TG 全名
+    username: Mapped[str] = mapped_column(nullable=True, index=True)  # 用户名
+    fullname: Mapped[str] = mapped_column(nullable=True, index=True)  # TG 全名
     role: Mapped[int] = mapped_column(default=Role.SEA.value)
     config: Mapped[str] = mapped_column(nullable=True)  # 用户配置 后期预留，可能塞json进去
     account: Mapped[str] = mapped_column(nullable=True)  # 账户
     password: Mapped[str] = mapped_column(nullable=True)  # 密码 hash
-    bind_id: Mapped[str] = mapped_column(nullable=True)  # 绑定的Emby账户ID
+    bind_id: Mapped[str] = mapped_column(nullable=True, index=True)  # 绑定的Emby账户ID
     data: Mapped[str] = mapped_column(nullable=True)  # 预留的其他配置
 
 
-create_database("users", UsersDatabaseModel)
-DATABASE_URL = f'sqlite+aiosqlite:///{Config.DATABASES_DIR / "users.db"}'
-ENGINE = create_async_engine(DATABASE_URL, echo=Config.SQLALCHEMY_LOG)
-UsersSessionFactory = async_sessionmaker(bind=ENGINE, expire_on_commit=False)
+def _create_user_search(connection: Connection):
+    """创建 bind_id/用户名索引与用户名的 FTS5 trigram 全文索引，全文索引由触发器与用户表保持同步"""
+    for index in UserModel.__table__.indexes:
+        index.create(connection, checkfirst=True)
+    connection.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS main.user_search USING fts5("
+                            "fullname, username, content='user', content_rowid='telegram_id', tokenize='trigram')"))
+    connection.execute(text("""
+        CREATE TRIGGER IF NOT EXISTS main.user_search_ai AFTER INSERT ON user BEGIN
+            INSERT INTO user_search(rowid, fullname, username) VALUES (new.telegram_id, new.fullname, new.username);
+        END"""))
+    connection.execute(text("""
+        CREATE TRIGGER IF NOT EXISTS main.user_search_ad AFTER DELETE ON user BEGIN
+            INSERT INTO user_search(user_search, rowid, fullname, username)
+            VALUES ('delete', old.telegram_id, old.fullname, old.username);
+        END"""))
+    connection.execute(text("""
+        CREATE TRIGGER IF NOT EXISTS main.user_search_au AFTER UPDATE OF telegram_id, fullname, username ON user BEGIN
+            INSERT INTO user_search(user_search, rowid, fullname, username)
+            VALUES ('delete', old.telegram_id, old.fullname, old.username);
+            INSERT INTO user_search(rowid, fullname, username) VALUES (new.telegram_id, new.fullname, new.username);
+        END"""))
+    connection.execute(text("INSERT INTO user_search(user_search) VALUES ('rebuild')"))
+
+
+create_database(UsersDatabaseModel, [_create_user_search])
+_user_search = table("user_search", column("rowid"), column("user_search"))
+UsersSessionFactory = SessionFactory
+UserCache = LRUCache(Config.USER_CACHE_SIZE, Config.USER_CACHE_TTL)  # telegram_id -> 用户列快照
+_user_columns = tuple(attr.key for attr in UserModel.__mapper__.column_attrs)
+
+
+def _snapshot(user: UserModel) -> dict:
+    return {key: getattr(user, key) for key in _user_columns}
+
+
+def _invalidate(session, telegram_id: int):
+    """修改后立即使缓存失效，提交后再失效一次，防止事务期间被其他读取回填旧数据"""
+    UserCache.invalidate(telegram_id)
+    on_commit(session, lambda: UserCache.invalidate(telegram_id))
+
+
+def _scoped(user: UserModel | None) -> UserModel | None:
+    """在 update 作用域内时返回该用户在作用域中的唯一对象"""
+    scope = current_scope()
+    if user is None or scope is None:
+        return user
+    return scope.add(UserModel, user.telegram_id, user, _snapshot(user))
 
 
 class UsersOperate:
     @staticmethod
-    async def add_user(user_data: UserModel):
+    async def add_user(user_data: UserModel) -> UserModel:
         """
         添加用户到数据库
         :param user_data: 用户数据
+        :return: 用户数据
         """
-        async with UsersSessionFactory() as session:
-            async with session.begin():
-                session.add(user_data)
+        async with session_scope() as session:
+            session.add(user_data)
+            _invalidate(session, user_data.telegram_id)
+        if scope := current_scope():
+            scope.put(UserModel, user_data.telegram_id, user_data, _snapshot(user_data))
+        return user_data
     
     @staticmethod
     async def get_user(telegram_id: int) -> UserModel | None:
         """
-        获取用户
+        获取用户 优先读取缓存，修改后需调用 update_user 保存
+        同一 update 内返回同一个对象，否则每次返回新的对象
         :param telegram_id: Telegram ID
         :return: 用户
         """
-        async with UsersSessionFactory() as session:
+        scope = current_scope()
+        if scope and (user := scope.get(UserModel, telegram_id)):
+            return user
+        snapshot = UserCache.get(telegram_id)
+        if snapshot is not None:
+            return _scoped(UserModel(**snapshot))
+        generation = UserCache.generation
+        async with session_scope() as session:
             scalar = await session.execute(select(UserModel).filter_by(telegram_id=telegram_id).limit(1))
-            return scalar.scalar_one_or_none()
+            user = scalar.scalar_one_or_none()
+        if user is not None and not in_unit_of_work():
+            UserCache.put(telegram_id, _snapshot(user), generation)
+        return _scoped(user)
     
     @staticmethod
     async def update_user(user_data: UserModel):
         """
-        更新用户数据
+        更新用户数据 在 update 作用域内时延迟到 update 结束统一写回，在 unit_of_work 内时直接加入其事务
         :param user_data: 用户数据
         """
-        async with UsersSessionFactory() as session:
-            async with session.begin():
-                await session.merge(user_data)
+        if (scope := current_scope()) and not in_unit_of_work():
+            return scope.mark_dirty(UserModel, user_data.telegram_id, user_data)
+        await UsersOperate.update_users([user_data])
+    
+    @staticmethod
+    async def update_users(users: Sequence[UserModel]):
+        """
+        在一个事务内批量更新用户数据
+        在 update 作用域内加载的用户只更新有变化的列，不覆盖期间其他地方的修改（如封禁、修改权限）
+        :param users: 用户数据列表
+        """
+        scope = current_scope()
+        async with session_scope() as session:
+            for user in users:
+                original = scope.original(UserModel, user.telegram_id) if scope else None
+                if original is None:
+                    merged = await session.merge(user)
+                    UserCache.invalidate(merged.telegram_id)
+                    on_commit(session, partial(UserCache.put, merged.telegram_id, _snapshot(merged)))
+                    continue
+                changes = {key: value for key, value in _snapshot(user).items() if value != original[key]}
+                if changes:
+                    await session.execute(update(UserModel).filter_by(telegram_id=user.telegram_id).values(**changes))
+                    _invalidate(session, user.telegram_id)
+        if scope:
+            for user in users:
+                scope.mark_clean(UserModel, user.telegram_id, _snapshot(user))
     
     @staticmethod
     async def clear_bind(telegram_id: int):
@@ -79,10 +165,12 @@ class UsersOperate:
         解绑用户
         :param telegram_id: 用户
         """
-        async with UsersSessionFactory() as session:
-            async with session.begin():
-                await session.execute(update(UserModel).filter_by(telegram_id=telegram_id).
-                                      values(account=None, password=None, bind_id=None))
+        async with session_scope() as session:
+            await session.execute(update(UserModel).filter_by(telegram_id=telegram_id).
+                                  values(account=None, password=None, bind_id=None))
+            _invalidate(session, telegram_id)
+        if (scope := current_scope()) and (user := scope.get(UserModel, telegram_id)):
+            user.account, user.password, user.bind_id = None, None, None
     
     @staticmethod
     async def delete(telegram_id: int):
@@ -90,7 +178,63 @@ class UsersOperate:
         删除用户
         :param telegram_id: Telegram ID
         """
-        async with UsersSessionFactory() as session:
-            async with session.begin():
-                await session.execute(delete(UserModel).filter_by(telegram_id=telegram_id))
-                
\ No newline at end of file
+        async with session_scope() as session:
+            await session.execute(delete(UserModel).filter_by(telegram_id=telegram_id))
+            _invalidate(session, telegram_id)
+        if scope := current_scope():
+            scope.discard(UserModel, telegram_id)
+                
+    
+    @staticmethod
+    async def move(old_id: int, new_id: int):
+        """
+        将用户迁移到新的 Telegram ID
+        :param old_id: 原 Telegram ID
+        :param new_id: 新 Telegram ID
+        """
+        async with session_scope() as session:
+            await session.execute(update(UserModel).filter_by(telegram_id=old_id).values(telegram_id=new_id))
+            _invalidate(session, old_id)
+            _invalidate(session, new_id)
+        if scope := current_scope():
+            scope.discard(UserModel, old_id)
+            scope.discard(UserModel, new_id)
+    
+    @staticmethod
+    async def get_user_by_bind_id(bind_id: str) -> UserModel | None:
+        """
+        通过绑定的Emby账户ID获取用户
+        :param bind_id: Emby账户ID
+        :return: 用户
+        """
+        async with session_scope() as session:
+            scalar = await session.execute(select(UserModel).filter_by(bind_id=bind_id).limit(1))
+            return _scoped(scalar.scalar_one_or_none())
+    
+    @staticmethod
+    async def search_users(keyword: str, limit: int = 10) -> Sequence[UserModel]:
+        """
+        按 Telegram 全名/用户名模糊搜索用户 有完全匹配时只返回完全匹配的用户，否则按相关度排序
+        :param keyword: 关键词
+        :param limit: 最多返回的数量
+        :return: 候选用户列表
+        """
+        exact = or_(UserModel.fullname == keyword, UserModel.username == keyword)
+        async with session_scope() as session:
+            # 完全匹配走普通索引，无需全文检索
+            scalar = await session.execute(select(UserModel).filter(exact).limit(limit))
+            if users := scalar.scalars().all():
+                return [_scoped(user) for user in users]
+            if len(keyword) < 3:
+                # trigram 无法索引少于三个字符的关键词
+                pattern = f"%{keyword}%"
+                stmt = select(UserModel).filter(or_(UserModel.fullname.like(pattern), UserModel.username.like(pattern)))
+            else:
+                query = '"' + keyword.replace('"', '""') + '"'
+                stmt = select(UserModel).join(_user_search, _user_search.c.rowid == UserModel.telegram_id).filter(
+                        _user_search.c.user_search.match(query)).order_by(func.bm25(literal_column("user_search")))
+            scalar = await session.execute(stmt.limit(limit))
+            return [_scoped(user) for user in scalar.scalars().all()]
+
+
+register_flusher(UserModel, UsersOperate.update_users)
@@ -1,14 +1,16 @@
 from typing import Optional
 
+from src.emby.api.auth import Auth
 from src.emby.api.req import EmbyRequest
 from src.emby.api.system import System
 from src.emby.api.user import Users
 
 
 class EmbyAPI:
-    def __init__(self, url: str, auth: int, api_key: Optional[str] = None):
+    def __init__(self, url: str, auth: int, api_key: Optional[str] = None, directory_ttl: float = 600):
         super().__init__()
         self.EmbyReq = EmbyRequest(url, auth, api_key)
-        self.Users = Users(self.EmbyReq)
+        self.Users = Users(self.EmbyReq, directory_ttl)
         self.System = System(self.EmbyReq)
+        self.Auth = Auth(self.EmbyReq)
         
@@ -0,0 +1,48 @@
+import httpx
+
+from src.emby.api.req import EmbyRequest, gen_device_id
+from src.logger import emby_logger
+
+
+class Auth:
+    """
+    以普通用户身份校验 Emby 账号，复用共享客户端与连接池
+    用户身份只放在单次请求的请求头中，不修改共享客户端的请求头
+    """
+
+    def __init__(self, client: EmbyRequest):
+        self.client = client
+
+    async def authenticate(self, account: str, password: str) -> dict | None:
+        """
+        校验用户名与密码 登录产生的临时 AccessToken 会立即注销
+        :param account: Emby 用户名
+        :param password: 密码
+        :return: Emby 用户信息，用户名或密码错误时返回 None
+        """
+        device_id = gen_device_id()
+        try:
+            response = await self.client.post("Users/authenticatebyname", json={
+                "Username": account,
+                "Pw": password
+            }, headers={"X-Emby-Device-Id": device_id}, omit_headers=("X-Emby-Token",))
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 401:
+                return None
+            raise
+        data = response.json()
+        if token := data.get("AccessToken"):
+            await self.logout(token, device_id)
+        return data.get("User")
+
+    async def logout(self, token: str, device_id: str):
+        """
+        注销临时 AccessToken，失败只记录日志
+        :param token: AccessToken
+        :param device_id: 登录时使用的设备ID
+        """
+        try:
+            await self.client.post("Sessions/Logout", headers={"X-Emby-Token": token, "X-Emby-Device-Id": device_id},
+                                   retries=0)
+        except Exception as e:
+            emby_logger.warning(f"Logout failed: {e!r}")
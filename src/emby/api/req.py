@@ -1,12 +1,111 @@
+import asyncio
+import random
+import time
 import uuid
+from enum import Enum
 from functools import wraps
 from typing import Any, Dict, Optional
 
 import httpx
 from httpx import Response
 
+from src.config import Config, EmbyConfig, HttpConfig
+from src.http_client import create_client
 from src.logger import emby_logger
 
+DEFAULT_TIMEOUT = httpx.Timeout(10.0, connect=5.0)
+# 按路径设置的超时，未列出的使用 DEFAULT_TIMEOUT
+ENDPOINT_TIMEOUTS = {
+    "System/Info/Public": httpx.Timeout(3.0),  # 连通性检查，需要快速失败
+    "Users": httpx.Timeout(30.0, connect=5.0),  # 全部用户，用户多时响应很大
+}
+IDEMPOTENT_METHODS = frozenset({"GET", "PUT", "DELETE"})
+RETRY_STATUS = frozenset({502, 503, 504})  # 视为服务端暂时不可用的状态码
+RETRY_BACKOFF = 0.5  # 第一次重试的最大等待秒数，之后每次翻倍
+RETRY_BACKOFF_MAX = 5.0
+
+
+def endpoint_timeout(path: str) -> httpx.Timeout:
+    return ENDPOINT_TIMEOUTS.get(path.strip("/"), DEFAULT_TIMEOUT)
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    带随机抖动的指数退避，避免大量请求同时重试
+    :param attempt: 已失败的次数，从 0 开始
+    """
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** attempt))
+
+
+class CircuitState(Enum):
+    CLOSED = "closed"  # 正常
+    OPEN = "open"  # 熔断，直接失败
+    HALF_OPEN = "half_open"  # 放行一个探测请求
+
+
+class CircuitOpenError(Exception):
+    """熔断期间不再请求 Emby，直接失败"""
+
+
+class CircuitBreaker:
+    """
+    连续失败达到阈值后熔断，等待 reset_timeout 秒后半开，只放行一个请求探测
+    探测成功则恢复，失败则继续熔断
+    失败按调用计数，一次调用的多次重试只算一次
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        """
+        :param failure_threshold: 熔断前允许的连续失败次数
+        :param reset_timeout: 熔断后多少秒开始探测
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CircuitState.CLOSED
+        self.failures = 0  # 连续失败次数
+        self.opened_at = 0.0
+        self.rejected = 0  # 熔断期间拒绝的请求数
+        self._probing = False
+
+    def before_request(self):
+        """请求前调用，熔断中时抛出 CircuitOpenError"""
+        if self.state is CircuitState.CLOSED:
+            return
+        if self.state is CircuitState.OPEN:
+            remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+            if remaining > 0:
+                self.rejected += 1
+                raise CircuitOpenError(f"Emby circuit open, retry in {remaining:.0f}s")
+            self.state = CircuitState.HALF_OPEN
+            self._probing = False
+        if self._probing:
+            self.rejected += 1
+            raise CircuitOpenError("Emby circuit half-open, probe in progress")
+        self._probing = True
+
+    def record_success(self):
+        if self.state is not CircuitState.CLOSED:
+            emby_logger.info("Emby circuit closed")
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.state is CircuitState.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state is not CircuitState.OPEN:
+                emby_logger.warning(f"Emby circuit opened after {self.failures} failures")
+            self.state = CircuitState.OPEN
+            self.opened_at = time.monotonic()
+
+    def release(self):
+        """请求被取消时调用，既不算成功也不算失败"""
+        self._probing = False
+
+    def stats(self) -> dict:
+        return {"state": self.state.value, "failures": self.failures, "rejected": self.rejected}
+
 
 def json_response(func):
     @wraps(func)
@@ -54,10 +153,11 @@ class EmbyRequest:
     def __init__(self, url: str, auth: int, api_key: Optional[str] = None):
         if not (url.endswith("emby") or url.endswith("emby/")):
             url += "/emby"
-        self.client = httpx.AsyncClient(base_url=url)
+        self.client = create_client(HttpConfig.EMBY_PROXY, base_url=url)
         self.api_key = api_key
         self.user_data = None
         self.user_id = None
+        self.breaker = CircuitBreaker(EmbyConfig.CIRCUIT_FAILURES, EmbyConfig.CIRCUIT_RESET)
 
         self.client.headers = {
             'X-Emby-Client': 'Telegram Bot',
@@ -70,56 +170,70 @@ class EmbyRequest:
         if auth == 1:  # API key
             self.client.headers['X-Emby-Token'] = api_key
 
-    async def login(self, account: str, password: str):
-        login_url = '/Users/authenticatebyname'
-        login_data = {
-            'Username': account,
-            'Pw': password
-        }
-        self.client.headers['X-Emby-Device-Id'] = gen_device_id()
-        response = await self.client.post(login_url, data=login_data)
-        emby_logger.info(f"Login {response.status_code} {response.text}")
-        if response.status_code == 200:
-            json_resp = response.json()
-            if token := json_resp.get('AccessToken'):
-                self.client.headers['X-Emby-Token'] = token
-                return json_resp
-            else:
-                raise ValueError("Login failed, no token")
-        else:
-            raise ValueError(f"Login failed, status code: {response.status_code}, response: {response.text}")
+    async def request(self, method: str, path: str, retries: int | None = None, omit_headers: tuple[str, ...] = (),
+                      **kwargs) -> Response:
+        """
+        发送请求，连接失败或服务端暂时不可用时重试
+        非幂等请求只在确定未发出（连接失败）时重试
+        :param method: HTTP 方法
+        :param path: 路径
+        :param retries: 最多重试次数，默认 Config.MAX_RETRY
+        :param omit_headers: 本次请求不发送的共享请求头，例如以其他用户身份请求时的 X-Emby-Token
+        """
+        kwargs.setdefault("timeout", endpoint_timeout(path))
+        request = self.client.build_request(method, path, **kwargs)
+        for header in omit_headers:
+            request.headers.pop(header, None)
+        idempotent = method in IDEMPOTENT_METHODS
+        attempts = max(Config.MAX_RETRY if retries is None else retries, 0) + 1
+        # 一次调用（含全部重试）只向熔断器记录一次结果，中间失败的尝试不计入
+        self.breaker.before_request()
+        try:
+            for attempt in range(attempts):
+                last = attempt + 1 == attempts
+                try:
+                    response = await self.client.send(request)
+                except httpx.TransportError as e:
+                    if last or not (idempotent or isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))):
+                        self.breaker.record_failure()
+                        raise
+                    emby_logger.warning(f"{method} {path} failed: {e!r}, retrying ({attempt + 1}/{attempts - 1})")
+                else:
+                    if response.status_code not in RETRY_STATUS:
+                        self.breaker.record_success()
+                        response.raise_for_status()
+                        emby_logger.info(f"{method} {path} {response.status_code}")
+                        return response
+                    if last or not idempotent:
+                        self.breaker.record_failure()
+                        response.raise_for_status()
+                    emby_logger.warning(
+                            f"{method} {path} {response.status_code}, retrying ({attempt + 1}/{attempts - 1})")
+                await asyncio.sleep(backoff_delay(attempt))
+        except BaseException:
+            # 取消等情况既不算成功也不算失败；已经记录过结果时没有影响
+            self.breaker.release()
+            raise
 
     @http_warp
     async def get(self, path: str, params: Optional[Dict[str, Any]] = None, headers: Optional[Dict[str, str]] = None,
                   **kwargs) -> Response:
-        response = await self.client.get(path, params=params, headers=headers, timeout=10, **kwargs)
-        response.raise_for_status()
-        emby_logger.info(f"GET {path} {response.status_code}")
-        return response
+        return await self.request("GET", path, params=params, headers=headers, **kwargs)
 
     @http_warp
     async def post(self, path: str, params: Optional[Dict[str, Any]] = None, headers: Optional[Dict[str, str]] = None,
                    json: Optional[Dict[str, Any]] = None, **kwargs) -> Response:
-        response = await self.client.post(path, params=params, headers=headers, data=json, timeout=10, **kwargs)
-        response.raise_for_status()
-        emby_logger.info(f"POST {path} {response.status_code}")
-        return response
+        return await self.request("POST", path, params=params, headers=headers, data=json, **kwargs)
 
     @http_warp
     async def put(self, path: str, params: Optional[Dict[str, Any]] = None, headers: Optional[Dict[str, str]] = None,
                   json: Optional[Dict[str, Any]] = None, **kwargs) -> Response:
-        response = await self.client.put(path, params=params, headers=headers, data=json, timeout=10, **kwargs)
-        response.raise_for_status()
-        emby_logger.info(f"PUT {path} {response.status_code}")
-        return response
+        return await self.request("PUT", path, params=params, headers=headers, data=json, **kwargs)
 
     @http_warp
     async def delete(self, path: str, params: Optional[Dict[str, Any]] = None, headers: Optional[Dict[str, str]] = None,
                      **kwargs) -> Response:
-        response = await self.client.delete(path, params=params, headers=headers, timeout=10, **kwargs)
-        response.raise_for_status()
-        emby_logger.info(f"DELETE {path} {response.status_code}")
-        return response
+        return await self.request("DELETE", path, params=params, headers=headers, **kwargs)
 
     async def close(self):
         await self.client.aclose()
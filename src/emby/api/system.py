@@ -12,4 +12,4 @@ class System:
         获取系统信息
         :return:
         """
-        return await self.client.get("System/Info/Public")
+        return await self.client.get("System/Info/Public", retries=0)  # 用于连通性检查，不重试
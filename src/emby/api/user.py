@@ -1,7 +1,10 @@
-from typing import Optional
+import asyncio
+import time
+from typing import Awaitable, Callable, Optional
 
 from src.emby.api import EmbyRequest
 from src.emby.api.req import bool_response, json_response
+from src.logger import emby_logger
 
 
 def info():
@@ -15,9 +18,146 @@ def info():
     )
 
 
+MISS_REFRESH_INTERVAL = 60  # 查询未命中时，距上次刷新超过该秒数则在后台刷新
+
+
+class UserDirectory:
+    """
+    Emby 用户目录缓存，按 Id 与忽略大小写的用户名索引
+    由定时任务整体刷新，Bot 自己创建/删除用户时直接更新；刷新期间的变更在刷新完成后重放
+    """
+
+    def __init__(self, loader: Callable[[], Awaitable[list[dict]]], ttl: float = 600):
+        """
+        :param loader: 获取全部用户的函数
+        :param ttl: 超过该秒数未刷新时，查询会在后台触发刷新
+        """
+        self.loader = loader
+        self.ttl = ttl
+        self.loaded_at: float | None = None  # 上次刷新完成的 monotonic 时间
+        self.refreshes = 0
+        self.hits = 0
+        self.misses = 0
+        self._by_id: dict[str, dict] = {}
+        self._by_name: dict[str, str] = {}  # casefold 用户名 -> Id
+        self._pending: list[tuple[str, dict | str]] | None = None  # 刷新期间的变更
+        self._refresh_task: asyncio.Task | None = None
+
+    def _add(self, user: dict):
+        if old := self._by_id.get(user["Id"]):
+            self._by_name.pop(old["Name"].casefold(), None)
+        self._by_id[user["Id"]] = user
+        self._by_name[user["Name"].casefold()] = user["Id"]
+
+    def _discard(self, user_id: str):
+        if user := self._by_id.pop(user_id, None):
+            self._by_name.pop(user["Name"].casefold(), None)
+
+    def add(self, user: dict):
+        """
+        记录新建或修改后的用户
+        :param user: Emby 用户信息
+        """
+        self._add(user)
+        if self._pending is not None:
+            self._pending.append(("add", user))
+
+    def discard(self, user_id: str):
+        """
+        移除已删除的用户
+        :param user_id: 用户Id
+        """
+        self._discard(user_id)
+        if self._pending is not None:
+            self._pending.append(("discard", user_id))
+
+    async def refresh(self) -> int:
+        """
+        重新下载全部用户并重建索引 同一时间只执行一次
+        :return: 用户数量
+        """
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._refresh())
+        return await asyncio.shield(self._refresh_task)
+
+    async def _refresh(self) -> int:
+        self._pending = []
+        try:
+            users = await self.loader()
+            self._by_id, self._by_name = {}, {}
+            for user in users:
+                self._add(user)
+            for action, value in self._pending:
+                if action == "add":
+                    self._add(value)
+                else:
+                    self._discard(value)
+        finally:
+            self._pending = None
+        self.loaded_at = time.monotonic()
+        self.refreshes += 1
+        return len(self._by_id)
+
+    def _log_failure(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            emby_logger.warning(f"Refresh user directory failed: {task.exception()!r}")
+
+    def _refresh_in_background(self, min_age: float):
+        if self._refresh_task is not None and not self._refresh_task.done():
+            return
+        if time.monotonic() - self.loaded_at <= min_age:
+            return
+        self._refresh_task = asyncio.create_task(self._refresh())
+        self._refresh_task.add_done_callback(self._log_failure)
+
+    async def _ensure_loaded(self):
+        if self.loaded_at is None:
+            # 首次使用时只能等待下载
+            await self.refresh()
+        else:
+            self._refresh_in_background(self.ttl)
+
+    async def get(self, user_id: str) -> dict | None:
+        """
+        按 Id 查找用户
+        :param user_id: 用户Id
+        """
+        await self._ensure_loaded()
+        user = self._by_id.get(user_id)
+        if user is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return user
+
+    async def find(self, name: str) -> dict | None:
+        """
+        按用户名查找用户，忽略大小写
+        未找到时可能是在 Emby 后台新建的用户，在后台提前刷新
+        :param name: Emby 用户名
+        """
+        await self._ensure_loaded()
+        if user_id := self._by_name.get(name.casefold()):
+            self.hits += 1
+            return self._by_id[user_id]
+        self.misses += 1
+        self._refresh_in_background(MISS_REFRESH_INTERVAL)
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._by_id),
+            "age": round(time.monotonic() - self.loaded_at, 1) if self.loaded_at is not None else None,
+            "refreshes": self.refreshes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
 class Users:
-    def __init__(self, client: EmbyRequest):
+    def __init__(self, client: EmbyRequest, directory_ttl: float = 600):
         self.client = client
+        self.directory = UserDirectory(self.get_users, directory_ttl)
     
     @json_response
     async def get_user(self, user_id: Optional[str] = "{UserID}"):
@@ -53,13 +193,18 @@ class Users:
             "client": client
         })
     
-    @bool_response
     async def delete_user(self, user_id: Optional[str] = "{UserID}"):
         """
         删除用户
         :param user_id: 用户ID
         :return: bool
         """
+        if deleted := await self._delete_user(user_id):
+            self.directory.discard(user_id)
+        return deleted
+
+    @bool_response
+    async def _delete_user(self, user_id: str):
         return await self.client.delete(f'Users/{user_id}')
     
     @json_response
@@ -83,13 +228,18 @@ class Users:
             "fields": fields
         })
     
-    @json_response
     async def new_user(self, name: str):
         """
         创建新用户
         :param name:
         :return:
         """
+        user = await self._new_user(name)
+        self.directory.add(user)
+        return user
+
+    @json_response
+    async def _new_user(self, name: str):
         return await self.client.post("Users/New", json={
             "Name": name,
         })
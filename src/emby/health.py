@@ -0,0 +1,84 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+from src.logger import emby_logger
+
+
+class HealthProber:
+    """
+    在后台定时探测服务器，命令处理只读取缓存的状态，不在用户请求中等待网络
+    状态只由探测任务写入
+    """
+
+    def __init__(self, probe: Callable[[], Awaitable[dict]], interval: float, down_interval: float,
+                 history_size: int = 20):
+        """
+        :param probe: 探测函数，失败时抛出异常
+        :param interval: 服务器正常时的探测间隔（秒）
+        :param down_interval: 服务器异常时的探测间隔（秒），用于尽快发现恢复
+        :param history_size: 保留的探测记录数
+        """
+        self.probe = probe
+        self.interval = interval
+        self.down_interval = down_interval
+        self.up: bool | None = None  # 尚未探测时为 None
+        self.latency: float | None = None  # 上次成功探测的耗时（毫秒）
+        self.last_check: float | None = None  # 上次探测的时间戳
+        self.since: float | None = None  # 当前状态开始的时间戳
+        self.last_error: str | None = None
+        self.info: dict = {}  # 上次成功探测返回的服务器信息
+        self.history: deque[tuple[float, bool, float]] = deque(maxlen=history_size)  # (时间戳, 是否正常, 耗时毫秒)
+        self._task: asyncio.Task | None = None
+
+    def is_up(self) -> bool:
+        """服务器是否可用 尚未探测时视为可用"""
+        return self.up is not False
+
+    def availability(self) -> float | None:
+        """最近探测记录中正常的比例"""
+        if not self.history:
+            return None
+        return sum(ok for _, ok, _ in self.history) / len(self.history)
+
+    async def check(self) -> bool:
+        """执行一次探测并更新状态"""
+        start = time.perf_counter()
+        try:
+            info = await self.probe()
+            ok, error = bool(info), None if info else "empty response"
+        except Exception as e:
+            info, ok, error = None, False, repr(e)
+        elapsed = (time.perf_counter() - start) * 1000
+        now = time.time()
+        if ok != self.up:
+            if self.up is not None:
+                log = emby_logger.info if ok else emby_logger.warning
+                log(f"Server is {'up' if ok else 'down'}{f': {error}' if error else ''}")
+            self.since = now
+        self.up, self.last_check, self.last_error = ok, now, error
+        if ok:
+            self.latency, self.info = elapsed, info
+        self.history.append((now, ok, elapsed))
+        return ok
+
+    async def _run(self):
+        while True:
+            await self.check()
+            await asyncio.sleep(self.interval if self.up else self.down_interval)
+
+    def start(self):
+        """启动后台探测任务"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="health_prober")
+
+    async def stop(self):
+        """停止后台探测任务"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,73 @@
+import importlib.util
+
+import httpx
+
+from src.config import Config, HttpConfig
+from src.logger import bot_logger
+
+_transports: dict[str | None, httpx.AsyncHTTPTransport] = {}  # 代理 -> 连接池
+
+
+def resolve_proxy(proxy: str | None) -> str | None:
+    """
+    计算客户端使用的代理
+    :param proxy: 客户端的代理配置，留空使用 Config.PROXY，direct 为不使用代理
+    """
+    if not proxy:
+        proxy = Config.PROXY
+    return None if not proxy or proxy == "direct" else proxy
+
+
+def http2_enabled() -> bool:
+    if not HttpConfig.HTTP2:
+        return False
+    if importlib.util.find_spec("h2") is None:
+        bot_logger.warning("HTTP/2 is enabled but h2 is not installed, install httpx[http2]")
+        HttpConfig.HTTP2 = False
+        return False
+    return True
+
+
+def shared_transport(proxy: str | None) -> httpx.AsyncHTTPTransport:
+    """
+    同一代理的客户端共用一个连接池
+    :param proxy: 代理地址，None 为直连
+    """
+    if (transport := _transports.get(proxy)) is None:
+        transport = _transports[proxy] = httpx.AsyncHTTPTransport(
+                http2=http2_enabled(),
+                limits=httpx.Limits(max_connections=HttpConfig.MAX_CONNECTIONS,
+                                    max_keepalive_connections=HttpConfig.MAX_KEEPALIVE_CONNECTIONS,
+                                    keepalive_expiry=HttpConfig.KEEPALIVE_EXPIRY),
+                proxy=proxy)
+    return transport
+
+
+class SharedTransport(httpx.AsyncBaseTransport):
+    """关闭客户端时不关闭共享的连接池，连接池由 close_transports 统一关闭"""
+
+    def __init__(self, transport: httpx.AsyncHTTPTransport):
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self.transport.handle_async_request(request)
+
+    async def aclose(self):
+        pass
+
+
+def create_client(proxy: str | None = None, **kwargs) -> httpx.AsyncClient:
+    """
+    创建使用共享连接池的客户端 不读取环境变量中的代理
+    :param proxy: 客户端的代理配置，见 resolve_proxy
+    """
+    return httpx.AsyncClient(transport=SharedTransport(shared_transport(resolve_proxy(proxy))), trust_env=False,
+                             **kwargs)
+
+
+async def close_transports():
+    """关闭全部共享连接池，在程序退出时调用"""
+    transports = list(_transports.values())
+    _transports.clear()
+    for transport in transports:
+        await transport.aclose()
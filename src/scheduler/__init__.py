@@ -0,0 +1,101 @@
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from telegram.ext import ContextTypes, JobQueue
+
+from src.config import EmbyConfig, SchedulerConfig
+from src.logger import scheduler_logger
+
+
+class JobStats:
+    """单个定时任务的运行记录"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.runs = 0  # 运行次数
+        self.failures = 0  # 失败次数
+        self.last_run: float | None = None  # 上次运行的时间戳
+        self.last_duration = 0.0  # 上次运行耗时（秒）
+        self.last_rows = 0  # 上次影响的行数
+        self.total_rows = 0  # 累计影响的行数
+        self.last_error: str | None = None
+
+    def to_dict(self) -> dict:
+        return dict(vars(self))
+
+
+JOB_STATS: dict[str, JobStats] = {}
+
+
+def maintenance_job(func):
+    """
+    记录任务的运行时间与影响行数，任务返回影响的行数
+    异常只记录不抛出，不影响下一次运行
+    """
+    stats = JOB_STATS.setdefault(func.__name__, JobStats(func.__name__))
+
+    @wraps(func)
+    async def wrapper(context: ContextTypes.DEFAULT_TYPE):
+        stats.last_run = time.time()
+        start = time.perf_counter()
+        try:
+            rows = await func(context)
+        except Exception as e:
+            stats.failures += 1
+            stats.last_error = repr(e)
+            scheduler_logger.exception(f"Job {stats.name} failed")
+            return
+        finally:
+            stats.runs += 1
+            stats.last_duration = time.perf_counter() - start
+        stats.last_rows = rows
+        stats.total_rows += rows
+        stats.last_error = None
+        scheduler_logger.info(f"Job {stats.name} finished in {stats.last_duration:.3f}s, {rows} rows")
+
+    return wrapper
+
+
+@contextmanager
+def paused_jobs(job_queue: JobQueue | None):
+    """
+    暂停全部定时任务，退出时恢复 正在运行的任务不会被中断，由数据库的维护入口等待其结束
+    :param job_queue: Application.job_queue
+    """
+    jobs = [job for job in job_queue.jobs() if job.enabled] if job_queue else []
+    for job in jobs:
+        job.enabled = False
+    try:
+        yield
+    finally:
+        for job in jobs:
+            job.enabled = True
+
+
+def start_scheduler(job_queue: JobQueue | None):
+    """
+    在 Bot 的 JobQueue 上注册定时维护任务
+    :param job_queue: Application.job_queue 未安装 job-queue 依赖时为 None
+    """
+    if not SchedulerConfig.ENABLE:
+        return
+    if job_queue is None:
+        scheduler_logger.warning("JobQueue is not available, install python-telegram-bot[job-queue]")
+        return
+    from .backup import backup
+    from .clean import archive, expire_red_packets, optimize, purge_cdk, settle_red_packets
+    from .emby import refresh_emby_users
+
+    scheduler_logger.info("Starting scheduler...")
+    job_queue.run_repeating(refresh_emby_users, interval=EmbyConfig.USER_DIRECTORY_REFRESH, first=5,
+                            name="refresh_emby_users")
+    job_queue.run_repeating(purge_cdk, interval=SchedulerConfig.CLEAN_INTERVAL, first=60, name="purge_cdk")
+    job_queue.run_repeating(settle_red_packets, interval=SchedulerConfig.CLEAN_INTERVAL, first=90,
+                            name="settle_red_packets")
+    job_queue.run_repeating(expire_red_packets, interval=SchedulerConfig.CLEAN_INTERVAL, first=120,
+                            name="expire_red_packets")
+    job_queue.run_repeating(archive, interval=SchedulerConfig.OPTIMIZE_INTERVAL, first=240, name="archive")
+    job_queue.run_repeating(optimize, interval=SchedulerConfig.OPTIMIZE_INTERVAL, first=300, name="optimize")
+    if SchedulerConfig.BACKUP_INTERVAL > 0:
+        job_queue.run_repeating(backup, interval=SchedulerConfig.BACKUP_INTERVAL, first=600, name="backup")
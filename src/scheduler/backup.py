@@ -0,0 +1,16 @@
+from telegram.ext import ContextTypes
+
+from src.database.backup import backup_databases
+from src.logger import scheduler_logger
+from src.scheduler import maintenance_job
+
+
+# noinspection PyUnusedLocal
+@maintenance_job
+async def backup(context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    在线备份全部数据库 返回备份的数据库数量
+    """
+    path = await backup_databases()
+    scheduler_logger.info(f"Databases backed up to {path}")
+    return len(list(path.glob("*.db.gz")))
@@ -1,10 +1,84 @@
+from datetime import datetime
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import ContextTypes
+
+from src.config import SchedulerConfig
+from src.database import optimize_database, pending_vacuum
+from src.database.bangumi import BangumiOperate
+from src.database.cdk import CdkOperate
+from src.database.score import RedPacketModel, ScoreOperate
 from src.logger import scheduler_logger
+from src.scheduler import maintenance_job
+
+
+# noinspection PyUnusedLocal
+@maintenance_job
+async def purge_cdk(context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    将过期或用完超过保留天数的注册码移入归档
+    """
+    before = int(datetime.now().timestamp()) - SchedulerConfig.CDK_RETENTION_DAYS * 86400
+    return await CdkOperate.purge_cdk(before)
+
+
+# noinspection PyUnusedLocal
+@maintenance_job
+async def settle_red_packets(context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    结算已经领完但状态未更新的红包
+    """
+    return await ScoreOperate.settle_red_packets()
+
+
+async def _edit_expired_packet(context: ContextTypes.DEFAULT_TYPE, packet: RedPacketModel):
+    text = f"红包已过期，总积分{packet.amount}, 数量{packet.count}，剩余{packet.current_amount}积分已经返还"
+    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("查看红包详情", callback_data=f'redinfo_{packet.id}')]])
+    try:
+        try:
+            await context.bot.edit_message_text(text, packet.chat_id, packet.message_id, reply_markup=reply_markup)
+        except BadRequest:
+            # 带图片的红包消息只能编辑说明
+            await context.bot.edit_message_caption(packet.chat_id, packet.message_id, caption=text,
+                                                   reply_markup=reply_markup)
+    except TelegramError as e:
+        scheduler_logger.warning(f"Failed to edit expired red packet {packet.id}: {e}")
+
+
+@maintenance_job
+async def expire_red_packets(context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    过期超过有效期的红包，返还剩余积分并编辑红包消息
+    """
+    if SchedulerConfig.RED_PACKET_TTL <= 0:
+        return 0
+    before = int(datetime.now().timestamp()) - SchedulerConfig.RED_PACKET_TTL
+    packets = await ScoreOperate.expire_red_packets(before)
+    for packet in packets:
+        if packet.chat_id and packet.message_id:
+            await _edit_expired_packet(context, packet)
+    return len(packets)
+
+
+# noinspection PyUnusedLocal
+@maintenance_job
+async def archive(context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    将已结束超过指定天数的红包与番剧请求移入归档
+    """
+    if SchedulerConfig.ARCHIVE_AFTER_DAYS <= 0:
+        return 0
+    before = int(datetime.now().timestamp()) - SchedulerConfig.ARCHIVE_AFTER_DAYS * 86400
+    return await ScoreOperate.archive_red_packets(before) + await BangumiOperate.archive_requires(before)
 
 
-def clean_memory():
+# noinspection PyUnusedLocal
+@maintenance_job
+async def optimize(context: ContextTypes.DEFAULT_TYPE) -> int:
     """
-    清理内存
+    回收空闲页并更新查询优化器的统计信息 返回回收的页数
     """
-    import gc
-    gc.collect()
-    scheduler_logger.info("Memory cleaned")
+    if names := await pending_vacuum():
+        scheduler_logger.warning(f"Incremental vacuum is off for {', '.join(names)}, run /vacuum once to enable it")
+    return sum((await optimize_database()).values())
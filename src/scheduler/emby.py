@@ -0,0 +1,13 @@
+from telegram.ext import ContextTypes
+
+from src.scheduler import maintenance_job
+from src.utils import EmbyClient
+
+
+# noinspection PyUnusedLocal
+@maintenance_job
+async def refresh_emby_users(context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    刷新 Emby 用户目录缓存 返回用户数量
+    """
+    return await EmbyClient.Users.directory.refresh()
@@ -1,42 +1,35 @@
 import base64
+import functools
 import hashlib
-import json
 import logging
 import re
 import subprocess
 from datetime import datetime, timezone
-from typing import Optional
+from typing import Optional, Sequence
 
 import numpy as np
 import pytz
-from sqlalchemy import or_, select
 
 from src.bangumi import BangumiAPI
 from src.config import Config, EmbyConfig
-from src.database.cdk import CdkModel
-from src.database.user import UserModel, UsersOperate, UsersSessionFactory
+from src.database.cdk import CdkModel, CdkOperate
+from src.database.user import UserModel, UsersOperate
 from src.emby.api import EmbyAPI
-from src.logger import bot_logger, emby_logger
+from src.emby.health import HealthProber
+from src.logger import bot_logger
 
 Bangumi_client = BangumiAPI(Config.BANGUMI_TOKEN)
-EmbyClient = EmbyAPI(EmbyConfig.BASE_URL, 1, EmbyConfig.API_KEY)
+EmbyClient = EmbyAPI(EmbyConfig.BASE_URL, 1, EmbyConfig.API_KEY, EmbyConfig.USER_DIRECTORY_REFRESH)
+EmbyHealth = HealthProber(EmbyClient.System.info, EmbyConfig.HEALTH_INTERVAL, EmbyConfig.HEALTH_DOWN_INTERVAL)
 
 
-# noinspection PyBroadException
 async def check_server_connectivity() -> bool:
     """
-    检查服务器连接性
+    立即检查服务器连接性，并更新 EmbyHealth 的状态
+    命令处理中请直接读取 EmbyHealth.is_up()
     :return: bool
     """
-    try:
-        info = await EmbyClient.System.info()
-        if info:
-            return True
-        else:
-            return False
-    except Exception as e:
-        emby_logger.error("check_server error: %s", e)
-        return False
+    return await EmbyHealth.check()
 
 
 def convert_to_china_timezone(time_data: Optional[int | str] = None) -> str:
@@ -83,42 +76,48 @@ def is_password_strong(password):
     return True
 
 
-async def get_user_info(username: str | int, only_tg_info: Optional[bool] = False) -> tuple[None, UserModel | None] | \
-                                                                                      tuple[None, None] | \
-                                                                                      tuple[None, UserModel]:
+USER_CANDIDATES = 5  # 按名字查找用户时最多列出的候选数量
+
+
+class AmbiguousUserError(Exception):
+    """按名字查找用户时匹配到多个用户，需要改用 Telegram ID"""
+
+    def __init__(self, keyword: str, candidates: Sequence[UserModel]):
+        super().__init__(f"{len(candidates)} users match {keyword}")
+        self.keyword = keyword
+        self.candidates = candidates
+
+
+async def get_user_info(username: str | int, only_tg_info: Optional[bool] = False,
+                        candidates: int = USER_CANDIDATES) -> tuple[None, UserModel | None] | \
+                                                               tuple[None, None] | \
+                                                               tuple[None, UserModel]:
     """
     获取用户信息
     :param username: Telegram ID/Fullname or Emby username
     :param only_tg_info: 是否只获取 Telegram 用户信息
+    :param candidates: 按名字查找时最多列出的候选数量，为 1 时直接使用排名第一的用户
     :return: Emby 用户信息, 用户数据库信息
+    :raise AmbiguousUserError: 名字匹配到多个用户
     """
     je_id = None
     jellyfin_user, user_info = None, None
 
-    async def fetch_user_id(f_username: str):
-        async with UsersSessionFactory() as f_session:
-            scalars = await f_session.execute(select(UserModel).filter(
-                or_(
-                    UserModel.fullname.like(f"%{f_username}%"),
-                    UserModel.username.like(f"%{f_username}%")
-                )
-            ).limit(1))
-            bot_logger.info(f"fetch_user_id: {scalars}")
-            return scalars.scalar_one_or_none()
-
     if isinstance(username, int) or username.isdigit():
         user_info = await UsersOperate.get_user(int(username))
         je_id = user_info.bind_id if user_info else None
     else:
-        user_info = await fetch_user_id(username)
+        matched = await UsersOperate.search_users(username, limit=candidates)
+        if len(matched) > 1:
+            raise AmbiguousUserError(username, matched)
+        user_info = matched[0] if matched else None
         if user_info:
             je_id = user_info.bind_id
     if only_tg_info and user_info:
         return None, user_info
     if not je_id:
         try:
-            all_user = await EmbyClient.Users.get_users()
-            je_data = next((u for u in all_user if u["Name"] == username), None)
+            je_data = await EmbyClient.Users.directory.find(str(username))
             je_id = je_data["Id"] if je_data else None
         except Exception as e:
             bot_logger.error(f"Error: {e}")
@@ -126,9 +125,7 @@ async def get_user_info(username: str | int, only_tg_info: Optional[bool] = Fals
     if je_id is not None:
         try:
             jellyfin_user = await EmbyClient.Users.get_user(je_id)
-            async with UsersSessionFactory() as session:
-                user_scalars = await session.execute(select(UserModel).filter_by(bind_id=je_id).limit(1))
-                user_info = user_scalars.scalar_one_or_none()
+            user_info = await UsersOperate.get_user_by_bind_id(je_id)
         except Exception as e:
             bot_logger.error(f"Error: {e}")
     return jellyfin_user, user_info
@@ -187,7 +184,9 @@ def is_integer(s):
         return False
 
 
+@functools.cache
 def get_latest_commit_info() -> str:
+    """当前版本的提交信息 更新时会重启进程，因此只需执行一次 git"""
     try:
         # 执行 git log -1 --oneline 命令
         result = subprocess.run(
@@ -202,15 +201,13 @@ def get_latest_commit_info() -> str:
         return ""
 
 
-def check_cdk(cdk: CdkModel, tg_id) -> bool:
+async def check_cdk(cdk: CdkModel, tg_id) -> bool:
     if cdk.limit <= 0:
         return False
     if cdk.expired_time != 0 and cdk.expired_time < datetime.now().timestamp():
         return False
-    if cdk.used_history:
-        history = json.loads(cdk.used_history)
-        if tg_id in [h["tg_id"] for h in history]:
-            return False
+    if await CdkOperate.is_used(cdk.id, tg_id):
+        return False
 
     return True
 
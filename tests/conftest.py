@@ -0,0 +1,122 @@
+import asyncio
+import json
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from src.config import Config  # noqa: E402
+
+# 必须在导入 src.database 之前设置，ENGINE 在导入时根据该路径创建
+Config.DATABASES_DIR = Path(tempfile.mkdtemp(prefix="bot-test-db-"))
+Config.BACKUP_DIR = Config.DATABASES_DIR / "backup"
+Config.LOGGING = False
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+async def reset_databases(seed: Callable[[Path], None] | None = None):
+    """
+    删除全部数据库文件后重新初始化
+    :param seed: 初始化前调用，用于写入旧版本的数据库
+    """
+    from src.database import ENGINE, Maintenance, init_database
+    from src.database.cdk import KnownCdks, CdkFilter
+    from src.database.score import ScoreLeaderboard
+    from src.database.user import UserCache
+
+    await ENGINE.dispose()
+    shutil.rmtree(Config.DATABASES_DIR, ignore_errors=True)
+    Config.DATABASES_DIR.mkdir(parents=True)
+    if seed:
+        seed(Config.DATABASES_DIR)
+    await init_database(force=True)
+    UserCache.clear()
+    ScoreLeaderboard.invalidate()
+    KnownCdks.__init__()
+    # 每个测试使用新的事件循环，asyncio.Event 会绑定到首次等待它的事件循环
+    Maintenance.__init__()
+
+
+@pytest.fixture
+async def database():
+    await reset_databases()
+    yield
+
+
+class FakeEmby:
+    """
+    本地的 HTTP/1.1 服务器，按路径调用预设的处理函数模拟 Emby
+    处理函数接收 (方法, 请求头, 请求体)，返回 (状态码, JSON 响应)，可在其中 sleep 模拟慢响应
+    """
+
+    def __init__(self):
+        self.handlers: dict[str, Callable[[str, dict, bytes], Awaitable[tuple[int, Any]]]] = {}
+        self.requests: list[tuple[str, str]] = []  # (方法, 路径)
+        self.connections = 0  # 累计建立的连接数
+        self.max_open = 0  # 同时打开的最大连接数
+        self._server: asyncio.Server | None = None
+        self._writers: set[asyncio.StreamWriter] = set()
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}/emby"
+
+    def count(self, path: str) -> int:
+        return sum(request_path == path for _, request_path in self.requests)
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+
+    async def close(self):
+        self._server.close()
+        for writer in self._writers:
+            writer.close()
+        await self._server.wait_closed()
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        self.connections += 1
+        self.max_open = max(self.max_open, len(self._writers))
+        try:
+            while line := await reader.readline():
+                method, target = line.decode().split()[:2]
+                headers = {}
+                while (header := await reader.readline()) not in (b"\r\n", b""):
+                    key, value = header.decode().split(":", 1)
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                path = target.split("?", 1)[0].removeprefix("/emby/")
+                self.requests.append((method, path))
+                handler = self.handlers.get(path)
+                status, payload = await handler(method, headers, body) if handler else (404, None)
+                content = json.dumps(payload).encode() if payload is not None else b""
+                writer.write(b"HTTP/1.1 %d Fake\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n"
+                             % (status, len(content)) + content)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+
+@pytest.fixture
+async def fake_emby():
+    from src.http_client import close_transports
+
+    server = FakeEmby()
+    await server.start()
+    yield server
+    await server.close()
+    # 连接池绑定在当前事件循环上
+    await close_transports()
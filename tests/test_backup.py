@@ -0,0 +1,74 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from src.database import Maintenance, optimize_database, session_scope
+from src.database.backup import backup_databases, list_backups, restore_databases
+from src.database.score import LedgerReason, ScoreOperate
+from src.scheduler import paused_jobs
+
+
+@pytest.mark.anyio
+async def test_backups_in_same_second(database):
+    first = await backup_databases()
+    second = await backup_databases()
+    assert first != second
+    assert list_backups()[:2] == [second, first]
+
+
+@pytest.mark.anyio
+async def test_backup_then_restore(database):
+    await ScoreOperate.credit(1, 10, LedgerReason.SIGN)
+    backup = await backup_databases()
+    await ScoreOperate.credit(1, 5, LedgerReason.SIGN)
+    # 恢复前会在同一秒内再备份一次当前数据
+    current = await restore_databases(backup.name)
+    assert current != backup
+    assert (await ScoreOperate.get_score(1)).score == 10
+    await restore_databases(current.name)
+    assert (await ScoreOperate.get_score(1)).score == 15
+
+
+@pytest.mark.anyio
+async def test_restore_blocks_sessions(database):
+    await ScoreOperate.credit(1, 10, LedgerReason.SIGN)
+    backup = await backup_databases()
+    release = asyncio.Event()
+
+    async def in_flight():
+        async with session_scope():
+            await release.wait()
+
+    holder = asyncio.create_task(in_flight())
+    await asyncio.sleep(0)
+    restore = asyncio.create_task(restore_databases(backup.name))
+    for _ in range(1000):
+        if Maintenance.active:
+            break
+        await asyncio.sleep(0.001)
+    # 恢复开始后发起的写入等待恢复结束，不会被备份覆盖
+    write = asyncio.create_task(ScoreOperate.credit(1, 5, LedgerReason.SIGN))
+    await asyncio.sleep(0.05)
+    assert not write.done()
+    release.set()
+    await asyncio.gather(holder, restore, write)
+    assert (await ScoreOperate.get_score(1)).score == 15
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("job", [optimize_database, backup_databases])
+async def test_maintenance_waits_for_restore(database, job):
+    async with Maintenance.closed():
+        task = asyncio.create_task(job())
+        await asyncio.sleep(0.05)
+        assert not task.done()
+    await task
+
+
+def test_paused_jobs():
+    jobs = [SimpleNamespace(enabled=True), SimpleNamespace(enabled=False)]
+    job_queue = SimpleNamespace(jobs=lambda: jobs)
+    with paused_jobs(job_queue):
+        assert [job.enabled for job in jobs] == [False, False]
+    assert [job.enabled for job in jobs] == [True, False]
@@ -0,0 +1,81 @@
+from datetime import datetime
+
+import pytest
+
+from src.config import Config
+from src.database import unit_of_work
+from src.database.cdk import CdkOperate, CdkSignature, KnownCdks, _b62encode, _sign, generate_cdk, signed_expiry, \
+    verify_cdk
+from src.database.score import LedgerReason, ScoreOperate
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("cdk", [None, "", 123])
+async def test_get_cdk_rejects_missing_code(database, cdk):
+    await CdkOperate.bulk_add_cdk(3)
+    await KnownCdks.load()
+    assert await CdkOperate.get_cdk(cdk) is None
+
+
+@pytest.mark.anyio
+async def test_get_cdk_uses_filter(database):
+    codes = await CdkOperate.bulk_add_cdk(3)
+    await KnownCdks.load()
+    assert (await CdkOperate.get_cdk(codes[0])).cdk == codes[0]
+    assert await CdkOperate.get_cdk("reg_AAAAAAAAAAAAAAAA_prej") is None
+    assert KnownCdks.rejected + KnownCdks.db_misses == 1
+
+
+@pytest.mark.anyio
+async def test_failed_generation_refunds_debit(database):
+    await ScoreOperate.credit(1, 100, LedgerReason.SIGN)
+    existing, = await CdkOperate.bulk_add_cdk(1)
+    with pytest.raises(RuntimeError):
+        async with unit_of_work():
+            await ScoreOperate.debit(1, 50, LedgerReason.GEN_CDK)
+            await CdkOperate.bulk_add_cdk(1, generator=lambda: existing, max_rounds=2)
+    assert (await ScoreOperate.get_score(1)).score == 100
+
+
+@pytest.fixture
+def signed(monkeypatch):
+    monkeypatch.setattr(Config, "SIGNED_CDK", True)
+    monkeypatch.setattr(Config, "SALT", "test-salt")
+
+
+@pytest.mark.anyio
+async def test_signed_cdk_expiry(database, signed):
+    now = int(datetime.now().timestamp())
+    expired, = await CdkOperate.bulk_add_cdk(1, expired_time=now - 60)
+    assert verify_cdk(expired) == CdkSignature.EXPIRED
+    assert signed_expiry(expired) == now - 60
+    code, = await CdkOperate.bulk_add_cdk(1, expired_time=now + 60)
+    assert verify_cdk(code) == CdkSignature.VALID
+    # 数据库中的过期时间仍然生效，管理员可以提前使其过期
+    cdk_data = await CdkOperate.get_cdk(code)
+    cdk_data.expired_time = now - 1
+    await CdkOperate.update_cdk(cdk_data)
+    assert not await CdkOperate.redeem(code, 1)
+    permanent, = await CdkOperate.bulk_add_cdk(1)
+    assert verify_cdk(permanent) == CdkSignature.VALID
+    assert signed_expiry(permanent) == 0
+
+
+def test_signed_cdk_version_1_still_valid(signed):
+    body = b"\x01" * 12
+    code = f"reg_1{_b62encode(body + _sign('1', body), 30)}_prej"
+    assert verify_cdk(code) == CdkSignature.VALID
+    assert verify_cdk("reg_2" + code[5:]) == CdkSignature.INVALID
+
+
+def test_signed_cdk_rejects_forgery(signed):
+    code = generate_cdk()
+    assert verify_cdk(code) == CdkSignature.VALID
+    forged = code[:-8] + ("A" if code[-8] != "A" else "B") + code[-7:]
+    assert verify_cdk(forged) == CdkSignature.INVALID
+
+
+def test_signed_cdk_requires_salt(signed, monkeypatch):
+    monkeypatch.setattr(Config, "SALT", "")
+    assert verify_cdk(generate_cdk()) == CdkSignature.UNSIGNED
+    assert not Config.SIGNED_CDK
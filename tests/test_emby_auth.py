@@ -0,0 +1,64 @@
+import asyncio
+import uuid
+from urllib.parse import parse_qs
+
+import pytest
+
+from src.config import HttpConfig
+from src.emby.api import EmbyAPI
+
+
+@pytest.fixture
+async def emby(fake_emby):
+    tokens = set()
+    bad_headers = []
+
+    async def authenticate(method, headers, body):
+        if "x-emby-token" in headers or "x-emby-device-id" not in headers:
+            bad_headers.append(headers)
+        form = {key: value[0] for key, value in parse_qs(body.decode()).items()}
+        if form.get("Pw") != "good":
+            return 401, None
+        token = uuid.uuid4().hex
+        tokens.add(token)
+        await asyncio.sleep(0.005)
+        return 200, {"AccessToken": token, "User": {"Id": f"id-{form['Username']}", "Name": form["Username"]}}
+
+    async def logout(method, headers, body):
+        tokens.discard(headers.get("x-emby-token"))
+        return 204, None
+
+    fake_emby.handlers["Users/authenticatebyname"] = authenticate
+    fake_emby.handlers["Sessions/Logout"] = logout
+    api = EmbyAPI(fake_emby.url, 1, "api-key")
+    yield api, tokens, bad_headers
+    await api.EmbyReq.close()
+
+
+@pytest.mark.anyio
+async def test_authenticate(emby):
+    api, tokens, bad_headers = emby
+    assert (await api.Auth.authenticate("alice", "good"))["Id"] == "id-alice"
+    assert await api.Auth.authenticate("alice", "bad") is None
+    assert not tokens and not bad_headers
+    # 共享客户端的请求头不变
+    assert api.EmbyReq.client.headers["X-Emby-Token"] == "api-key"
+    assert "X-Emby-Device-Id" not in api.EmbyReq.client.headers
+
+
+@pytest.mark.anyio
+async def test_authenticate_under_load(emby, fake_emby):
+    api, tokens, bad_headers = emby
+    users = [f"user{i}" for i in range(500)]
+    semaphore = asyncio.Semaphore(50)
+
+    async def bind(name):
+        async with semaphore:
+            return await api.Auth.authenticate(name, "good")
+
+    results = await asyncio.gather(*(bind(name) for name in users))
+    assert [user["Id"] for user in results] == [f"id-{name}" for name in users]
+    # 临时 AccessToken 全部注销，并发连接数受连接池限制
+    assert not tokens and not bad_headers
+    assert fake_emby.max_open <= HttpConfig.MAX_CONNECTIONS
+    assert fake_emby.count("Users/authenticatebyname") == len(users)
@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from src.emby.api import req
+from src.emby.api.req import CircuitBreaker, CircuitOpenError, CircuitState, EmbyRequest
+
+
+def responses(*statuses: int):
+    """依次返回给定的状态码，用完后重复最后一个"""
+    remaining = list(statuses)
+
+    async def handler(method, headers, body):
+        status = remaining.pop(0) if len(remaining) > 1 else remaining[0]
+        return status, {"status": status}
+
+    return handler
+
+
+def slow(delay: float):
+    async def handler(method, headers, body):
+        await asyncio.sleep(delay)
+        return 200, {}
+
+    return handler
+
+
+@pytest.fixture
+async def emby(fake_emby, monkeypatch):
+    monkeypatch.setattr(req, "RETRY_BACKOFF", 0)
+    request = EmbyRequest(fake_emby.url, auth=1, api_key="key")
+    request.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+    yield request
+    await request.close()
+
+
+@pytest.mark.anyio
+async def test_retry_idempotent(emby, fake_emby):
+    fake_emby.handlers["Items"] = responses(503, 502, 200)
+    response = await emby.request("GET", "/Items", retries=2)
+    assert response.json() == {"status": 200}
+    assert fake_emby.count("Items") == 3
+
+
+@pytest.mark.anyio
+async def test_retry_exhausted(emby, fake_emby):
+    fake_emby.handlers["Items"] = responses(503)
+    with pytest.raises(httpx.HTTPStatusError):
+        await emby.request("GET", "/Items", retries=2)
+    assert fake_emby.count("Items") == 3
+
+
+@pytest.mark.anyio
+async def test_post_not_retried(emby, fake_emby):
+    fake_emby.handlers["Users/New"] = responses(503, 200)
+    with pytest.raises(httpx.HTTPStatusError):
+        await emby.request("POST", "/Users/New", retries=2)
+    assert fake_emby.count("Users/New") == 1
+
+
+@pytest.mark.anyio
+async def test_endpoint_timeout(emby, fake_emby, monkeypatch):
+    monkeypatch.setitem(req.ENDPOINT_TIMEOUTS, "System/Info/Public", httpx.Timeout(0.1))
+    fake_emby.handlers["System/Info/Public"] = slow(0.5)
+    fake_emby.handlers["Items"] = slow(0.3)
+    start = time.monotonic()
+    with pytest.raises(httpx.ReadTimeout):
+        await emby.request("GET", "/System/Info/Public", retries=0)
+    assert time.monotonic() - start < 0.4
+    # 其他路径使用默认超时
+    assert (await emby.request("GET", "/Items", retries=0)).status_code == 200
+
+
+@pytest.mark.anyio
+async def test_breaker_counts_calls_not_attempts(emby, fake_emby):
+    fake_emby.handlers["Items"] = responses(503)
+    with pytest.raises(httpx.HTTPStatusError):
+        await emby.request("GET", "/Items", retries=2)
+    assert (emby.breaker.state, emby.breaker.failures) == (CircuitState.CLOSED, 1)
+
+
+@pytest.mark.anyio
+async def test_breaker_open_half_open_close(emby, fake_emby):
+    fake_emby.handlers["Items"] = responses(503, 503, 503, 200)
+    for _ in range(2):
+        with pytest.raises(httpx.HTTPStatusError):
+            await emby.request("GET", "/Items", retries=0)
+    assert emby.breaker.state is CircuitState.OPEN
+    # 熔断期间不再请求服务器
+    with pytest.raises(CircuitOpenError):
+        await emby.request("GET", "/Items", retries=0)
+    assert fake_emby.count("Items") == 2
+
+    await asyncio.sleep(0.25)
+    # 半开时只放行一个探测请求，探测失败继续熔断
+    with pytest.raises(httpx.HTTPStatusError):
+        await emby.request("GET", "/Items", retries=0)
+    assert emby.breaker.state is CircuitState.OPEN
+
+    await asyncio.sleep(0.25)
+    probe = asyncio.create_task(emby.request("GET", "/Items", retries=0))
+    await asyncio.sleep(0)
+    assert emby.breaker.state is CircuitState.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        await emby.request("GET", "/Items", retries=0)
+    assert (await probe).status_code == 200
+    assert emby.breaker.state is CircuitState.CLOSED
+    assert fake_emby.count("Items") == 4
@@ -0,0 +1,146 @@
+import base64
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+import pytest
+from sqlalchemy import select
+
+from conftest import reset_databases
+
+
+def _baseline_cdk(directory: Path):
+    """与最初版本相同的 cdk.db：cdk 列只有普通索引，可能存在重复的注册码，使用历史存为 json"""
+    connection = sqlite3.connect(directory / "cdk.db")
+    connection.executescript("""
+        CREATE TABLE cdk (
+            id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            cdk VARCHAR NOT NULL,
+            "limit" INTEGER NOT NULL,
+            expired_time INTEGER NOT NULL,
+            used_history VARCHAR NOT NULL,
+            other VARCHAR
+        );
+        CREATE INDEX ix_cdk_id ON cdk (id);
+        CREATE INDEX ix_cdk_cdk ON cdk (cdk);
+    """)
+    history = json.dumps([{"tg_id": 1, "time": 100}])
+    connection.executemany('INSERT INTO cdk (cdk, "limit", expired_time, used_history) VALUES (?, ?, ?, ?)', [
+        ("reg_duplicate", 1, 0, history),
+        ("reg_single", 1, 0, ""),
+        ("reg_duplicate", 2, 0, json.dumps([{"tg_id": 1, "time": 200}, {"tg_id": 2, "time": 300}])),
+        ("reg_duplicate", 3, 0, ""),
+    ])
+    connection.commit()
+    connection.close()
+
+
+@pytest.mark.anyio
+async def test_cdk_upgrade_from_baseline_with_duplicates():
+    from src.database import session_scope
+    from src.database.cdk import CdkModel, CdkOperate, CdkUsageModel
+
+    await reset_databases(_baseline_cdk)
+
+    async with session_scope() as session:
+        rows = (await session.execute(select(CdkModel.cdk, CdkModel.limit).order_by(CdkModel.id))).all()
+        usages = (await session.execute(select(CdkUsageModel.cdk_id, CdkUsageModel.telegram_id)
+                                        .order_by(CdkUsageModel.telegram_id))).all()
+    assert rows == [("reg_duplicate", 6), ("reg_single", 1)]
+    # 重复注册码的使用记录并入最早的一条，同一用户只保留一次
+    assert usages == [(1, 1), (1, 2)]
+    assert (await CdkOperate.get_cdk("reg_duplicate")).id == 1
+
+    connection = sqlite3.connect(_cdk_path())
+    indexes = {name: unique for _, name, unique, *_ in connection.execute("PRAGMA index_list(cdk)")}
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    connection.close()
+    assert indexes["ix_cdk_cdk_cdk"] == 1
+    assert not {"ix_cdk_id", "ix_cdk_cdk", "ix_cdk_cdk_id"} & indexes.keys()
+    assert version == 4
+
+
+@pytest.mark.anyio
+async def test_cdk_fresh_database_has_only_needed_indexes(database):
+    connection = sqlite3.connect(_cdk_path())
+    indexes = {name: unique for _, name, unique, *_ in connection.execute("PRAGMA index_list(cdk)")}
+    connection.close()
+    assert indexes == {"ix_cdk_cdk_cdk": 1, "ix_cdk_available": 0}
+
+
+def _cdk_path() -> str:
+    from src.database import database_path
+    return database_path("cdk")
+
+
+def _baseline_score(directory: Path):
+    """与最初版本相同的 score.db：旧版本的红包没有创建时间"""
+    connection = sqlite3.connect(directory / "score.db")
+    connection.executescript("""
+        CREATE TABLE score (
+            telegram_id INTEGER NOT NULL PRIMARY KEY,
+            score INTEGER NOT NULL,
+            checkin_time INTEGER NOT NULL,
+            data VARCHAR
+        );
+        CREATE INDEX ix_score_telegram_id ON score (telegram_id);
+        CREATE TABLE red_packet (
+            id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            current_amount INTEGER NOT NULL,
+            status INTEGER NOT NULL,
+            type INTEGER NOT NULL,
+            history VARCHAR NOT NULL,
+            create_time INTEGER,
+            data VARCHAR
+        );
+        CREATE INDEX ix_red_packet_id ON red_packet (id);
+        CREATE INDEX ix_red_packet_telegram_id ON red_packet (telegram_id);
+    """)
+    history = "".join(f"{tg_id}#{base64.b64encode(name.encode()).decode()}#{amount},"
+                      for tg_id, name, amount in ((2, "小明", 6), (3, "Bob", 4)))
+    connection.executemany("INSERT INTO red_packet (telegram_id, amount, count, current_amount, status, type, "
+                           "history, create_time) VALUES (1, 10, 2, 0, ?, 0, ?, ?)", [
+        (1, history, None),  # 已领完
+        (2, "", None),  # 已撤回
+        (1, history, int(time.time())),
+        (0, "", None),  # 升级时仍未领完
+    ])
+    connection.commit()
+    connection.close()
+
+
+@pytest.mark.anyio
+async def test_score_upgrade_archives_legacy_red_packets():
+    from src.database.score import ScoreOperate
+
+    await reset_databases(_baseline_score)
+
+    # 已结束红包的领取历史同样迁移到 red_packet_share 表
+    for packet_id in (1, 3):
+        claims = await ScoreOperate.get_red_packet_claims(packet_id)
+        assert sorted((claim.telegram_id, claim.fullname, claim.amount) for claim in claims) == [
+            (2, "小明", 6), (3, "Bob", 4)]
+    assert await ScoreOperate.archive_red_packets(int(time.time()) - 60) == 2
+    assert await ScoreOperate.get_red_packet(1) is None
+    assert await ScoreOperate.get_red_packet(3) is not None
+    # 未结束的旧红包从升级时开始计算有效期，不会在第一次过期清理时退款
+    assert await ScoreOperate.expire_red_packets(int(time.time()) - 60) == []
+    assert (await ScoreOperate.get_red_packet(4)).status == 0
+
+
+@pytest.mark.anyio
+async def test_optimize_leaves_vacuum_to_admin():
+    from src.database import optimize_database, pending_vacuum, vacuum_database
+
+    await reset_databases(_baseline_cdk)
+    assert await pending_vacuum() == ["cdk"]
+    # 定时维护不执行完整的 VACUUM
+    assert "cdk" not in await optimize_database()
+    assert await pending_vacuum() == ["cdk"]
+    assert set(await vacuum_database()) == {"cdk"}
+    assert await pending_vacuum() == []
+    assert "cdk" in await optimize_database()
@@ -0,0 +1,63 @@
+import pytest
+from sqlalchemy import select, update
+
+from src.database import session_scope, unit_of_work
+from src.database.scope import update_scope
+from src.database.user import Role, UserCache, UserModel, UsersOperate
+
+
+async def _add_user(telegram_id: int = 1):
+    await UsersOperate.add_user(UserModel(telegram_id=telegram_id, username="user", fullname="User",
+                                          role=Role.ORDINARY.value))
+    UserCache.clear()
+
+
+@pytest.mark.anyio
+async def test_flush_on_return(database):
+    await _add_user()
+    async with update_scope():
+        user = await UsersOperate.get_user(1)
+        user.fullname = "Renamed"
+        await UsersOperate.update_user(user)
+    assert (await UsersOperate.get_user(1)).fullname == "Renamed"
+
+
+@pytest.mark.anyio
+async def test_no_flush_on_exception(database):
+    await _add_user()
+    with pytest.raises(RuntimeError):
+        async with update_scope():
+            user = await UsersOperate.get_user(1)
+            user.fullname = "Renamed"
+            await UsersOperate.update_user(user)
+            raise RuntimeError
+    assert (await UsersOperate.get_user(1)).fullname == "User"
+
+
+async def _stored(column):
+    async with session_scope() as session:
+        return (await session.execute(select(column).filter_by(telegram_id=1))).scalar_one()
+
+
+@pytest.mark.anyio
+async def test_flush_keeps_concurrent_changes(database):
+    await _add_user()
+    async with update_scope():
+        user = await UsersOperate.get_user(1)
+        user.fullname = "Renamed"
+        await UsersOperate.update_user(user)
+        # 期间管理员封禁了该用户
+        async with session_scope() as session:
+            await session.execute(update(UserModel).filter_by(telegram_id=1).values(role=Role.BANNED.value))
+    assert (await _stored(UserModel.fullname), await _stored(UserModel.role)) == ("Renamed", Role.BANNED.value)
+
+
+@pytest.mark.anyio
+async def test_unit_of_work_commits_inside_scope(database):
+    await _add_user()
+    async with update_scope():
+        user = await UsersOperate.get_user(1)
+        user.password = "hash"
+        async with unit_of_work():
+            await UsersOperate.update_user(user)
+        assert await _stored(UserModel.password) == "hash"
@@ -0,0 +1,89 @@
+import asyncio
+from contextlib import asynccontextmanager
+from functools import partial
+
+import pytest
+from sqlalchemy import select
+
+from src.database import Maintenance, score, session_scope
+from src.database.scope import current_scope, update_scope
+from src.database.score import Leaderboard, LedgerGroupCommit, LedgerReason, ScoreJournalModel, ScoreOperate
+
+
+@pytest.mark.anyio
+async def test_invalidate_during_load(database, monkeypatch):
+    await ScoreOperate.credit(1, 10, LedgerReason.SIGN)
+    leaderboard = Leaderboard()
+    session_scope = score.session_scope
+
+    @asynccontextmanager
+    async def invalidating_scope():
+        async with session_scope() as session:
+            yield session
+        # 加载查询期间积分被管理员直接修改
+        monkeypatch.setattr(score, "session_scope", session_scope)
+        leaderboard.invalidate()
+
+    monkeypatch.setattr(score, "session_scope", invalidating_scope)
+    assert await leaderboard.top() == [(1, None, 10)]
+    await ScoreOperate.credit(2, 20, LedgerReason.SIGN)
+    assert await leaderboard.top() == [(2, None, 20), (1, None, 10)]
+
+
+@pytest.mark.anyio
+async def test_group_commit_fails_only_offending_operation(database):
+    async def failing(session):
+        await score._credit(session, 2, 5, LedgerReason.SIGN)
+        raise ValueError("boom")
+
+    committer = LedgerGroupCommit()
+    results = await asyncio.gather(
+            committer.submit(partial(score._credit, telegram_id=1, amount=10, reason=LedgerReason.SIGN)),
+            committer.submit(failing),
+            committer.submit(partial(score._credit, telegram_id=3, amount=30, reason=LedgerReason.SIGN)),
+            return_exceptions=True)
+    assert results[0] == 10 and results[2] == 30
+    assert isinstance(results[1], ValueError)
+    assert await ScoreOperate.get_score(2) is None
+    async with session_scope() as session:
+        journal = (await session.execute(select(ScoreJournalModel.telegram_id))).scalars().all()
+    assert sorted(journal) == [1, 3]
+
+
+@pytest.mark.anyio
+async def test_group_commit_is_atomic(database, monkeypatch):
+    async def broken_journal(session):
+        raise RuntimeError("journal")
+
+    monkeypatch.setattr(score, "_write_journal", broken_journal)
+    committer = LedgerGroupCommit()
+    results = await asyncio.gather(
+            committer.submit(partial(score._credit, telegram_id=1, amount=10, reason=LedgerReason.SIGN)),
+            committer.submit(partial(score._credit, telegram_id=2, amount=20, reason=LedgerReason.SIGN)),
+            return_exceptions=True)
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert await ScoreOperate.get_score(1) is None
+
+
+@pytest.mark.anyio
+async def test_group_commit_flusher_has_own_context(database):
+    scopes = []
+
+    async def credit(session):
+        scopes.append(current_scope())
+        return await score._credit(session, 1, 10, LedgerReason.SIGN)
+
+    committer = LedgerGroupCommit()
+    async with update_scope():
+        assert await committer.submit(credit) == 10
+    assert scopes == [None]
+    # 提交者处于会话内时，刷新任务仍要经过维护入口
+    token = Maintenance._inside.set(True)
+    try:
+        async with Maintenance.closed():
+            task = asyncio.create_task(committer.submit(credit))
+            await asyncio.sleep(0.05)
+            assert not task.done()
+    finally:
+        Maintenance._inside.reset(token)
+    assert await task == 20
@@ -0,0 +1,41 @@
+import pytest
+
+from src.database.user import Role, UserCache, UserModel, UsersOperate
+from src.utils import AmbiguousUserError, get_user_info
+
+
+@pytest.fixture
+async def users(database):
+    for telegram_id, fullname, username in ((1, "Alice", "alice"), (2, "Alice Smith", None), (3, "Malice", "mal"),
+                                            (4, "Bob", "bobby"), (5, "Bob", None)):
+        await UsersOperate.add_user(UserModel(telegram_id=telegram_id, fullname=fullname, username=username,
+                                              role=Role.ORDINARY.value))
+    UserCache.clear()
+
+
+@pytest.mark.anyio
+async def test_exact_match_first(users):
+    assert [user.telegram_id for user in await UsersOperate.search_users("Alice")] == [1]
+    assert [user.telegram_id for user in await UsersOperate.search_users("bobby")] == [4]
+    assert {user.telegram_id for user in await UsersOperate.search_users("lice")} == {1, 2, 3}
+    assert {user.telegram_id for user in await UsersOperate.search_users("Bo")} == {4, 5}
+
+
+@pytest.mark.anyio
+async def test_search_follows_updates(users):
+    user = await UsersOperate.get_user(3)
+    user.fullname = "Carol"
+    await UsersOperate.update_user(user)
+    assert {user.telegram_id for user in await UsersOperate.search_users("lice")} == {1, 2}
+    assert [user.telegram_id for user in await UsersOperate.search_users("Carol")] == [3]
+
+
+@pytest.mark.anyio
+async def test_get_user_info_candidates(users):
+    assert (await get_user_info("Alice", only_tg_info=True))[1].telegram_id == 1
+    with pytest.raises(AmbiguousUserError) as error:
+        await get_user_info("lice", only_tg_info=True)
+    assert {user.telegram_id for user in error.value.candidates} == {1, 2, 3}
+    with pytest.raises(AmbiguousUserError):
+        await get_user_info("Bob", only_tg_info=True)
+    assert (await get_user_info("lice", only_tg_info=True, candidates=1))[1] is not None